@@ -26,6 +26,7 @@ from keys.keychain import KeyChain
 from dht.utils import digest
 from market.profile import Profile
 from market.contracts import Contract, check_order_for_payment
+from market.transfer import VISIBLE
 from net.upnp import PortMapper
 
 DEFAULT_RECORDS_COUNT = 20
@@ -105,6 +106,12 @@ class OpenBazaarAPI(APIResource):
     @GET('^/api/v1/get_image')
     @authenticated
     def get_image(self, request):
+        def _imagePath():
+            image_path = self.db.filemap.get_file(request.args["hash"][0])
+            if image_path is None:
+                image_path = self.db.cache.get(request.args["hash"][0])
+            return image_path
+
         @defer.inlineCallbacks
         def _showImage(resp=None):
             @defer.inlineCallbacks
@@ -113,12 +120,17 @@ class OpenBazaarAPI(APIResource):
                 request.setHeader('content-type', content_type)
                 request.setHeader('cache-control', 'max-age=604800')
 
-                f = open(file_path, "rb")
-                yield FileSender().beginFileTransfer(f, request)
-                f.close()
+                image = self.db.filemap.read(request.args["hash"][0])
+                if image is not None:
+                    request.write(image)
+                else:
+                    f = open(file_path, "rb")
+                    yield FileSender().beginFileTransfer(f, request)
+                    f.close()
                 defer.returnValue(0)
 
-            if os.path.exists(image_path):
+            image_path = _imagePath()
+            if image_path is not None and os.path.exists(image_path):
                 yield _setContentDispositionAndSend(image_path, "jpg", "image/jpeg")
             else:
                 request.setResponseCode(http.NOT_FOUND)
@@ -126,17 +138,15 @@ class OpenBazaarAPI(APIResource):
             request.finish()
 
         if "hash" in request.args and len(request.args["hash"][0]) == 40:
-            if self.db.filemap.get_file(request.args["hash"][0]) is not None:
-                image_path = self.db.filemap.get_file(request.args["hash"][0])
-            else:
-                image_path = DATA_FOLDER + "cache/" + request.args["hash"][0]
-            if not os.path.exists(image_path) and "guid" in request.args:
+            if _imagePath() is None and "guid" in request.args:
                 node = None
                 for connection in self.protocol.values():
                     if connection.handler.node is not None and \
                                     connection.handler.node.id == unhexlify(request.args["guid"][0]):
                         node = connection.handler.node
-                        self.mserver.get_image(node, unhexlify(request.args["hash"][0])).addCallback(_showImage)
+                        self.mserver.get_image(node, unhexlify(request.args["hash"][0]),
+                                               priority=VISIBLE).addCallback(_showImage)
+                        break
                 if node is None:
                     _showImage()
             else:
@@ -505,7 +515,12 @@ class OpenBazaarAPI(APIResource):
                     else:
                         request.write(json.dumps({}))
                         request.finish()
-                self.kserver.resolve(unhexlify(request.args["guid"][0])).addCallback(get_node)
+                contract = self.mserver.get_verified_contract(unhexlify(request.args["guid"][0]),
+                                                              unhexlify(request.args["id"][0]))
+                if contract is not None:
+                    parse_contract(contract)
+                else:
+                    self.kserver.resolve(unhexlify(request.args["guid"][0])).addCallback(get_node)
             else:
                 try:
                     with open(self.db.filemap.get_file(request.args["id"][0]), "r") as filename:
@@ -983,7 +998,8 @@ class OpenBazaarAPI(APIResource):
             def get_response(num):
                 request.write(json.dumps({"success": True, "peers reached": num}, indent=4))
                 request.finish()
-            self.mserver.broadcast(request.args["message"][0]).addCallback(get_response)
+            relay = "relay" in request.args and str_to_bool(request.args["relay"][0])
+            self.mserver.broadcast(request.args["message"][0], relay=relay).addCallback(get_response)
             return server.NOT_DONE_YET
         except Exception, e:
             request.write(json.dumps({"success": False, "reason": e.message}, indent=4))
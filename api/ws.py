@@ -2,7 +2,6 @@ __author__ = 'chris'
 
 import ast
 import json
-import os
 import time
 from binascii import unhexlify
 from random import shuffle
@@ -14,11 +13,11 @@ from twisted.internet.protocol import Protocol, Factory, connectionDone
 from txws import WebSocketProtocol, WebSocketFactory
 
 from api.utils import smart_unicode
-from config import DATA_FOLDER
 from dht.node import Node
 from keys.keychain import KeyChain
 from log import Logger
 from market.profile import Profile
+from market.transfer import THUMBNAIL
 from protos import objects
 from protos.countries import CountryCode
 from protos.objects import PlaintextMessage, Value, Listings
@@ -168,10 +167,10 @@ class WSProtocol(Protocol):
                             }
                             for country in l.ships_to:
                                 listing_json["listing"]["ships_to"].append(str(CountryCode.Name(country)))
-                            if not os.path.isfile(DATA_FOLDER + 'cache/' + l.thumbnail_hash.encode("hex")):
-                                self.factory.mserver.get_image(node, l.thumbnail_hash)
-                            if not os.path.isfile(DATA_FOLDER + 'cache/' + listings.avatar_hash.encode("hex")):
-                                self.factory.mserver.get_image(node, listings.avatar_hash)
+                            if l.thumbnail_hash.encode("hex") not in self.factory.db.cache:
+                                self.factory.mserver.get_image(node, l.thumbnail_hash, priority=THUMBNAIL)
+                            if listings.avatar_hash.encode("hex") not in self.factory.db.cache:
+                                self.factory.mserver.get_image(node, listings.avatar_hash, priority=THUMBNAIL)
                             self.transport.write(str(bleach.clean(
                                 json.dumps(listing_json, indent=4), tags=ALLOWED_TAGS)))
                             count += 1
@@ -193,12 +192,13 @@ class WSProtocol(Protocol):
                     shuffle(vendor_list)
                     node_to_ask = vendor_list[0]
                     if node_to_ask is not None:
-                        self.factory.mserver.get_listings(node_to_ask).addCallback(handle_response, node_to_ask)
+                        self.factory.mserver.get_catalog(node_to_ask, count=3).addCallback(handle_response,
+                                                                                           node_to_ask)
 
         vendor_list = vendors.values()
         shuffle(vendor_list)
         for vendor in vendor_list[:15]:
-            self.factory.mserver.get_listings(vendor).addCallback(handle_response, vendor)
+            self.factory.mserver.get_catalog(vendor, count=3).addCallback(handle_response, vendor)
 
     def send_message(self, message_id, guid, handle, message, subject, message_type, recipient_key):
 
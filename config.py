@@ -12,7 +12,10 @@ from os.path import expanduser, join, isfile
 from ConfigParser import ConfigParser
 from urlparse import urlparse
 
-PROTOCOL_VERSION = 1
+PROTOCOL_VERSION = 7
+# Peers running an older version than this are disconnected. Version 2 added
+# session authenticated messages but still talks to version 1 nodes.
+MIN_PROTOCOL_VERSION = 1
 CONFIG_FILE = join(os.getcwd(), 'ob.cfg')
 
 # FIXME probably a better way to do this. This curretly checks two levels deep.
@@ -35,6 +38,11 @@ DEFAULTS = {
     'ssl': False,
     'username': None,
     'password': None,
+    'session_auth': 'True',
+    'max_connections': '1000',
+    'cache_size': '512',
+    'send_rate': '2048',
+    'peer_send_rate': '512',
     'seed': 'seed.openbazaar.org:8080,5b44be5c18ced1bc9400fe5e79c8ab90204f06bebacc04dd9c70a95eaca6e117',
 }
 
@@ -165,6 +173,11 @@ TRANSACTION_FEE = int(cfg.get('CONSTANTS', 'TRANSACTION_FEE'))
 LIBBITCOIN_SERVER = cfg.get('CONSTANTS', 'LIBBITCOIN_SERVER')
 LIBBITCOIN_SERVER_TESTNET = cfg.get('CONSTANTS', 'LIBBITCOIN_SERVER_TESTNET')
 RESOLVER = cfg.get('CONSTANTS', 'RESOLVER')
+SESSION_AUTH = str_to_bool(cfg.get('CONSTANTS', 'SESSION_AUTH'))
+MAX_CONNECTIONS = int(cfg.get('CONSTANTS', 'MAX_CONNECTIONS'))
+CACHE_SIZE = int(cfg.get('CONSTANTS', 'CACHE_SIZE')) * 1024 * 1024
+SEND_RATE = int(cfg.get('CONSTANTS', 'SEND_RATE')) * 1024
+PEER_SEND_RATE = int(cfg.get('CONSTANTS', 'PEER_SEND_RATE')) * 1024
 SSL = str_to_bool(cfg.get('AUTHENTICATION', 'SSL'))
 SSL_CERT = cfg.get('AUTHENTICATION', 'SSL_CERT')
 SSL_KEY = cfg.get('AUTHENTICATION', 'SSL_KEY')
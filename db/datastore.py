@@ -2,21 +2,27 @@ __author__ = 'chris'
 
 import os
 import sqlite3 as lite
+import time
 from collections import Counter
-from config import DATA_FOLDER
+from config import DATA_FOLDER, CACHE_SIZE
 from dht.node import Node
-from dht.utils import digest
+from dht.utils import digest, LRUCache
 from protos import objects
 from protos.objects import Listings, Followers, Following
 from os.path import join
-from db.migrations import migration1
+from db.migrations import migration1, migration2, migration3, migration4, migration5
+
+# Files served to other nodes are kept in memory up to this many bytes in total. Files
+# larger than MAX_CACHED_FILE are always read from disk.
+FILE_CACHE_SIZE = 32 * 1024 * 1024
+MAX_CACHED_FILE = 1024 * 1024
 
 
 class Database(object):
 
     __slots__ = ['PATH', 'filemap', 'profile', 'listings', 'keys', 'follow', 'messages',
                  'notifications', 'broadcasts', 'vendors', 'moderators', 'purchases', 'sales',
-                 'cases', 'ratings', 'settings']
+                 'cases', 'ratings', 'settings', 'verified_contracts', 'cache']
 
     def __init__(self, testnet=False, filepath=None):
         object.__setattr__(self, 'PATH', self._database_path(testnet, filepath))
@@ -35,6 +41,8 @@ class Database(object):
         object.__setattr__(self, 'cases', Cases(self.PATH))
         object.__setattr__(self, 'ratings', Ratings(self.PATH))
         object.__setattr__(self, 'settings', Settings(self.PATH))
+        object.__setattr__(self, 'verified_contracts', VerifiedContracts(self.PATH))
+        object.__setattr__(self, 'cache', ContentCache(self.PATH))
 
         self._initialize_datafolder_tree()
         self._initialize_database(self.PATH)
@@ -114,13 +122,16 @@ class Database(object):
         conn = lite.connect(database_path)
         cursor = conn.cursor()
 
-        cursor.execute('''PRAGMA user_version = 1''')
+        cursor.execute('''PRAGMA user_version = 5''')
         cursor.execute('''CREATE TABLE hashmap(hash TEXT PRIMARY KEY, filepath TEXT)''')
 
         cursor.execute('''CREATE TABLE profile(id INTEGER PRIMARY KEY, serializedUserInfo BLOB, tempHandle TEXT)''')
 
         cursor.execute('''CREATE TABLE listings(id INTEGER PRIMARY KEY, serializedListings BLOB)''')
 
+        cursor.execute('''CREATE TABLE listing_index(contractHash BLOB PRIMARY KEY, serializedListing BLOB,
+    version INTEGER)''')
+
         cursor.execute('''CREATE TABLE keys(type TEXT PRIMARY KEY, privkey BLOB, pubkey BLOB)''')
 
         cursor.execute('''CREATE TABLE followers(id INTEGER PRIMARY KEY, serializedFollowers BLOB)''')
@@ -166,6 +177,11 @@ class Database(object):
     country TEXT, language TEXT, timeZone TEXT, notifications INTEGER, shippingAddresses BLOB, blocked BLOB,
     termsConditions TEXT, refundPolicy TEXT, moderatorList BLOB, username TEXT, password TEXT)''')
 
+        cursor.execute('''CREATE TABLE verified_contracts(contractID TEXT PRIMARY KEY, digest BLOB, guid BLOB)''')
+
+        cursor.execute('''CREATE TABLE cache(name TEXT PRIMARY KEY, size INTEGER, lastUsed INTEGER)''')
+        cursor.execute('''CREATE INDEX index_cache_last_used ON cache(lastUsed);''')
+
         conn.commit()
         conn.close()
 
@@ -175,8 +191,16 @@ class Database(object):
         cursor.execute('''PRAGMA user_version''')
         version = cursor.fetchone()[0]
         conn.close()
-        if version == 0:
+        if version < 1:
             migration1.migrate(self.PATH)
+        if version < 2:
+            migration2.migrate(self.PATH)
+        if version < 3:
+            migration3.migrate(self.PATH)
+        if version < 4:
+            migration4.migrate(self.PATH)
+        if version < 5:
+            migration5.migrate(self.PATH)
 
 
 class HashMap(object):
@@ -185,10 +209,15 @@ class HashMap(object):
     over the wire in a query) with a more human readable filename in local
     storage. This is useful for users who want to look through their store
     data on disk.
+
+    The whole map is kept in memory after the first lookup, along with the contents of
+    recently read files.
     """
 
     def __init__(self, database_path):
         self.PATH = database_path
+        self.index = None
+        self.files = LRUCache(FILE_CACHE_SIZE, len)
 
     def insert(self, hash_value, filepath):
         conn = Database.connect_database(self.PATH)
@@ -198,16 +227,29 @@ class HashMap(object):
                           VALUES (?,?)''', (hash_value, filepath))
             conn.commit()
         conn.close()
+        if self.index is not None:
+            self.index[hash_value] = filepath
+        self.files.pop(hash_value)
 
     def get_file(self, hash_value):
-        conn = Database.connect_database(self.PATH)
-        cursor = conn.cursor()
-        cursor.execute('''SELECT filepath FROM hashmap WHERE hash=?''', (hash_value,))
-        ret = cursor.fetchone()
-        conn.close()
-        if ret is None:
-            return None
-        return ret[0]
+        if self.index is None:
+            self.index = dict(self.get_all())
+        return self.index.get(hash_value)
+
+    def read(self, hash_value):
+        """
+        Returns the contents of the file with this hash or None if we don't have it.
+        """
+        data = self.files.get(hash_value)
+        if data is None:
+            path = self.get_file(hash_value)
+            if path is None or not os.path.isfile(path):
+                return None
+            with open(path, "rb") as f:
+                data = f.read()
+            if len(data) <= MAX_CACHED_FILE:
+                self.files[hash_value] = data
+        return data
 
     def get_all(self):
         conn = Database.connect_database(self.PATH)
@@ -224,6 +266,9 @@ class HashMap(object):
             cursor.execute('''DELETE FROM hashmap WHERE hash = ?''', (hash_value,))
             conn.commit()
         conn.close()
+        if self.index is not None:
+            self.index.pop(hash_value, None)
+        self.files.pop(hash_value)
 
     def delete_all(self):
         conn = Database.connect_database(self.PATH)
@@ -232,9 +277,157 @@ class HashMap(object):
             cursor.execute('''DELETE FROM hashmap''')
             conn.commit()
         conn.close()
+        self.index = {}
+        self.files.clear()
+
+
+def cache_path(name, folder=None):
+    """
+    Returns where a file named `name` is kept in the cache folder. Files are split between
+    subfolders by the first two characters of their (hex) name.
+    """
+    return join(folder or join(DATA_FOLDER, "cache"), name[:2], name)
+
+
+class ContentCache(object):
+    """
+    Keeps the contracts, images and profiles fetched from other nodes on disk. The size
+    and last use of each file is tracked in the db and the least recently used files
+    are removed when the total goes over CACHE_SIZE. The list of files is kept in
+    memory, so checking whether something is cached never touches the filesystem.
+    """
+
+    # Only write a file's last use to the db if it has changed by at least this much.
+    TOUCH_INTERVAL = 3600
+
+    def __init__(self, database_path, size=CACHE_SIZE, folder=None):
+        self.PATH = database_path
+        self.size = size
+        self.folder = folder or join(DATA_FOLDER, "cache")
+        # name -> (size, last used)
+        self.index = None
+        self.used = 0
+
+    def save(self, name, data):
+        self._load_index()
+        path = cache_path(name, self.folder)
+        if not os.path.exists(os.path.dirname(path)):
+            os.makedirs(os.path.dirname(path))
+        with open(path, "wb") as outfile:
+            outfile.write(data)
+        now = int(time.time())
+        conn = Database.connect_database(self.PATH)
+        with conn:
+            cursor = conn.cursor()
+            cursor.execute('''INSERT OR REPLACE INTO cache(name, size, lastUsed) VALUES (?,?,?)''',
+                           (name, len(data), now))
+            conn.commit()
+        conn.close()
+        self.used += len(data) - self.index.get(name, (0, 0))[0]
+        self.index[name] = (len(data), now)
+        if self.used > self.size:
+            self._evict()
+
+    def get(self, name):
+        """
+        Returns the path of the cached file or None if it isn't cached.
+        """
+        self._load_index()
+        if name not in self.index:
+            return None
+        size, last_used = self.index[name]
+        now = int(time.time())
+        if now - last_used >= self.TOUCH_INTERVAL:
+            conn = Database.connect_database(self.PATH)
+            with conn:
+                cursor = conn.cursor()
+                cursor.execute('''UPDATE cache SET lastUsed=? WHERE name=?''', (now, name))
+                conn.commit()
+            conn.close()
+            self.index[name] = (size, now)
+        return cache_path(name, self.folder)
+
+    def read(self, name):
+        """
+        Returns the contents of the cached file or None if it isn't cached.
+        """
+        path = self.get(name)
+        if path is None:
+            return None
+        try:
+            with open(path, "rb") as f:
+                return f.read()
+        except IOError:
+            self.delete(name)
+            return None
+
+    def delete(self, name):
+        self._load_index()
+        conn = Database.connect_database(self.PATH)
+        with conn:
+            cursor = conn.cursor()
+            cursor.execute('''DELETE FROM cache WHERE name=?''', (name,))
+            conn.commit()
+        conn.close()
+        if name in self.index:
+            self.used -= self.index.pop(name)[0]
+        if os.path.isfile(cache_path(name, self.folder)):
+            os.remove(cache_path(name, self.folder))
+
+    def _evict(self):
+        # remove down to 90% of the limit so we aren't evicting on every save
+        target = self.size * 0.9
+        conn = Database.connect_database(self.PATH)
+        cursor = conn.cursor()
+        cursor.execute('''SELECT name, size FROM cache ORDER BY lastUsed''')
+        removed = []
+        for name, size in cursor:
+            if self.used <= target:
+                break
+            removed.append((name,))
+            self.used -= size
+            self.index.pop(name, None)
+            if os.path.isfile(cache_path(name, self.folder)):
+                os.remove(cache_path(name, self.folder))
+        cursor.executemany('''DELETE FROM cache WHERE name=?''', removed)
+        conn.commit()
+        conn.close()
+
+    def _load_index(self):
+        if self.index is None:
+            conn = Database.connect_database(self.PATH)
+            cursor = conn.cursor()
+            cursor.execute('''SELECT name, size, lastUsed FROM cache''')
+            self.index = {}
+            for name, size, last_used in cursor.fetchall():
+                self.index[name] = (size, last_used)
+                self.used += size
+            conn.close()
 
+    def __contains__(self, name):
+        self._load_index()
+        return name in self.index
 
-class ProfileStore(object):
+
+class ObservableStore(object):
+    """
+    A store whose contents are cached elsewhere. Each function registered with
+    `add_listener` is called with no arguments after every write.
+    """
+
+    def __init__(self, database_path):
+        self.PATH = database_path
+        self.listeners = []
+
+    def add_listener(self, listener):
+        self.listeners.append(listener)
+
+    def _changed(self):
+        for listener in self.listeners:
+            listener()
+
+
+class ProfileStore(ObservableStore):
     """
     Stores the user's profile data in the db. The profile is stored as a serialized
     Profile protobuf object. It's done this way because because protobuf is more
@@ -244,9 +437,6 @@ class ProfileStore(object):
     `market.profile` module and not this class directly.
     """
 
-    def __init__(self, database_path):
-        self.PATH = database_path
-
     def set_proto(self, proto):
         conn = Database.connect_database(self.PATH)
         with conn:
@@ -256,6 +446,7 @@ class ProfileStore(object):
                           VALUES (?,?,?)''', (1, proto, handle))
             conn.commit()
         conn.close()
+        self._changed()
 
     def get_proto(self):
         conn = Database.connect_database(self.PATH)
@@ -291,20 +482,33 @@ class ProfileStore(object):
             return ret[0]
 
 
-class ListingsStore(object):
+class ListingsStore(ObservableStore):
     """
     Stores a serialized `Listings` protobuf object. It contains metadata for all the
     contracts hosted by this store. We will send this in response to a GET_LISTING
     query. This should be updated each time a new contract is created.
+
+    Each `ListingMetadata` is also stored on its own, keyed by contract hash, so a single
+    listing can be looked up without parsing the whole `Listings` object. These are
+    kept in memory after the first lookup.
+
+    Every change is numbered with a catalog version that only ever goes up. Deleted
+    listings are kept as empty rows with the version they were deleted at, so other
+    nodes can ask for just the changes since the last version they saw.
     """
 
     def __init__(self, database_path):
-        self.PATH = database_path
+        ObservableStore.__init__(self, database_path)
+        # contract hash -> (serialized listing or None if deleted, version)
+        self.index = None
+        self.version = 0
 
     def add_listing(self, proto):
         """
         Will also update an existing listing if the contract hash is the same.
         """
+        self._load_index()
+        version = self.version + 1
         conn = Database.connect_database(self.PATH)
         with conn:
             cursor = conn.cursor()
@@ -318,10 +522,17 @@ class ListingsStore(object):
             l.listing.extend([proto])
             cursor.execute('''INSERT OR REPLACE INTO listings(id, serializedListings)
                           VALUES (?,?)''', (1, l.SerializeToString()))
+            cursor.execute('''INSERT OR REPLACE INTO listing_index(contractHash, serializedListing, version)
+                          VALUES (?,?,?)''', (proto.contract_hash, proto.SerializeToString(), version))
             conn.commit()
         conn.close()
+        self.index[proto.contract_hash] = (proto.SerializeToString(), version)
+        self.version = version
+        self._changed()
 
     def delete_listing(self, hash_value):
+        self._load_index()
+        version = self.version + 1
         conn = Database.connect_database(self.PATH)
         with conn:
             cursor = conn.cursor()
@@ -335,16 +546,31 @@ class ListingsStore(object):
                     l.listing.remove(listing)
             cursor.execute('''INSERT OR REPLACE INTO listings(id, serializedListings)
                           VALUES (?,?)''', (1, l.SerializeToString()))
+            cursor.execute('''UPDATE listing_index SET serializedListing=NULL, version=?
+                          WHERE contractHash=?''', (version, hash_value))
             conn.commit()
         conn.close()
+        if hash_value in self.index:
+            self.index[hash_value] = (None, version)
+            self.version = version
+        self._changed()
 
     def delete_all_listings(self):
+        self._load_index()
+        version = self.version + 1
         conn = Database.connect_database(self.PATH)
         with conn:
             cursor = conn.cursor()
             cursor.execute('''DELETE FROM listings''')
+            cursor.execute('''UPDATE listing_index SET serializedListing=NULL, version=?
+                          WHERE serializedListing IS NOT NULL''', (version,))
             conn.commit()
         conn.close()
+        for hash_value, (ser, _) in self.index.items():
+            if ser is not None:
+                self.index[hash_value] = (None, version)
+                self.version = version
+        self._changed()
 
     def get_proto(self):
         conn = Database.connect_database(self.PATH)
@@ -356,6 +582,43 @@ class ListingsStore(object):
             return None
         return ret[0]
 
+    def get_listing(self, hash_value):
+        """
+        Returns the serialized `ListingMetadata` for this contract hash or None.
+        """
+        self._load_index()
+        return self.index.get(hash_value, (None, 0))[0]
+
+    def get_version(self):
+        """
+        Returns the current catalog version. It is 0 if there have never been any listings.
+        """
+        self._load_index()
+        return self.version
+
+    def get_changes(self, since=0):
+        """
+        Returns a list of (contract hash, serialized `ListingMetadata`) for each listing
+        added, updated or deleted after catalog version `since`, oldest change first. The
+        metadata is None for deleted listings.
+        """
+        self._load_index()
+        changes = [(version, hash_value, ser) for hash_value, (ser, version) in self.index.items()
+                   if version > since]
+        changes.sort()
+        return [(hash_value, ser) for _, hash_value, ser in changes]
+
+    def _load_index(self):
+        if self.index is None:
+            conn = Database.connect_database(self.PATH)
+            cursor = conn.cursor()
+            cursor.execute('''SELECT contractHash, serializedListing, version FROM listing_index''')
+            self.index = {}
+            for hash_value, ser, version in cursor.fetchall():
+                self.index[hash_value] = (ser, version)
+                self.version = max(self.version, version)
+            conn.close()
+
 
 class KeyStore(object):
     """
@@ -394,15 +657,12 @@ class KeyStore(object):
         conn.close()
 
 
-class FollowData(object):
+class FollowData(ObservableStore):
     """
     A class for saving and retrieving follower and following data
     for this node.
     """
 
-    def __init__(self, database_path):
-        self.PATH = database_path
-
     def follow(self, proto):
         conn = Database.connect_database(self.PATH)
         with conn:
@@ -419,6 +679,7 @@ class FollowData(object):
                            (1, f.SerializeToString()))
             conn.commit()
         conn.close()
+        self._changed()
 
     def unfollow(self, guid):
         conn = Database.connect_database(self.PATH)
@@ -435,6 +696,7 @@ class FollowData(object):
                            (1, f.SerializeToString()))
             conn.commit()
         conn.close()
+        self._changed()
 
     def get_following(self):
         conn = Database.connect_database(self.PATH)
@@ -473,6 +735,7 @@ class FollowData(object):
                            (1, f.SerializeToString()))
             conn.commit()
         conn.close()
+        self._changed()
 
     def delete_follower(self, guid):
         conn = Database.connect_database(self.PATH)
@@ -489,6 +752,7 @@ class FollowData(object):
                            (1, f.SerializeToString()))
             conn.commit()
         conn.close()
+        self._changed()
 
     def get_followers(self):
         conn = Database.connect_database(self.PATH)
@@ -580,7 +844,7 @@ WHERE guid=? and messageType=?''', (g[0], "CHAT"))
             handle = ""
             if val[0] is not None:
                 try:
-                    with open(DATA_FOLDER + 'cache/' + g[0], "r") as filename:
+                    with open(cache_path(g[0]), "r") as filename:
                         profile = filename.read()
                     p = objects.Profile()
                     p.ParseFromString(profile)
@@ -1117,14 +1381,11 @@ buyer, vendor, validation, claim, status FROM cases ''')
         conn.close()
 
 
-class Ratings(object):
+class Ratings(ObservableStore):
     """
     Store ratings for each contract in the db.
     """
 
-    def __init__(self, database_path):
-        self.PATH = database_path
-
     def add_rating(self, listing_hash, rating):
         conn = Database.connect_database(self.PATH)
         with conn:
@@ -1134,6 +1395,7 @@ class Ratings(object):
                            (listing_hash, rating_id, rating))
             conn.commit()
         conn.close()
+        self._changed()
 
     def get_listing_ratings(self, listing_hash, starting_id=None):
         conn = Database.connect_database(self.PATH)
@@ -1223,3 +1485,42 @@ refundPolicy, moderatorList) VALUES (?,?,?,?,?,?,?,?,?,?,?,?)''',
         ret = cursor.fetchone()
         conn.close()
         return ret
+
+
+class VerifiedContracts(object):
+    """
+    Records the contracts in the cache folder whose signatures we have already checked,
+    along with the hash of the file and the guid of the vendor, so opening one again
+    doesn't mean verifying it again.
+    """
+
+    def __init__(self, database_path):
+        self.PATH = database_path
+
+    def add(self, contract_id, contract_digest, guid):
+        conn = Database.connect_database(self.PATH)
+        with conn:
+            cursor = conn.cursor()
+            cursor.execute('''INSERT OR REPLACE INTO verified_contracts(contractID, digest, guid)
+                          VALUES (?,?,?)''', (contract_id, contract_digest, guid))
+            conn.commit()
+        conn.close()
+
+    def get(self, contract_id):
+        """
+        Returns a tuple of (digest, guid) or None if the contract hasn't been verified.
+        """
+        conn = Database.connect_database(self.PATH)
+        cursor = conn.cursor()
+        cursor.execute('''SELECT digest, guid FROM verified_contracts WHERE contractID=?''', (contract_id,))
+        ret = cursor.fetchone()
+        conn.close()
+        return ret
+
+    def delete(self, contract_id):
+        conn = Database.connect_database(self.PATH)
+        with conn:
+            cursor = conn.cursor()
+            cursor.execute('''DELETE FROM verified_contracts WHERE contractID=?''', (contract_id,))
+            conn.commit()
+        conn.close()
@@ -0,0 +1,28 @@
+__author__ = 'chris'
+import sqlite3
+from protos.objects import Listings
+
+
+def migrate(database_path):
+    print "migrating to db version 2"
+    conn = sqlite3.connect(database_path)
+    conn.text_factory = str
+    cursor = conn.cursor()
+
+    # create the index of listing metadata by contract hash
+    cursor.execute('''CREATE TABLE listing_index(contractHash BLOB PRIMARY KEY, serializedListing BLOB)''')
+
+    # fill it from the existing listings
+    cursor.execute('''SELECT serializedListings FROM listings WHERE id = 1''')
+    ret = cursor.fetchone()
+    if ret is not None:
+        l = Listings()
+        l.ParseFromString(ret[0])
+        for listing in l.listing:
+            cursor.execute('''INSERT OR REPLACE INTO listing_index(contractHash, serializedListing)
+    VALUES (?,?)''', (listing.contract_hash, listing.SerializeToString()))
+
+    # update version
+    cursor.execute('''PRAGMA user_version = 2''')
+    conn.commit()
+    conn.close()
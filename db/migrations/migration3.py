@@ -0,0 +1,28 @@
+__author__ = 'chris'
+import sqlite3
+from protos.objects import Listings
+
+
+def migrate(database_path):
+    print "migrating to db version 3"
+    conn = sqlite3.connect(database_path)
+    conn.text_factory = str
+    cursor = conn.cursor()
+
+    # add the catalog version to the listing index
+    cursor.execute('''ALTER TABLE listing_index ADD COLUMN version INTEGER DEFAULT 0''')
+
+    # number the existing listings in the order they were added
+    cursor.execute('''SELECT serializedListings FROM listings WHERE id = 1''')
+    ret = cursor.fetchone()
+    if ret is not None:
+        l = Listings()
+        l.ParseFromString(ret[0])
+        for version, listing in enumerate(l.listing, 1):
+            cursor.execute('''UPDATE listing_index SET version=? WHERE contractHash=?''',
+                           (version, listing.contract_hash))
+
+    # update version
+    cursor.execute('''PRAGMA user_version = 3''')
+    conn.commit()
+    conn.close()
@@ -0,0 +1,17 @@
+__author__ = 'chris'
+import sqlite3
+
+
+def migrate(database_path):
+    print "migrating to db version 4"
+    conn = sqlite3.connect(database_path)
+    conn.text_factory = str
+    cursor = conn.cursor()
+
+    # create the table of contracts we have already verified
+    cursor.execute('''CREATE TABLE verified_contracts(contractID TEXT PRIMARY KEY, digest BLOB, guid BLOB)''')
+
+    # update version
+    cursor.execute('''PRAGMA user_version = 4''')
+    conn.commit()
+    conn.close()
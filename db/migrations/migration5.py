@@ -0,0 +1,36 @@
+__author__ = 'chris'
+import os
+import sqlite3
+import time
+from config import DATA_FOLDER
+from os.path import join
+
+
+def migrate(database_path):
+    print "migrating to db version 5"
+    conn = sqlite3.connect(database_path)
+    conn.text_factory = str
+    cursor = conn.cursor()
+
+    # create the table tracking the files in the cache folder
+    cursor.execute('''CREATE TABLE cache(name TEXT PRIMARY KEY, size INTEGER, lastUsed INTEGER)''')
+    cursor.execute('''CREATE INDEX index_cache_last_used ON cache(lastUsed);''')
+
+    # move the cached files into subfolders by the first two characters of their name
+    folder = join(DATA_FOLDER, "cache")
+    now = int(time.time())
+    if os.path.isdir(folder):
+        for name in os.listdir(folder):
+            path = join(folder, name)
+            if not os.path.isfile(path):
+                continue
+            if not os.path.isdir(join(folder, name[:2])):
+                os.makedirs(join(folder, name[:2]))
+            os.rename(path, join(folder, name[:2], name))
+            cursor.execute('''INSERT OR REPLACE INTO cache(name, size, lastUsed) VALUES (?,?,?)''',
+                           (name, os.path.getsize(join(folder, name[:2], name)), now))
+
+    # update version
+    cursor.execute('''PRAGMA user_version = 5''')
+    conn.commit()
+    conn.close()
@@ -1,7 +1,9 @@
 import os
+import shutil
+import tempfile
 import unittest
 
-from db.datastore import Database
+from db.datastore import Database, ContentCache
 from dht.utils import digest
 from protos.objects import Profile, Listings, Following, Metadata, Followers, Node, FULL_CONE
 from protos.countries import CountryCode
@@ -84,6 +86,18 @@ class DatastoreTest(unittest.TestCase):
         v = self.hm.get_file(self.test_hash)
         self.assertIsNone(v)
 
+    def test_hashmapRead(self):
+        with open("test.txt", "w") as f:
+            f.write(self.test_file)
+        self.addCleanup(os.remove, "test.txt")
+        self.assertIsNone(self.hm.read(self.test_hash))
+        self.hm.insert(self.test_hash, "test.txt")
+        self.assertEqual(self.hm.read(self.test_hash), self.test_file)
+        self.assertIn(self.test_hash, self.hm.files)
+        self.hm.delete(self.test_hash)
+        self.assertNotIn(self.test_hash, self.hm.files)
+        self.assertIsNone(self.hm.read(self.test_hash))
+
     def test_hashmapGetEmpty(self):
         f = self.hm.get_file('87e0555568bf5c7e4debd6645fc3f41e88df6ca9')
         self.assertEqual(f, None)
@@ -133,6 +147,40 @@ class DatastoreTest(unittest.TestCase):
         self.ls.delete_all_listings()
         self.assertEqual(None, self.ls.delete_listing(self.test_hash))
 
+    def test_getListing(self):
+        self.ls.delete_all_listings()
+        self.assertIsNone(self.ls.get_listing(self.test_hash))
+        self.ls.add_listing(self.lm)
+        self.assertEqual(self.lm.SerializeToString(), self.ls.get_listing(self.test_hash))
+
+        # a fresh store has to load the index from the db
+        db = Database(filepath="test.db")
+        self.assertEqual(self.lm.SerializeToString(), db.listings.get_listing(self.test_hash))
+
+        self.ls.delete_listing(self.test_hash)
+        self.assertIsNone(self.ls.get_listing(self.test_hash))
+
+    def test_getChanges(self):
+        self.ls.delete_all_listings()
+        start = self.ls.get_version()
+        self.ls.add_listing(self.lm)
+        lm2 = Listings.ListingMetadata()
+        lm2.contract_hash = self.test_hash2
+        self.ls.add_listing(lm2)
+        self.assertEqual(self.ls.get_version(), start + 2)
+        self.assertEqual(self.ls.get_changes(start), [(self.test_hash, self.lm.SerializeToString()),
+                                                      (self.test_hash2, lm2.SerializeToString())])
+
+        self.ls.delete_listing(self.test_hash)
+        self.assertEqual(self.ls.get_changes(start + 2), [(self.test_hash, None)])
+        self.assertIsNone(self.ls.get_listing(self.test_hash))
+
+        # the version carries on from where it was after a restart
+        db = Database(filepath="test.db")
+        self.assertEqual(db.listings.get_version(), start + 3)
+        self.assertEqual(db.listings.get_changes(start + 1), [(self.test_hash2, lm2.SerializeToString()),
+                                                              (self.test_hash, None)])
+
     def test_setGUIDKey(self):
         self.ks.set_key("guid", "privkey", "signed_privkey")
         key = self.ks.get_key("guid")
@@ -346,3 +394,33 @@ class DatastoreTest(unittest.TestCase):
 
 
 
+
+    def test_verifiedContracts(self):
+        vc = self.db.verified_contracts
+        self.assertIsNone(vc.get(self.test_hash))
+        vc.add(self.test_hash, digest(self.test_file), self.u.guid)
+        self.assertEqual(vc.get(self.test_hash), (digest(self.test_file), self.u.guid))
+        vc.delete(self.test_hash)
+        self.assertIsNone(vc.get(self.test_hash))
+
+    def test_contentCache(self):
+        folder = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, folder)
+        cache = ContentCache(self.db.PATH, size=10, folder=folder)
+        cache.save("aa01", "12345")
+        self.assertIn("aa01", cache)
+        self.assertTrue(os.path.isfile(os.path.join(folder, "aa", "aa01")))
+        self.assertEqual(cache.read("aa01"), "12345")
+        cache.save("bb01", "1234")
+        cache.save("cc01", "123")
+        self.assertNotIn("aa01", cache)
+        self.assertIsNone(cache.get("aa01"))
+        self.assertFalse(os.path.isfile(os.path.join(folder, "aa", "aa01")))
+        self.assertEqual(cache.used, 7)
+
+        # a fresh index is loaded from the db
+        cache = ContentCache(self.db.PATH, size=10, folder=folder)
+        self.assertEqual(cache.read("cc01"), "123")
+        self.assertEqual(cache.used, 7)
+        cache.delete("cc01")
+        self.assertIsNone(cache.read("cc01"))
@@ -5,15 +5,14 @@ Copyright (c) 2014 Brian Muller
 Copyright (c) 2015 OpenBazaar
 """
 
+import heapq
 import pickle
 import httplib
 import random
-from binascii import hexlify
 from twisted.internet.task import LoopingCall
 from twisted.internet import defer, reactor, task
 
 import nacl.signing
-import nacl.hash
 import nacl.encoding
 
 from seed import peers
@@ -24,6 +23,7 @@ from dht.storage import ForgetfulStorage
 from dht.node import Node
 from dht.crawling import ValueSpiderCrawl
 from dht.crawling import NodeSpiderCrawl
+from net.verification import check_guid
 
 from protos import objects
 
@@ -174,10 +174,7 @@ class Server(object):
                     n = objects.Node()
                     try:
                         n.ParseFromString(result[1][0])
-                        h = nacl.hash.sha512(n.publicKey)
-                        hash_pow = h[40:]
-                        if int(hash_pow[:6], 16) >= 50 or hexlify(n.guid) != h[:40]:
-                            raise Exception('Invalid GUID')
+                        check_guid(n.guid, n.publicKey)
                         node = Node(n.guid, addr[0], addr[1], n.publicKey,
                                     None if not n.HasField("relayAddress") else
                                     (n.relayAddress.ip, n.relayAddress.port),
@@ -352,6 +349,53 @@ class Server(object):
         spider = NodeSpiderCrawl(self.protocol, node_to_find, nearest, self.ksize, self.alpha)
         return spider.find().addCallback(check_for_node)
 
+    def resolve_many(self, guids):
+        """
+        Resolve a batch of guids at once. Nodes we are connected to or have in the routing
+        table are returned straight away. Each of the rest gets its own `NodeSpiderCrawl`, in
+        guid order and at most `alpha` at a time. The only thing the crawls share is a map of
+        the nodes found so far, which the closest nodes each crawl returns are added to. A
+        guid which turns up there is resolved without a crawl of its own, and the others
+        start from the closest nodes in it rather than just the routing table.
+
+        Returns a `dict` of guid -> `Deferred` which fires with the `Node` or None.
+
+        Args:
+            guids: a list of 20 byte guids.
+        """
+
+        seen = {}
+        for bucket in self.protocol.router.buckets:
+            for node in bucket.getNodes():
+                seen[node.id] = node
+        for connection in self.protocol.multiplexer.values():
+            if connection.handler.node is not None:
+                seen[connection.handler.node.id] = connection.handler.node
+
+        def learn(nodes):
+            for node in nodes:
+                seen.setdefault(node.id, node)
+
+        def crawl(guid):
+            if guid in seen:
+                return defer.succeed(seen[guid])
+            node_to_find = Node(guid)
+            nearest = self.protocol.router.findNeighbors(node_to_find)
+            nearest += heapq.nsmallest(self.ksize, seen.values(), key=node_to_find.distanceTo)
+            if len(nearest) == 0:
+                return defer.succeed(None)
+            spider = NodeSpiderCrawl(self.protocol, node_to_find, nearest, self.ksize, self.alpha)
+            return spider.find().addCallback(learn).addCallback(lambda _: seen.get(guid))
+
+        results = {}
+        semaphore = defer.DeferredSemaphore(self.alpha)
+        for guid in sorted(set(guids)):
+            if guid in seen:
+                results[guid] = defer.succeed(seen[guid])
+            else:
+                results[guid] = semaphore.run(crawl, guid)
+        return results
+
     def saveState(self, fname):
         """
         Save the state of this node (the alpha/ksize/id/immediate neighbors)
@@ -6,13 +6,13 @@ Copyright (c) 2015 OpenBazaar
 import random
 from twisted.internet import reactor
 from zope.interface import implements
-import nacl.signing
 
 from dht.node import Node
 from dht.routing import RoutingTable
 from dht.utils import digest
 from log import Logger
 from net.rpcudp import RPCProtocol
+from net.verification import verify_signature
 from interfaces import MessageProcessor
 from protos import objects
 from protos.message import PING, STUN, STORE, DELETE, FIND_NODE, FIND_VALUE, HOLE_PUNCH, INV, VALUES
@@ -30,7 +30,8 @@ class KademliaProtocol(RPCProtocol):
         self.db = database
         self.signing_key = signing_key
         self.log = Logger(system=self)
-        self.handled_commands = [PING, STUN, STORE, DELETE, FIND_NODE, FIND_VALUE, HOLE_PUNCH, INV, VALUES]
+        self.handled_commands = frozenset([PING, STUN, STORE, DELETE, FIND_NODE, FIND_VALUE,
+                                           HOLE_PUNCH, INV, VALUES])
         RPCProtocol.__init__(self, sourceNode, self.router)
 
     def connect_multiplexer(self, multiplexer):
@@ -68,28 +69,22 @@ class KademliaProtocol(RPCProtocol):
         if value is not None:
             # Try to delete a message from the dht
             if keyword == digest(sender.id):
-                try:
-                    verify_key = nacl.signing.VerifyKey(sender.pubkey)
-                    verify_key.verify(key, signature)
-                    self.storage.delete(keyword, key)
-                    return ["True"]
-                except Exception:
-                    return ["False"]
+                pubkey = sender.pubkey
             # Or try to delete a pointer
             else:
                 try:
                     node = objects.Node()
                     node.ParseFromString(value)
                     pubkey = node.publicKey
-                    try:
-                        verify_key = nacl.signing.VerifyKey(pubkey)
-                        verify_key.verify(key, signature)
-                        self.storage.delete(keyword, key)
-                        return ["True"]
-                    except Exception:
-                        return ["False"]
                 except Exception:
-                    pass
+                    return ["False"]
+
+            def delete(_):
+                self.storage.delete(keyword, key)
+                return ["True"]
+
+            d = verify_signature(pubkey, key, signature)
+            return d.addCallback(delete).addErrback(lambda _: ["False"])
         return ["False"]
 
     def rpc_find_node(self, sender, key):
@@ -220,14 +215,17 @@ class KademliaProtocol(RPCProtocol):
     def handleCallResponse(self, result, node):
         """
         If we get a response, add the node to the routing table.  If
-        we get no response, make sure it's removed from the routing table.
+        we get no response and the connection has been closed, make sure it's
+        removed from the routing table. A request can fail on a short adaptive
+        timeout or because the node is rate limiting us without the node being
+        gone, in which case the connection is left open.
         """
         if result[0]:
             if self.isNewConnection(node):
                 self.log.debug("call response from new node, transferring key/values")
                 reactor.callLater(1, self.transferKeyValues, node)
             self.router.addContact(node)
-        else:
+        elif (node.ip, node.port) not in self.multiplexer:
             self.log.debug("no response from %s, removing from router" % node)
             self.router.removeContact(node)
         return result
@@ -252,3 +250,6 @@ class KademliaProtocol(RPCProtocol):
     def __iter__(self):
         return iter(self.handled_commands)
 
+    def __contains__(self, command):
+        return command in self.handled_commands
+
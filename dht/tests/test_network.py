@@ -0,0 +1,72 @@
+from twisted.trial import unittest
+from twisted.internet import defer
+
+from dht.network import Server
+from dht.node import Node
+from dht.routing import RoutingTable
+from dht.utils import digest
+from protos.objects import FULL_CONE
+
+
+class FakeConnection(object):
+    def __init__(self, node):
+        self.handler = self
+        self.node = node
+
+
+class FakeProtocol(object):
+    def __init__(self, node, nodes):
+        self.router = RoutingTable(self, 20, node)
+        self.multiplexer = {}
+        # every node the fake network answers FIND_NODE with
+        self.nodes = nodes
+        self.pending = []
+        self.crawled = set()
+
+    def callFindNode(self, node_to_ask, node_to_find):
+        d = defer.Deferred()
+        self.pending.append((d, node_to_find.id))
+        self.crawled.add(node_to_find.id)
+        return d
+
+    def respond(self):
+        # each response can start more requests so keep going until there are none
+        while self.pending:
+            d, _ = self.pending.pop(0)
+            d.callback((True, [n.getProto().SerializeToString() for n in self.nodes]))
+
+
+class ResolveManyTest(unittest.TestCase):
+    def setUp(self):
+        self.nodes = [Node(digest(str(i)), "127.0.0.1", 1000 + i, "pubkey", None, FULL_CONE) for i in range(8)]
+        self.neighbor = Node(digest("neighbor"), "127.0.0.1", 999, "pubkey", None, FULL_CONE)
+        self.protocol = FakeProtocol(Node(digest("us")), self.nodes + [self.neighbor])
+        # only the parts of the server resolve_many uses
+        self.server = Server.__new__(Server)
+        self.server.ksize = 20
+        self.server.alpha = 3
+        self.server.protocol = self.protocol
+
+    def test_resolve_many(self):
+        connected, known = self.nodes[:2]
+        self.protocol.multiplexer[(connected.ip, connected.port)] = FakeConnection(connected)
+        self.protocol.router.addContact(known)
+        self.protocol.router.addContact(self.neighbor)
+
+        guids = [n.id for n in self.nodes] + [connected.id]
+        resolved = self.server.resolve_many(guids)
+        self.assertEqual(len(resolved), len(self.nodes))
+
+        # nodes we are connected to or already know about are found straight away
+        self.assertEqual(self.successResultOf(resolved[connected.id]), connected)
+        self.assertEqual(self.successResultOf(resolved[known.id]), known)
+
+        # the rest are crawled for at most alpha at a time
+        self.assertEqual(len(set(guid for _, guid in self.protocol.pending)), 3)
+        self.assertFalse(resolved[max(n.id for n in self.nodes[2:])].called)
+
+        # and what the first crawls turn up answers the ones after them
+        self.protocol.respond()
+        for n in self.nodes[2:]:
+            self.assertEqual(self.successResultOf(resolved[n.id]).id, n.id)
+        self.assertEqual(len(self.protocol.crawled), 3)
@@ -7,6 +7,7 @@ import mock
 import nacl.signing
 import nacl.encoding
 import nacl.hash
+import nacl.public
 import os
 from txrudp import connection, rudp, packet, constants
 from twisted.trial import unittest
@@ -18,6 +19,10 @@ from dht.storage import ForgetfulStorage
 from dht.node import Node
 from protos import message, objects
 from net.wireprotocol import OpenBazaarProtocol
+from net.timerwheel import TimerWheel
+from net.sendqueue import SendQueue, BULK
+from net.session import Session
+from net import verification
 from db import datastore
 from config import PROTOCOL_VERSION
 
@@ -105,6 +110,340 @@ class KademliaProtocolTest(unittest.TestCase):
         self.assertEqual(received_message, expected_message)
         self.assertEqual(len(m_calls), 2)
 
+    def _ping_message(self, sealed=False):
+        m = message.Message()
+        m.messageID = digest(str(random.getrandbits(255)))
+        m.command = message.PING
+        m.protoVer = self.version
+        m.testnet = False
+        if sealed:
+            m.sender.guid = self.protocol.sourceNode.id
+            m.signature = self.handler.session.mac(m.SerializeToString())
+        else:
+            m.sender.MergeFrom(self.protocol.sourceNode.getProto())
+            m.signature = self.signing_key.sign(m.SerializeToString())[:64]
+        return m
+
+    def test_session_auth(self):
+        self._connecting_to_connected()
+        self.con.handler = self.handler
+        self.handler.on_connection_made()
+
+        self.assertIsNone(self.handler.session.key)
+        self.handler.receive_message(self._ping_message().SerializeToString())
+        self.assertIsNotNone(self.handler.session.key)
+
+        tampered = self._ping_message(sealed=True)
+        tampered.arguments.append("tampered")
+        self.assertFalse(self.handler.receive_message(tampered.SerializeToString()))
+        sealed = self._ping_message(sealed=True).SerializeToString()
+        self.assertTrue(len(sealed) < 166)
+        self.assertIsNot(self.handler.receive_message(sealed), False)
+
+        self.clock.advance(100 * constants.PACKET_TIMEOUT)
+        connection.REACTOR.runUntilCurrent()
+        responses = {}
+        for call in self.proto_mock.send_datagram.call_args_list:
+            sent_packet = packet.Packet.from_bytes(call[0][0])
+            if sent_packet.payload:
+                responses[sent_packet.sequence_number] = sent_packet.payload
+        self.assertEqual(len(responses), 2)
+        first, second = message.Message(), message.Message()
+        first.ParseFromString(responses[min(responses)])
+        second.ParseFromString(responses[max(responses)])
+        # the peer needs one signed message to learn our node, after that we can use the MAC
+        self.assertEqual(len(first.signature), 64)
+        self.assertEqual(first.sender, self.protocol.sourceNode.getProto())
+        self.assertEqual(len(second.signature), Session.MAC_SIZE)
+        self.assertEqual(second.sender.guid, self.protocol.sourceNode.id)
+        self.assertFalse(second.sender.HasField("nodeAddress"))
+
+    def test_session_auth_old_version(self):
+        self._connecting_to_connected()
+        self.version = 1
+        self.handler.on_connection_made()
+        self.handler.receive_message(self._ping_message().SerializeToString())
+        self.assertIsNone(self.handler.session.key)
+
+    def test_queue_while_verifying(self):
+        self._connecting_to_connected()
+        self.handler.on_connection_made()
+        d = defer.Deferred()
+        self.handler.verifying = d
+        self.handler.receive_message(self._ping_message().SerializeToString())
+        self.assertEqual(len(self.handler.queue), 1)
+        self.assertIsNone(self.handler.session.key)
+
+        d.addBoth(self.handler.process_queue)
+        d.callback(None)
+        self.assertEqual(len(self.handler.queue), 0)
+        self.assertIsNone(self.handler.verifying)
+        self.assertIsNotNone(self.handler.session.key)
+
+    def test_invalid_signature(self):
+        self._connecting_to_connected()
+        self.handler.on_connection_made()
+        m = self._ping_message()
+        m.signature = "a" * 64
+        self.handler.receive_message(m.SerializeToString())
+        self.assertIsNone(self.handler.verifying)
+        self.assertIsNone(self.handler.session.key)
+        self.assertIsNone(self.handler.node)
+        self.assertEqual(self.handler.time_last_message, 0)
+        self.clock.advance(100 * constants.PACKET_TIMEOUT)
+        connection.REACTOR.runUntilCurrent()
+        for call in self.proto_mock.send_datagram.call_args_list:
+            self.assertEqual(packet.Packet.from_bytes(call[0][0]).payload, "")
+
+    def test_identity_change(self):
+        self._connecting_to_connected()
+        self.handler.on_connection_made()
+        self.handler.receive_message(self._ping_message().SerializeToString())
+        self.assertEqual(self.handler.node.id, self.protocol.sourceNode.id)
+
+        # claiming an old version doesn't get another guid past the signature check
+        self.version = 1
+        m = self._ping_message()
+        m.sender.guid = digest("someone else")
+        self.handler.receive_message(m.SerializeToString())
+        self.assertEqual(self.handler.node.id, self.protocol.sourceNode.id)
+        self.assertIsNotNone(self.handler.session.key)
+        sealed = self._ping_message(sealed=True)
+        sealed.sender.guid = digest("someone else")
+        self.assertFalse(self.handler.receive_message(sealed.SerializeToString()))
+
+    def test_guid_cache(self):
+        guid = self.protocol.sourceNode.id
+        pubkey = self.signing_key.verify_key.encode()
+        with mock.patch("nacl.hash.sha512", wraps=nacl.hash.sha512) as sha512:
+            verification.check_guid(guid, pubkey)
+            verification.check_guid(guid, pubkey)
+            self.assertTrue(sha512.call_count <= 1)
+            self.assertRaises(Exception, verification.check_guid, digest("wrong"), pubkey)
+            self.assertRaises(Exception, verification.check_guid, digest("wrong"), pubkey)
+            self.assertTrue(sha512.call_count <= 2)
+
+    def test_dispatch_table(self):
+        self.assertTrue(message.PING in self.protocol)
+        self.assertFalse(message.GET_CONTRACT in self.protocol)
+        self.assertIs(self.wire_protocol.dispatch[message.PING], self.protocol)
+        self.assertEqual(set(self.wire_protocol.dispatch), set(self.protocol))
+        self.assertIs(self.handler.dispatch[message.STORE], self.protocol)
+        self.wire_protocol.unregister_processor(self.protocol)
+        self.assertEqual(self.wire_protocol.dispatch, {})
+
+    def test_replay_duplicate_request(self):
+        self._connecting_to_connected()
+        self.handler.on_connection_made()
+        m = message.Message()
+        m.messageID = digest("msgid")
+        m.sender.MergeFrom(self.protocol.sourceNode.getProto())
+        m.command = message.STORE
+        m.protoVer = self.version
+        m.testnet = False
+        m.arguments.extend([digest("Keyword"), "Key",
+                            self.protocol.sourceNode.getProto().SerializeToString(), str(10)])
+        m.signature = self.signing_key.sign(m.SerializeToString())[:64]
+        data = m.SerializeToString()
+
+        with mock.patch.object(self.protocol, "rpc_store", wraps=self.protocol.rpc_store) as rpc_store:
+            self.handler.receive_message(data)
+            self.handler.receive_message(data)
+            self.assertEqual(rpc_store.call_count, 1)
+
+        self.clock.advance(100 * constants.PACKET_TIMEOUT)
+        connection.REACTOR.runUntilCurrent()
+        responses = {}
+        for call in self.proto_mock.send_datagram.call_args_list:
+            sent_packet = packet.Packet.from_bytes(call[0][0])
+            if sent_packet.payload:
+                responses[sent_packet.sequence_number] = sent_packet.payload
+        self.assertEqual(len(responses), 2)
+        self.assertEqual(len(set(responses.values())), 1)
+
+    def test_rate_limit(self):
+        self._connecting_to_connected()
+        self.handler.on_connection_made()
+        for _ in range(5):
+            self.handler.receive_message(self._ping_message().SerializeToString())
+
+        self.clock.advance(100 * constants.PACKET_TIMEOUT)
+        connection.REACTOR.runUntilCurrent()
+        commands = []
+        for call in self.proto_mock.send_datagram.call_args_list:
+            sent_packet = packet.Packet.from_bytes(call[0][0])
+            if sent_packet.payload:
+                m = message.Message()
+                m.ParseFromString(sent_packet.payload)
+                commands.append(m.command)
+        self.assertEqual(commands, [message.PING] * 4 + [message.CALM_DOWN])
+
+    def test_rate_limit_ban(self):
+        limiter = self.wire_protocol.rate_limiter
+        same_ip = (self.addr1[0], self.addr1[1] + 1)
+        with mock.patch.dict(limiter.limits, {message.GET_LISTINGS: (3, 0)}):
+            for _ in range(3):
+                self.assertTrue(limiter.allow(self.addr1, message.GET_LISTINGS, ()))
+            self.assertFalse(limiter.allow(self.addr1, message.GET_LISTINGS, ()))
+            self.assertTrue(limiter.allow(self.addr2, message.GET_LISTINGS, ()))
+            # another node behind the same ip has its own bucket
+            self.assertTrue(limiter.allow(same_ip, message.GET_LISTINGS, ()))
+            for _ in range(3):
+                limiter.allow(self.addr1, message.GET_LISTINGS, ())
+        self.assertTrue(limiter.is_banned(self.addr1))
+        self.assertFalse(limiter.is_banned(same_ip))
+        self.assertFalse(self.addr1[0] in self.wire_protocol._banned_ips)
+        self.assertFalse(limiter.allow(self.addr1, message.PING, ()))
+        self.assertIsNone(self.wire_protocol.make_new_connection(self.own_addr, self.addr1))
+        # the buckets of addr2 and same_ip along with those of their ips
+        self.assertEqual(len(limiter), 4)
+
+    def test_rate_limit_ban_ip(self):
+        limiter = self.wire_protocol.rate_limiter
+        self.wire_protocol.make_new_connection(self.own_addr, self.addr2, outbound=True)
+        with mock.patch.dict(limiter.limits, {message.GET_LISTINGS: (3, 0)}):
+            # changing port gets a fresh bucket for the peer but not for its ip
+            for port in range(1000, 1020):
+                for _ in range(4):
+                    limiter.allow((self.addr2[0], port), message.GET_LISTINGS, ())
+        self.assertTrue(limiter.is_banned((self.addr2[0], 2000)))
+        self.assertFalse(limiter.is_banned(self.addr1))
+        self.assertFalse(self.addr2 in self.wire_protocol)
+        self.assertIsNone(self.wire_protocol.make_new_connection(self.own_addr, (self.addr2[0], 2000)))
+        self.assertIsNotNone(self.wire_protocol.make_new_connection(self.own_addr, self.addr1))
+
+    def test_acceptCalmDown(self):
+        self._connecting_to_connected()
+        n = Node(digest("S"), self.addr1[0], self.addr1[1])
+        self.protocol.router.addContact(n)
+        d = self.protocol.callPing(n)
+        msgID = self.protocol._outstanding.keys()[0]
+        m = message.Message()
+        m.messageID = msgID
+        m.sender.MergeFrom(self.protocol.sourceNode.getProto())
+        m.command = message.CALM_DOWN
+        m.protoVer = self.version
+        m.testnet = False
+        self.protocol.receive_message(m, n, self.con)
+        self.assertEqual(self.successResultOf(d), (False, None))
+        self.assertEqual(self.protocol._outstanding, {})
+        self.assertTrue(self.addr1 in self.wire_protocol)
+        # being rate limited doesn't mean the node is gone
+        self.assertFalse(self.protocol.router.isNewNode(n))
+
+    def test_calmDownThroughHandler(self):
+        self._connecting_to_connected()
+        self.handler.on_connection_made()
+        d = self.protocol.callPing(Node(digest("S"), self.addr1[0], self.addr1[1]))
+        m = self._ping_message()
+        m.messageID = self.protocol._outstanding.keys()[0]
+        m.command = message.CALM_DOWN
+        m.ClearField("signature")
+        m.signature = self.signing_key.sign(m.SerializeToString())[:64]
+        self.handler.receive_message(m.SerializeToString())
+        self.assertEqual(self.successResultOf(d), (False, None))
+        self.assertEqual(self.protocol._outstanding, {})
+
+    def test_compressed_response(self):
+        n = Node(digest("S"), self.addr1[0], self.addr1[1])
+        args = ["value %d " % i * 50 for i in range(10)]
+        with mock.patch.object(self.con, "send_message") as send_message:
+            self.protocol._sendResponse(args, "find_value", digest("msgid"), n, self.con, None, True)
+            self.protocol._sendResponse(args, "find_value", digest("msgid2"), n, self.con)
+        compressed, plain = message.Message(), message.Message()
+        compressed.ParseFromString(send_message.call_args_list[0][0][0])
+        plain.ParseFromString(send_message.call_args_list[1][0][0])
+        self.assertTrue(compressed.compressed)
+        self.assertFalse(plain.compressed)
+        self.assertTrue(compressed.ByteSize() < plain.ByteSize())
+
+        d = defer.Deferred()
+        self.protocol._outstanding[compressed.messageID] = [d, self.addr1, reactor.callLater(5, lambda: None),
+                                                            time.time(), message.FIND_VALUE]
+        self.protocol.receive_message(compressed, n, self.con)
+        self.assertEqual(self.successResultOf(d), (True, tuple(args)))
+
+    def test_connection_limit(self):
+        self.wire_protocol.max_connections = 2
+        addr3 = ('145.23.67.12', 28469)
+        addr4 = ('34.67.189.3', 28469)
+        addr5 = ('78.12.34.56', 28469)
+        con1 = self.wire_protocol.make_new_connection(self.own_addr, self.addr1, outbound=True)
+        con2 = self.wire_protocol.make_new_connection(self.own_addr, self.addr2, outbound=True)
+        con1.handler.verified = con2.handler.verified = True
+        con1.handler.time_last_message = time.time() + 1
+        n = Node(digest("id2"), self.addr2[0], self.addr2[1])
+        self.protocol.router.addContact(n)
+
+        # an incoming connection can't push out established ones
+        self.assertIsNone(self.wire_protocol.make_new_connection(self.own_addr, addr5))
+        self.assertEqual(len(self.wire_protocol), 2)
+
+        # the connection to addr2 is least recently used
+        self.wire_protocol.make_new_connection(self.own_addr, addr3, outbound=True)
+        self.assertEqual(len(self.wire_protocol), 2)
+        self.assertTrue(self.addr1 in self.wire_protocol)
+        self.assertFalse(self.addr2 in self.wire_protocol)
+        self.assertTrue(addr3 in self.wire_protocol)
+        self.assertTrue(self.protocol.router.isNewNode(n) is False)
+
+        # but one which hasn't authenticated itself yet goes first
+        self.wire_protocol.make_new_connection(self.own_addr, addr4)
+        self.assertTrue(self.addr1 in self.wire_protocol)
+        self.assertFalse(addr3 in self.wire_protocol)
+        self.assertTrue(addr4 in self.wire_protocol)
+        self.wire_protocol.make_new_connection(self.own_addr, addr5)
+        self.assertFalse(addr4 in self.wire_protocol)
+        self.assertTrue(addr5 in self.wire_protocol)
+
+        # and we never close one we are waiting on a response from
+        con3 = self.wire_protocol.make_new_connection(self.own_addr, addr3, outbound=True)
+        con3.handler.verified = True
+        with mock.patch.object(self.protocol, "has_outstanding_requests", lambda address: address == addr3):
+            self.wire_protocol.make_new_connection(self.own_addr, addr4, outbound=True)
+        self.assertFalse(self.addr1 in self.wire_protocol)
+        self.assertTrue(addr3 in self.wire_protocol)
+        self.assertTrue(addr4 in self.wire_protocol)
+
+    def test_keep_alive(self):
+        self._connecting_to_connected()
+        clock = task.Clock()
+        handler = self.wire_protocol.ConnHandler([self.protocol], objects.RESTRICTED, None,
+                                                 keep_alive_timers=TimerWheel(tick=1, clock=clock))
+        handler.connection = self.con
+        handler.node = Node(digest("id2"), self.addr1[0], self.addr1[1])
+        handler.on_connection_made()
+        self.assertTrue(handler.keep_alive_call.active())
+        self.assertTrue(handler.keep_alive_call.deadline <= 30)
+
+        with mock.patch.object(self.protocol, "callPing") as ping:
+            # recent traffic means no ping is needed
+            handler.time_last_message = time.time()
+            clock.advance(30)
+            self.assertEqual(ping.call_count, 0)
+            self.assertTrue(handler.keep_alive_call.active())
+
+            handler.time_last_message = time.time() - 60
+            clock.advance(34)
+            self.assertEqual(ping.call_count, 1)
+            self.assertTrue(handler.keep_alive_call.active())
+
+        call = handler.keep_alive_call
+        handler.handle_shutdown()
+        self.assertFalse(call.active())
+
+    def test_connection_made(self):
+        con = self.wire_protocol.make_new_connection(self.own_addr, self.addr1)
+        self.assertFalse(con.handler.connected)
+        self.assertIsNone(con.handler.keep_alive_call)
+
+        # the handler is told as soon as the handshake completes rather than polling for it
+        syn_packet = packet.Packet.from_data(42, self.own_addr, self.addr1, ack=0, syn=True,
+                                             payload=nacl.public.PrivateKey.generate().public_key.encode())
+        con.receive_packet(syn_packet, self.addr1)
+        self.assertTrue(con.handler.connected)
+        self.assertTrue(con.handler.keep_alive_call.active())
+
     def test_rpc_store(self):
         self._connecting_to_connected()
         self.protocol.router.addContact(self.protocol.sourceNode)
@@ -518,11 +857,97 @@ class KademliaProtocolTest(unittest.TestCase):
         message_id = digest("msgid")
         n = Node(digest("S"), self.addr1[0], self.addr1[1])
         d = defer.Deferred()
-        self.protocol._outstanding[message_id] = (d, self.addr1, reactor.callLater(5, handle_response))
+        self.protocol._outstanding[message_id] = (d, self.addr1, reactor.callLater(5, handle_response),
+                                                  time.time(), message.FIND_NODE)
         self.protocol._acceptResponse(message_id, ["test"], n)
+        self.assertTrue(self.addr1 in self.protocol.rtt)
 
         return d.addCallback(handle_response)
 
+    def test_acceptResponseBulkCommand(self):
+        self._connecting_to_connected()
+
+        message_id = digest("msgid")
+        n = Node(digest("S"), self.addr1[0], self.addr1[1])
+        d = defer.Deferred()
+        self.protocol._outstanding[message_id] = (d, self.addr1, reactor.callLater(5, lambda: None),
+                                                  time.time(), message.GET_IMAGE)
+        self.protocol._acceptResponse(message_id, ["test"], n)
+        self.assertFalse(self.addr1 in self.protocol.rtt)
+
+    def test_adaptiveTimeout(self):
+        rtt = self.protocol.rtt
+        self.assertEqual(rtt.get_timeout(self.addr1), rtt.max_timeout)
+        for _ in range(10):
+            rtt.add_sample(self.addr1, 0.1)
+        self.assertEqual(rtt.get_timeout(self.addr1), rtt.min_timeout)
+        for _ in range(10):
+            rtt.add_sample(self.addr2, 100)
+        self.assertEqual(rtt.get_timeout(self.addr2), rtt.max_timeout)
+        self.assertEqual(rtt.get_timeout(self.addr1), rtt.min_timeout)
+
+    def test_adaptiveTimeoutExpires(self):
+        clock = task.Clock()
+        self.protocol._timers = TimerWheel(clock=clock)
+        self.protocol.timeout = mock.Mock()
+        self.wire_protocol[self.addr1] = self.con
+        self.con.handler = self.handler
+        n = Node(digest("S"), self.addr1[0], self.addr1[1])
+        for _ in range(10):
+            self.protocol.rtt.add_sample(self.addr1, 2)
+        before = self.protocol.rtt.get_timeout(self.addr1)
+
+        d = defer.Deferred()
+        for msgID in ("first", "second"):
+            self.protocol._outstanding[msgID] = [d if msgID == "first" else defer.Deferred(), self.addr1,
+                                                 self.protocol._timers.schedule(15, lambda: None),
+                                                 time.time(), message.FIND_NODE]
+        self.protocol._peer_requests[self.addr1] = set(["first", "second"])
+        self.protocol._expire("first", n, before)
+
+        # only the request which timed out fails and the connection is left alone
+        self.assertEqual(self.successResultOf(d), (False, None))
+        self.assertEqual(self.protocol._peer_requests[self.addr1], set(["second"]))
+        self.assertGreater(self.protocol.rtt.get_timeout(self.addr1), before)
+        self.assertFalse(self.protocol.timeout.called)
+
+        # but it is closed if we haven't heard from the peer by the end of the full timeout
+        clock.advance(15)
+        self.protocol.timeout.assert_called_once_with(n)
+
+        self.protocol.timeout.reset_mock()
+        self.protocol._expire("second", n, before)
+        self.handler.time_last_message = time.time() + 1
+        clock.advance(15)
+        self.assertFalse(self.protocol.timeout.called)
+
+    def test_lateResponseAfterExpire(self):
+        clock = task.Clock()
+        self.protocol._timers = TimerWheel(clock=clock)
+        self.protocol.timeout = mock.Mock()
+        n = Node(digest("S"), self.addr1[0], self.addr1[1])
+        d = defer.Deferred()
+        self.protocol._outstanding["msgID"] = [d, self.addr1, None, time.time(), message.FIND_NODE]
+        self.protocol._peer_requests[self.addr1] = set(["msgID"])
+        self.protocol._expire("msgID", n, 1)
+        self.assertEqual(self.successResultOf(d), (False, None))
+
+        m = message.Message()
+        m.messageID = "msgID"
+        m.sender.MergeFrom(self.protocol.sourceNode.getProto())
+        m.command = message.FIND_NODE
+        m.protoVer = self.version
+        m.testnet = False
+        m.arguments.append(self.protocol.sourceNode.getProto().SerializeToString())
+        # the response arriving late isn't handled as a request of its own
+        with mock.patch.object(self.protocol, "_acceptRequest") as accept_request:
+            self.protocol.receive_message(m, n, self.con)
+            self.assertFalse(accept_request.called)
+            clock.advance(15)
+            self.assertNotIn("msgID", self.protocol._expired)
+            self.protocol.receive_message(m, n, self.con)
+            self.assertTrue(accept_request.called)
+
     def test_unknownRPC(self):
         self.assertFalse(self.handler.receive_message(str(random.getrandbits(1400))))
 
@@ -534,9 +959,98 @@ class KademliaProtocolTest(unittest.TestCase):
 
         n = Node(digest("S"), self.addr1[0], self.addr1[1])
         d = defer.Deferred().addCallback(handle_response, n)
-        self.protocol._outstanding["msgID"] = [d, self.addr1, reactor.callLater(5, handle_response)]
+        self.protocol._outstanding["msgID"] = [d, self.addr1, reactor.callLater(5, handle_response),
+                                               time.time(), message.FIND_NODE]
+        self.protocol._peer_requests[self.addr1] = set(["msgID"])
+        self.protocol.rtt.add_sample(self.addr1, 0.1)
         self.protocol.router.addContact(n)
         self.protocol.timeout(n)
+        self.assertFalse(self.addr1 in self.protocol.rtt)
+        self.assertFalse("msgID" in self.protocol._outstanding)
+        self.assertFalse(self.addr1 in self.protocol._peer_requests)
+
+    def test_timerWheel(self):
+        fired = []
+        clock = task.Clock()
+        wheel = TimerWheel(tick=0.1, slots=8, clock=clock)
+        wheel.schedule(0.5, fired.append, "a")
+        b = wheel.schedule(0.5, fired.append, "b")
+        wheel.schedule(2, fired.append, "c")
+        b.cancel()
+        self.assertFalse(b.active())
+        clock.advance(0.6)
+        self.assertEqual(fired, ["a"])
+        # the wheel only has 0.8 seconds of slots so "c" goes around more than once
+        clock.advance(1)
+        self.assertEqual(fired, ["a"])
+        clock.advance(0.5)
+        self.assertEqual(fired, ["a", "c"])
+        self.assertEqual(len(wheel), 0)
+        self.assertEqual(clock.getDelayedCalls(), [])
+        wheel.schedule(0.1, fired.append, "d")
+        clock.advance(0.2)
+        self.assertEqual(fired, ["a", "c", "d"])
+
+    def test_sendQueue(self):
+        sent = []
+        clock = task.Clock()
+        queue = SendQueue(rate=1000, peer_rate=300, clock=clock)
+        self.successResultOf(queue.enqueue(self.addr1, "a" * 400, sent.append))
+        # addr1 is over its rate now but other peers aren't held up by it
+        d1 = queue.enqueue(self.addr1, "b" * 100, sent.append, BULK)
+        d2 = queue.enqueue(self.addr1, "c" * 100, sent.append)
+        self.successResultOf(queue.enqueue(self.addr2, "d" * 100, sent.append, BULK))
+        self.assertEqual(sent, ["a" * 400, "d" * 100])
+        self.assertFalse(d1.called or d2.called)
+        self.assertEqual(len(queue), 2)
+
+        # interactive messages go ahead of bulk ones
+        clock.advance(1)
+        self.assertEqual(sent[2:], ["c" * 100, "b" * 100])
+        self.successResultOf(d1)
+        self.successResultOf(d2)
+
+        d3 = queue.enqueue(self.addr1, "e", sent.append)
+        self.assertFalse(d3.called)
+        queue.remove(self.addr1)
+        self.failureResultOf(d3)
+        self.assertEqual(len(queue), 0)
+        clock.advance(1)
+        self.assertEqual(len(sent), 4)
+
+    def test_sendQueueBuildsDataWhenSent(self):
+        sent = []
+        built = []
+        clock = task.Clock()
+        queue = SendQueue(rate=1000, peer_rate=300, clock=clock)
+
+        def build(name):
+            built.append(name)
+            return name * 100
+
+        queue.enqueue(self.addr1, "a" * 400, sent.append)
+        queue.enqueue(self.addr1, lambda: build("b"), sent.append, BULK)
+        queue.enqueue(self.addr1, lambda: build("c"), sent.append)
+        self.assertEqual(built, [])
+
+        # messages are built in the order they actually go out
+        clock.advance(1)
+        self.assertEqual(built, ["c", "b"])
+        self.assertEqual(sent[1:], ["c" * 100, "b" * 100])
+
+    def test_timeoutStartsWhenSent(self):
+        self._connecting_to_connected()
+        self.wire_protocol[self.addr1] = self.con
+        clock = task.Clock()
+        self.wire_protocol.send_queue = SendQueue(rate=1000, peer_rate=300, clock=clock)
+        self.wire_protocol.send_queue.enqueue(self.addr1, "a" * 400, lambda data: None)
+
+        self.protocol.callPing(Node(digest("S"), self.addr1[0], self.addr1[1]))
+        entry = self.protocol._outstanding.values()[0]
+        self.assertIsNone(entry[2])
+        clock.advance(1)
+        self.assertTrue(entry[2].active())
+        entry[2].cancel()
 
     def test_transferKeyValues(self):
         self._connecting_to_connected()
@@ -3,7 +3,7 @@ import hashlib
 from twisted.trial import unittest
 from twisted.internet import defer
 
-from dht.utils import digest, sharedPrefix, OrderedSet, deferredDict
+from dht.utils import digest, sharedPrefix, OrderedSet, deferredDict, LRUCache
 
 
 class UtilsTest(unittest.TestCase):
@@ -56,3 +56,32 @@ class OrderedSetTest(unittest.TestCase):
         o.push('2')
         o.push('1')
         self.assertEqual(o, ['2', '1'])
+
+
+class LRUCacheTest(unittest.TestCase):
+    def test_eviction(self):
+        c = LRUCache(2)
+        c["a"] = 1
+        c["b"] = 2
+        self.assertEqual(c.get("a"), 1)
+        c["c"] = 3
+        self.assertEqual(len(c), 2)
+        self.assertTrue("a" in c)
+        self.assertFalse("b" in c)
+        self.assertEqual(c.get("b", "missing"), "missing")
+        self.assertEqual(c.pop("a"), 1)
+        self.assertFalse("a" in c)
+
+    def test_sizeof(self):
+        c = LRUCache(10, len)
+        c["a"] = "12345"
+        c["b"] = "1234"
+        self.assertEqual(c.used, 9)
+        c["c"] = "12"
+        self.assertFalse("a" in c)
+        self.assertEqual(c.used, 6)
+        c["b"] = "1"
+        self.assertEqual(c.used, 3)
+        c["d"] = "12345678901"
+        self.assertEqual(len(c), 0)
+        self.assertEqual(c.used, 0)
@@ -5,6 +5,7 @@ Copyright (c) 2014 Brian Muller
 """
 import hashlib
 import operator
+from collections import OrderedDict
 
 from twisted.internet import defer
 
@@ -57,6 +58,57 @@ class OrderedSet(list):
         self.append(thing)
 
 
+class LRUCache(object):
+    """
+    A :class:`dict` like container which holds at most `size` items. Reading or writing
+    a key marks it as the most recently used and the least recently used item is
+    dropped when the cache is full.
+    """
+
+    def __init__(self, size, sizeof=None):
+        """
+        Args:
+            size: the most items to hold or, if `sizeof` is given, the largest total size.
+            sizeof: a function returning the size of a value, such as `len`.
+        """
+        self.size = size
+        self.sizeof = sizeof if sizeof is not None else (lambda value: 1)
+        self.used = 0
+        self._data = OrderedDict()
+
+    def get(self, key, default=None):
+        try:
+            value = self._data.pop(key)
+        except KeyError:
+            return default
+        self._data[key] = value
+        return value
+
+    def pop(self, key, default=None):
+        if key not in self._data:
+            return default
+        value = self._data.pop(key)
+        self.used -= self.sizeof(value)
+        return value
+
+    def clear(self):
+        self._data.clear()
+        self.used = 0
+
+    def __setitem__(self, key, value):
+        self.pop(key)
+        self._data[key] = value
+        self.used += self.sizeof(value)
+        while self.used > self.size:
+            self.used -= self.sizeof(self._data.popitem(last=False)[1])
+
+    def __contains__(self, key):
+        return key in self._data
+
+    def __len__(self):
+        return len(self._data)
+
+
 def sharedPrefix(args):
     """
     Find the shared prefix between the strings.
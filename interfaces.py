@@ -32,7 +32,7 @@ class Multiplexer(Interface):
         Set the ws and blockchain attributes.
         """
 
-    def send_message(datagram, address, relay_addr):
+    def send_message(datagram, address, relay_addr, priority):
         """
         Send a message over the wire to the given address
 
@@ -40,6 +40,7 @@ class Multiplexer(Interface):
             datagram: the serialized message to send
             address: the recipients address `tuple`
             relay_addr: a replay address `tuple` if used, otherwise None
+            priority: the `net.sendqueue` priority of the message
         """
 
     def __getitem__(addr):
@@ -121,6 +122,11 @@ class MessageProcessor(Interface):
         :return: iter([list of enums])
         """
 
+    def __contains__(command):
+        """
+        Return True if the given message type is handled by this processor.
+        """
+
 
 class BroadcastListener(Interface):
     """
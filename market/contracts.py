@@ -56,7 +56,7 @@ class Contract(object):
             try:
                 file_path = self.db.filemap.get_file(hash_value.encode("hex"))
                 if file_path is None:
-                    file_path = DATA_FOLDER + "cache/" + hash_value.encode("hex")
+                    file_path = self.db.cache.get(hash_value.encode("hex"))
                 with open(file_path, 'r') as filename:
                     self.contract = json.load(filename, object_pairs_hook=OrderedDict)
             except Exception:
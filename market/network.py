@@ -6,7 +6,6 @@ import gnupg
 import httplib
 import json
 import nacl.signing
-import nacl.hash
 import nacl.encoding
 import nacl.utils
 import obelisk
@@ -17,20 +16,29 @@ from binascii import unhexlify
 from collections import OrderedDict
 from config import DATA_FOLDER, TRANSACTION_FEE
 from dht.node import Node
-from dht.utils import digest
+from dht.utils import digest, LRUCache
 from keys.bip32utils import derive_childkey
 from keys.keychain import KeyChain
 from log import Logger
 from market.contracts import Contract
 from market.moderation import process_dispute, close_dispute
 from market.profile import Profile
-from market.protocol import MarketProtocol
+from market.protocol import MarketProtocol, UNCHANGED, CONDITIONAL_VERSION, CATALOG_VERSION, MAX_PAGE_SIZE, \
+    RELAY_VERSION, MAX_RELAY_FOLLOWERS
 from market.transactions import BitcoinTransaction
+from market.transfer import Download, MediaFetcher, CHUNK_VERSION, THUMBNAIL, FULL
+from net.verification import check_guid, check_signature
 from nacl.public import PrivateKey, PublicKey, Box
 from protos import objects
 from seed import peers
 from twisted.internet import defer, reactor, task
 
+# The most broadcast messages waiting on a response at once.
+MAX_BROADCASTS = 20
+
+# The number of followers each node hands a relayed broadcast on to.
+RELAY_FANOUT = 8
+
 
 class Server(object):
     def __init__(self, kserver, signing_key, database):
@@ -45,6 +53,17 @@ class Server(object):
         self.db = database
         self.log = Logger(system=self)
         self.protocol = MarketProtocol(kserver.node, self.router, signing_key, database)
+        self.protocol.forward_broadcast = self._relay_broadcast
+        # Chunked downloads by file hash. Ones which failed part way are kept so they
+        # can be resumed.
+        self.downloads = LRUCache(20)
+        self.media = MediaFetcher(self._get_image)
+        # The last verified profile, listings etc. fetched from each node along with the
+        # hash of the data, so we can ask the node whether it has changed since.
+        self.responses = LRUCache(500)
+        # Shared by every broadcast we send or relay so there are never more than
+        # MAX_BROADCASTS waiting on a response.
+        self.broadcasts = defer.DeferredSemaphore(MAX_BROADCASTS)
         task.LoopingCall(self.update_listings).start(3600, now=True)
 
     def querySeed(self, list_seed_pubkey):
@@ -81,6 +100,86 @@ class Server(object):
             except Exception, e:
                 self.log.error("failed to query seed: %s" % str(e))
 
+    def remote_version(self, node):
+        """
+        The protocol version of the node. We only know this for nodes we have an open
+        connection to, otherwise it is 0.
+        """
+        address = (node.ip, node.port)
+        multiplexer = self.protocol.multiplexer
+        if address not in multiplexer:
+            return 0
+        return getattr(multiplexer[address].handler, "remote_version", 0)
+
+    def supports_chunks(self, node):
+        """
+        Whether the node is known to understand GET_CHUNK.
+        """
+        return self.remote_version(node) >= CHUNK_VERSION
+
+    def _get_cached(self, node_to_ask, name, call, get_result):
+        """
+        Make a read request, sending the hash of our copy of the data if we have one so
+        the node can reply with just UNCHANGED. `get_result` is only called when new
+        data comes back and its result is kept for next time.
+
+        The node's protocol version is kept along with our copy, since we only know it
+        while there is an open connection and the next request will often need a new one.
+        """
+        key = (node_to_ask.id, name)
+        cached = self.responses.get(key)
+        if cached is not None and max(self.remote_version(node_to_ask), cached[2]) >= CONDITIONAL_VERSION:
+            d = call(node_to_ask, cached[0])
+        else:
+            cached = None
+            d = call(node_to_ask)
+
+        def handle_response(result):
+            if result[0] and result[1] is None:
+                # the node doesn't have it any more
+                self.responses.pop(key)
+                return None
+            if cached is not None and result[0] and result[1][0] == UNCHANGED:
+                try:
+                    verify_key = nacl.signing.VerifyKey(node_to_ask.pubkey)
+                    verify_key.verify(UNCHANGED + ":" + cached[0], result[1][1])
+                    return copy_proto(cached[1])
+                except Exception:
+                    return None
+            value = get_result(result)
+            if value is not None:
+                self.responses[key] = (digest(result[1][0]), copy_proto(value), self.remote_version(node_to_ask))
+            return value
+
+        return d.addCallback(handle_response)
+
+    def download(self, nodes, file_hash, verify=True):
+        """
+        Download a file in chunks from all of the given nodes. Returns a `Deferred` which
+        fires with the file or None. If a download of this file is already in progress the
+        nodes are added to it, and if an earlier attempt failed it is resumed.
+        """
+        download = self.downloads.get(file_hash)
+        if download is None:
+            download = Download(self.protocol, file_hash, verify)
+            self.downloads[file_hash] = download
+
+        def on_complete(data):
+            if data is not None:
+                self.downloads.pop(file_hash)
+            return data
+
+        return download.fetch(nodes).addCallback(on_complete)
+
+    def _fetch(self, nodes, file_hash, call, verify=True):
+        # Use a chunked download if any of the nodes support it and fall back to asking
+        # the first node for the whole file. Either way the result looks like an rpc response.
+        chunked = [node for node in nodes if self.supports_chunks(node)]
+        if len(chunked) == 0:
+            return call(nodes[0], file_hash)
+        d = self.download(chunked, file_hash, verify)
+        return d.addCallback(lambda data: (data is not None, [data]))
+
     def get_contract(self, node_to_ask, contract_id):
         """
         Will query the given node to fetch a contract given its hash.
@@ -123,39 +222,75 @@ class Server(object):
                             guid_key = moderator["pubkeys"]["guid"]
                             bitcoin_key = moderator["pubkeys"]["bitcoin"]["key"]
                             bitcoin_sig = base64.b64decode(moderator["pubkeys"]["bitcoin"]["signature"])
-                            h = nacl.hash.sha512(unhexlify(guid_key))
-                            pow_hash = h[40:]
-                            if int(pow_hash[:6], 16) >= 50 or guid != h[:40]:
-                                raise Exception('Invalid GUID')
-                            verify_key = nacl.signing.VerifyKey(guid_key, encoder=nacl.encoding.HexEncoder)
-                            verify_key.verify(unhexlify(bitcoin_key), bitcoin_sig)
+                            check_guid(unhexlify(guid), unhexlify(guid_key))
+                            check_signature(unhexlify(guid_key), unhexlify(bitcoin_key), bitcoin_sig)
                             #TODO: should probably also validate the handle here.
                     self.cache(result[1][0], id_in_contract)
-                    if "image_hashes" in contract["vendor_offer"]["listing"]["item"]:
-                        for image_hash in contract["vendor_offer"]["listing"]["item"]["image_hashes"]:
-                            self.get_image(node_to_ask, unhexlify(image_hash))
+                    self.db.verified_contracts.add(id_in_contract, digest(result[1][0]), node_to_ask.id)
+                    self._get_contract_images(node_to_ask, contract)
                     return contract
                 else:
                     return None
             except Exception:
                 return None
 
+        contract = self.get_verified_contract(node_to_ask.id, contract_id)
+        if contract is not None:
+            self._get_contract_images(node_to_ask, contract)
+            return defer.succeed(contract)
         if node_to_ask.ip is None:
             return defer.succeed(None)
         self.log.info("fetching contract %s from %s" % (contract_id.encode("hex"), node_to_ask))
-        d = self.protocol.callGetContract(node_to_ask, contract_id)
+        d = self._fetch([node_to_ask], contract_id, self.protocol.callGetContract, verify=False)
         return d.addCallback(get_result)
 
-    def get_image(self, node_to_ask, image_hash):
+    def _get_contract_images(self, node_to_ask, contract):
+        # the first image is the thumbnail
+        if "image_hashes" in contract["vendor_offer"]["listing"]["item"]:
+            for i, image_hash in enumerate(contract["vendor_offer"]["listing"]["item"]["image_hashes"]):
+                self.get_image(node_to_ask, unhexlify(image_hash), priority=THUMBNAIL if i == 0 else FULL)
+
+    def get_verified_contract(self, guid, contract_id):
+        """
+        Returns the contract from the cache if we have already verified that it was signed
+        by this guid, otherwise None. Contracts are addressed by hash so once one has
+        been checked it doesn't need checking again.
+        """
+        entry = self.db.verified_contracts.get(contract_id.encode("hex"))
+        if entry is None or entry[1] != guid:
+            return None
+        try:
+            data = self.db.cache.read(contract_id.encode("hex"))
+            if data is None or digest(data) != entry[0]:
+                return None
+            return json.loads(data, object_pairs_hook=OrderedDict)
+        except Exception:
+            return None
+
+    def get_image(self, node_to_ask, image_hash, other_nodes=(), priority=FULL):
         """
         Will query the given node to fetch an image given its hash.
         If the returned image doesn't have the same hash, it will return None.
 
+        Images already in the cache are returned straight away. Otherwise the request
+        joins the media queue, where any request for the same image already in flight
+        is shared.
+
         Args:
             node_to_ask: a `dht.node.Node` object containing an ip and port
             image_hash: a 20 byte hash in raw byte format
+            other_nodes: more nodes which have the image. Large images are
+                downloaded from all of them at once.
+            priority: `VISIBLE`, `THUMBNAIL` or `FULL` from `market.transfer`.
         """
+        if node_to_ask.ip is None or len(image_hash) != 20:
+            return defer.succeed(None)
+        image = self.db.cache.read(image_hash.encode("hex"))
+        if image is not None:
+            return defer.succeed(image)
+        return self.media.fetch(node_to_ask, image_hash, priority, other_nodes)
 
+    def _get_image(self, node_to_ask, image_hash, other_nodes):
         def get_result(result):
             try:
                 if result[0] and digest(result[1][0]) == image_hash:
@@ -166,10 +301,8 @@ class Server(object):
             except Exception:
                 return None
 
-        if node_to_ask.ip is None or len(image_hash) != 20:
-            return defer.succeed(None)
         self.log.info("fetching image %s from %s" % (image_hash.encode("hex"), node_to_ask))
-        d = self.protocol.callGetImage(node_to_ask, image_hash)
+        d = self._fetch([node_to_ask] + list(other_nodes), image_hash, self.protocol.callGetImage)
         return d.addCallback(get_result)
 
     def get_profile(self, node_to_ask):
@@ -190,9 +323,9 @@ class Server(object):
                     if not gpg.verify(p.pgp_key.signature) or \
                                     node_to_ask.id.encode('hex') not in p.pgp_key.signature:
                         p.ClearField("pgp_key")
-                if not os.path.isfile(DATA_FOLDER + 'cache/' + p.avatar_hash.encode("hex")):
-                    self.get_image(node_to_ask, p.avatar_hash)
-                if not os.path.isfile(DATA_FOLDER + 'cache/' + p.header_hash.encode("hex")):
+                if p.avatar_hash.encode("hex") not in self.db.cache:
+                    self.get_image(node_to_ask, p.avatar_hash, priority=THUMBNAIL)
+                if p.header_hash.encode("hex") not in self.db.cache:
                     self.get_image(node_to_ask, p.header_hash)
                 self.cache(result[1][0], node_to_ask.id.encode("hex"))
                 return p
@@ -202,8 +335,7 @@ class Server(object):
         if node_to_ask.ip is None:
             return defer.succeed(None)
         self.log.info("fetching profile from %s" % node_to_ask)
-        d = self.protocol.callGetProfile(node_to_ask)
-        return d.addCallback(get_result)
+        return self._get_cached(node_to_ask, "get_profile", self.protocol.callGetProfile, get_result)
 
     def get_user_metadata(self, node_to_ask):
         """
@@ -219,8 +351,8 @@ class Server(object):
                 verify_key.verify(result[1][0], result[1][1])
                 m = objects.Metadata()
                 m.ParseFromString(result[1][0])
-                if not os.path.isfile(DATA_FOLDER + 'cache/' + m.avatar_hash.encode("hex")):
-                    self.get_image(node_to_ask, m.avatar_hash)
+                if m.avatar_hash.encode("hex") not in self.db.cache:
+                    self.get_image(node_to_ask, m.avatar_hash, priority=THUMBNAIL)
                 return m
             except Exception:
                 return None
@@ -228,8 +360,7 @@ class Server(object):
         if node_to_ask.ip is None:
             return defer.succeed(None)
         self.log.info("fetching user metadata from %s" % node_to_ask)
-        d = self.protocol.callGetUserMetadata(node_to_ask)
-        return d.addCallback(get_result)
+        return self._get_cached(node_to_ask, "get_user_metadata", self.protocol.callGetUserMetadata, get_result)
 
     def get_listings(self, node_to_ask):
         """
@@ -251,7 +382,42 @@ class Server(object):
         if node_to_ask.ip is None:
             return defer.succeed(None)
         self.log.info("fetching store listings from %s" % node_to_ask)
-        d = self.protocol.callGetListings(node_to_ask)
+        return self._get_cached(node_to_ask, "get_listings", self.protocol.callGetListings, get_result)
+
+    def get_catalog(self, node_to_ask, since=0, start=0, count=MAX_PAGE_SIZE):
+        """
+        Fetch a page of a store's listings. If `since` is a catalog version from an earlier
+        call only the listings which changed after it are returned, along with the hashes
+        of those deleted. The `objects.Listings` returned also has the store's current
+        catalog version and the number of listings that could be paged through.
+
+        If the node doesn't support catalogs the full listings are downloaded and the
+        page taken from those. The version is then 0 and any `since` is ignored.
+        """
+
+        def get_result(result):
+            try:
+                verify_key = nacl.signing.VerifyKey(node_to_ask.pubkey)
+                verify_key.verify(result[1][0], result[1][1])
+                l = objects.Listings()
+                l.ParseFromString(result[1][0])
+                return l
+            except Exception:
+                return None
+
+        def get_page(l):
+            if l is not None:
+                l.total = len(l.listing)
+                del l.listing[start + count:]
+                del l.listing[:start]
+            return l
+
+        if node_to_ask.ip is None:
+            return defer.succeed(None)
+        if self.remote_version(node_to_ask) < CATALOG_VERSION:
+            return self.get_listings(node_to_ask).addCallback(get_page)
+        self.log.info("fetching store catalog from %s" % node_to_ask)
+        d = self.protocol.callGetCatalog(node_to_ask, since, start, count)
         return d.addCallback(get_result)
 
     def get_contract_metadata(self, node_to_ask, contract_hash):
@@ -268,8 +434,8 @@ class Server(object):
                 l = objects.Listings().ListingMetadata()
                 l.ParseFromString(result[1][0])
                 if l.thumbnail_hash != "":
-                    if not os.path.isfile(DATA_FOLDER + 'cache/' + l.thumbnail_hash.encode("hex")):
-                        self.get_image(node_to_ask, l.thumbnail_hash)
+                    if l.thumbnail_hash.encode("hex") not in self.db.cache:
+                        self.get_image(node_to_ask, l.thumbnail_hash, priority=THUMBNAIL)
                 return l
             except Exception:
                 return None
@@ -391,23 +557,18 @@ class Server(object):
             # Verify the signature and guid of each follower.
             for follower in f.followers:
                 try:
-                    v_key = nacl.signing.VerifyKey(follower.pubkey)
                     signature = follower.signature
                     follower.ClearField("signature")
-                    v_key.verify(follower.SerializeToString(), signature)
-                    h = nacl.hash.sha512(follower.pubkey)
-                    pow_hash = h[40:]
-                    if int(pow_hash[:6], 16) >= 50 or follower.guid.encode("hex") != h[:40]:
-                        raise Exception('Invalid GUID')
+                    check_signature(follower.pubkey, follower.SerializeToString(), signature)
+                    check_guid(follower.guid, follower.pubkey)
                     if follower.following != node_to_ask.id:
                         raise Exception('Invalid follower')
                 except Exception:
                     f.followers.remove(follower)
             return f
 
-        d = self.protocol.callGetFollowers(node_to_ask)
         self.log.info("fetching followers from %s" % node_to_ask)
-        return d.addCallback(get_response)
+        return self._get_cached(node_to_ask, "get_followers", self.protocol.callGetFollowers, get_response)
 
     def get_following(self, node_to_ask):
         """
@@ -429,13 +590,8 @@ class Server(object):
                 return None
             for user in f.users:
                 try:
-                    v_key = nacl.signing.VerifyKey(user.pubkey)
-                    signature = user.signature
-                    v_key.verify(user.metadata.SerializeToString(), signature)
-                    h = nacl.hash.sha512(user.pubkey)
-                    pow_hash = h[40:]
-                    if int(pow_hash[:6], 16) >= 50 or user.guid.encode("hex") != h[:40]:
-                        raise Exception('Invalid GUID')
+                    check_signature(user.pubkey, user.metadata.SerializeToString(), user.signature)
+                    check_guid(user.guid, user.pubkey)
                 except Exception:
                     f.users.remove(user)
             return f
@@ -444,37 +600,124 @@ class Server(object):
         self.log.info("fetching following list from %s" % node_to_ask)
         return d.addCallback(get_response)
 
-    def broadcast(self, message):
+    def broadcast(self, message, progress=None, relay=False):
         """
-        Sends a broadcast message to all online followers. It will resolve
-        each guid before sending the broadcast. Messages must be less than
-        140 characters. Returns the number of followers the broadcast reached.
+        Sends a broadcast message to all online followers. The followers are resolved as
+        one batch and the message goes out to each as soon as it's found, starting with the
+        ones we are already connected to, with at most MAX_BROADCASTS sends in flight.
+        Messages must be less than 140 characters. Returns the number of followers the
+        broadcast reached.
+
+        With `relay` the message is signed and timestamped as a `PlaintextMessage` and only
+        sent to a few followers which verify it and pass it on down a tree of the rest (see
+        `_relay_broadcast`). We can't see past the first level so the count is of the
+        followers it was handed on to rather than reached.
+
+        Args:
+            message: the message to broadcast.
+            progress: an optional callable which is passed the number of followers reached,
+                the number tried so far and the total after each one finishes. It isn't
+                called for relayed broadcasts.
+            relay: whether to relay the broadcast through the followers.
         """
 
         if len(message) > 140:
             return defer.succeed(0)
 
-        def send(nodes):
-            def how_many_reached(responses):
-                count = 0
-                for resp in responses:
-                    if resp[1][0] and resp[1][1][0] == "True":
-                        count += 1
-                return count
-
-            ds = []
-            signature = self.signing_key.sign(str(message))[:64]
-            for n in nodes:
-                if n[1] is not None:
-                    ds.append(self.protocol.callBroadcast(n[1], message, signature))
-            return defer.DeferredList(ds).addCallback(how_many_reached)
-        dl = []
         f = objects.Followers()
         f.ParseFromString(self.db.follow.get_followers())
-        for follower in f.followers:
-            dl.append(self.kserver.resolve(follower.guid))
-        self.log.info("broadcasting %s to followers" % message)
-        return defer.DeferredList(dl).addCallback(send)
+        signature = self.signing_key.sign(str(message))[:64]
+        guids = sorted(set(follower.guid for follower in f.followers))
+        self.log.info("broadcasting %s to %s followers" % (message, len(guids)))
+        if relay:
+            p = objects.PlaintextMessage()
+            p.sender_guid = self.kserver.node.id
+            p.pubkey = self.kserver.node.pubkey
+            p.type = objects.PlaintextMessage.BROADCAST
+            p.message = str(message)
+            p.timestamp = int(time.time())
+            p.signature = self.signing_key.sign(p.SerializeToString())[:64]
+            return self._relay_broadcast(p.SerializeToString(), guids)
+
+        resolved = self.kserver.resolve_many(guids)
+        status = {"reached": 0, "tried": 0}
+
+        def send(node):
+            if node is not None:
+                return self.broadcasts.run(self.protocol.callBroadcast, node, message, signature)
+
+        def sent(result):
+            status["tried"] += 1
+            if result is not None and result[0] and result[1][0] == "True":
+                status["reached"] += 1
+            if progress is not None:
+                progress(status["reached"], status["tried"], len(resolved))
+
+        def done(_):
+            self.log.info("broadcast reached %s of %s followers" % (status["reached"], len(resolved)))
+            return status["reached"]
+
+        ds = []
+        for d in resolved.values():
+            d.addCallback(send).addErrback(lambda failure: None).addCallback(sent)
+            ds.append(d)
+        return defer.DeferredList(ds).addCallback(done)
+
+    def _relay_broadcast(self, plaintext, followers):
+        """
+        Hands a signed broadcast `PlaintextMessage` on down the relay tree. The followers are
+        split into RELAY_FANOUT groups (more if a group would be over MAX_RELAY_FOLLOWERS) and
+        the first follower in each is sent the broadcast along with the rest of its group to
+        pass on, so every node only sends a handful of messages however many followers there
+        are.
+
+        If the first follower can't be reached or turns it down and the broadcast is our own
+        we split the rest of its group again and carry on ourselves. Relaying nodes just drop
+        the group, otherwise whoever sent us a list of made up guids could have us crawl for
+        every one of them. Followers running a version without RELAY_BROADCAST can only
+        accept a broadcast straight from the store so they are sent the plain one.
+
+        Returns a `Deferred` which fires with the number of followers it was handed on to.
+        """
+
+        p = objects.PlaintextMessage()
+        p.ParseFromString(plaintext)
+        ours = p.sender_guid == self.kserver.node.id
+        followers = sorted(set(followers) - set([self.kserver.node.id]))
+        if len(followers) == 0:
+            return defer.succeed(0)
+
+        size = min((len(followers) + RELAY_FANOUT - 1) // RELAY_FANOUT, MAX_RELAY_FOLLOWERS + 1)
+        groups = [followers[i:i + size] for i in range(0, len(followers), size)]
+        resolved = self.kserver.resolve_many([group[0] for group in groups])
+
+        def take_over(node, rest):
+            if not ours:
+                return 0
+            ds = [self._relay_broadcast(plaintext, rest)]
+            if node is not None and 0 < self.remote_version(node) < RELAY_VERSION:
+                signature = self.signing_key.sign(p.message)[:64]
+                d = self.broadcasts.run(self.protocol.callBroadcast, node, p.message, signature)
+                ds.append(d.addCallback(lambda result: 1 if result[0] and result[1][0] == "True" else 0))
+            return defer.gatherResults(ds).addCallback(sum)
+
+        def relay(node, group):
+            if node is None or 0 < self.remote_version(node) < RELAY_VERSION:
+                return take_over(node, group[1:])
+
+            def handed_on(result):
+                if result[0] and result[1][0] == "True":
+                    return len(group)
+                return take_over(node, group[1:])
+
+            d = self.broadcasts.run(self.protocol.callRelayBroadcast, node, plaintext, group[1:])
+            return d.addCallback(handed_on)
+
+        ds = []
+        for group in groups:
+            d = resolved[group[0]].addCallback(relay, group).addErrback(lambda failure: 0)
+            ds.append(d)
+        return defer.gatherResults(ds).addCallback(sum)
 
     def send_message(self, receiving_node, public_key, message_type, message, subject=None, store_only=False):
         """
@@ -534,12 +777,9 @@ class Server(object):
                             p.ParseFromString(plaintext)
                             signature = p.signature
                             p.ClearField("signature")
+                            check_guid(p.sender_guid, p.pubkey)
                             verify_key = nacl.signing.VerifyKey(p.pubkey)
                             verify_key.verify(p.SerializeToString(), signature)
-                            h = nacl.hash.sha512(p.pubkey)
-                            pow_hash = h[40:]
-                            if int(pow_hash[:6], 16) >= 50 or p.sender_guid.encode("hex") != h[:40]:
-                                raise Exception('Invalid guid')
                             if p.type == objects.PlaintextMessage.Type.Value("ORDER_CONFIRMATION"):
                                 c = Contract(self.db, hash_value=unhexlify(p.subject),
                                              testnet=self.protocol.multiplexer.testnet)
@@ -1111,10 +1351,14 @@ class Server(object):
         except Exception:
             pass
 
-    @staticmethod
-    def cache(file_to_save, filename):
+    def cache(self, file_to_save, filename):
         """
-        Saves the file to a cache folder override previous versions if any.
+        Saves the file to the cache, overriding previous versions if any.
         """
-        with open(DATA_FOLDER + "cache/" + filename, 'wb') as outfile:
-            outfile.write(file_to_save)
+        self.db.cache.save(filename, file_to_save)
+
+
+def copy_proto(proto):
+    c = proto.__class__()
+    c.CopyFrom(proto)
+    return c
@@ -1,28 +1,52 @@
 __author__ = 'chris'
 
 import json
-import nacl.signing
 import nacl.utils
 import nacl.encoding
-import nacl.hash
+import time
 from binascii import unhexlify
 from collections import OrderedDict
 from interfaces import MessageProcessor, BroadcastListener, MessageListener, NotificationListener
+from dht.utils import digest, LRUCache
 from keys.bip32utils import derive_childkey
 from log import Logger
 from market.contracts import Contract
 from market.moderation import process_dispute, close_dispute
 from market.profile import Profile
+from market.transfer import get_manifest, read_chunk
 from nacl.public import PublicKey, Box
 from net.rpcudp import RPCProtocol
+from net.verification import verify_signature, verify_identity
 from protos.message import GET_CONTRACT, GET_IMAGE, GET_PROFILE, GET_LISTINGS, GET_USER_METADATA,\
     GET_CONTRACT_METADATA, FOLLOW, UNFOLLOW, GET_FOLLOWERS, GET_FOLLOWING, BROADCAST, MESSAGE, ORDER, \
-    ORDER_CONFIRMATION, COMPLETE_ORDER, DISPUTE_OPEN, DISPUTE_CLOSE, GET_RATINGS, REFUND
+    ORDER_CONFIRMATION, COMPLETE_ORDER, DISPUTE_OPEN, DISPUTE_CLOSE, GET_RATINGS, REFUND, GET_CHUNK, GET_CATALOG, \
+    RELAY_BROADCAST
 from protos.objects import Metadata, Listings, Followers, PlaintextMessage
 from zope.interface import implements
 from zope.interface.exceptions import DoesNotImplement
 from zope.interface.verify import verifyObject
 
+# Sent in place of the data when the caller already has the latest copy.
+UNCHANGED = "unchanged"
+
+# The first protocol version which accepts the hash of a cached copy on read requests.
+CONDITIONAL_VERSION = 5
+
+# The first protocol version which understands GET_CATALOG.
+CATALOG_VERSION = 6
+
+# The most listings returned in a single GET_CATALOG response.
+MAX_PAGE_SIZE = 50
+
+# The first protocol version which understands RELAY_BROADCAST.
+RELAY_VERSION = 7
+
+# How many seconds a relayed broadcast is accepted for after the store signs it.
+RELAY_MAX_AGE = 600
+
+# The most followers a single RELAY_BROADCAST may hand on to.
+MAX_RELAY_FOLLOWERS = 10000
+
 
 class MarketProtocol(RPCProtocol):
     implements(MessageProcessor)
@@ -36,10 +60,20 @@ class MarketProtocol(RPCProtocol):
         self.db = database
         self.signing_key = signing_key
         self.listeners = []
-        self.handled_commands = [GET_CONTRACT, GET_IMAGE, GET_PROFILE, GET_LISTINGS, GET_USER_METADATA,
-                                 GET_CONTRACT_METADATA, FOLLOW, UNFOLLOW, GET_FOLLOWERS, GET_FOLLOWING,
-                                 BROADCAST, MESSAGE, ORDER, ORDER_CONFIRMATION, COMPLETE_ORDER, DISPUTE_OPEN,
-                                 DISPUTE_CLOSE, GET_RATINGS, REFUND]
+        self.handled_commands = frozenset([GET_CONTRACT, GET_IMAGE, GET_PROFILE, GET_LISTINGS, GET_USER_METADATA,
+                                           GET_CONTRACT_METADATA, FOLLOW, UNFOLLOW, GET_FOLLOWERS, GET_FOLLOWING,
+                                           BROADCAST, MESSAGE, ORDER, ORDER_CONFIRMATION, COMPLETE_ORDER,
+                                           DISPUTE_OPEN, DISPUTE_CLOSE, GET_RATINGS, REFUND, GET_CHUNK,
+                                           GET_CATALOG, RELAY_BROADCAST])
+        # signed responses to the read only rpcs, keyed by rpc name then argument
+        self.responses = {}
+        # the signatures of broadcasts we have already relayed. Older ones than
+        # RELAY_MAX_AGE are turned down anyway so they don't need to be kept.
+        self.relayed = LRUCache(1000)
+        # set by the market server to pass relayed broadcasts on down the tree
+        self.forward_broadcast = None
+        if database:
+            self._watch_database()
 
     def connect_multiplexer(self, multiplexer):
         self.multiplexer = multiplexer
@@ -47,12 +81,50 @@ class MarketProtocol(RPCProtocol):
     def add_listener(self, listener):
         self.listeners.append(listener)
 
+    def _watch_database(self):
+        def invalidate(*names):
+            def clear():
+                for name in names:
+                    self.responses.pop(name, None)
+            return clear
+
+        self.db.profile.add_listener(invalidate("get_profile", "get_user_metadata", "get_listings",
+                                                "get_contract_metadata", "get_catalog"))
+        self.db.listings.add_listener(invalidate("get_listings", "get_contract_metadata", "get_catalog"))
+        self.db.follow.add_listener(invalidate("get_followers", "get_following"))
+        self.db.ratings.add_listener(invalidate("get_ratings"))
+
+    def _signed_response(self, name, build, key=None, cached_hash=None):
+        """
+        Returns the data serialized by `build` and our signature over it. The result is
+        cached until the data in the database it was built from changes.
+
+        If `cached_hash` is the hash of the current data the caller already has it, so
+        just UNCHANGED and a signature over the hash is returned.
+        """
+        cache = self.responses.setdefault(name, LRUCache(100))
+        entry = cache.get(key)
+        if entry is None:
+            ser = build()
+            if ser is None:
+                return None
+            data_hash = digest(ser)
+            unchanged = UNCHANGED + ":" + data_hash
+            entry = ([ser, self.signing_key.sign(ser)[:64]],
+                     data_hash, [UNCHANGED, self.signing_key.sign(unchanged)[:64]])
+            cache[key] = entry
+        response, data_hash, unchanged = entry
+        if cached_hash == data_hash:
+            return list(unchanged)
+        return list(response)
+
     def rpc_get_contract(self, sender, contract_hash):
         self.log.info("serving contract %s to %s" % (contract_hash.encode('hex'), sender))
         self.router.addContact(sender)
         try:
-            with open(self.db.filemap.get_file(contract_hash.encode("hex")), "r") as filename:
-                contract = filename.read()
+            contract = self.db.filemap.read(contract_hash.encode("hex"))
+            if contract is None:
+                raise Exception("Contract not found")
             return [contract]
         except Exception:
             self.log.warning("could not find contract %s" % contract_hash.encode('hex'))
@@ -65,77 +137,137 @@ class MarketProtocol(RPCProtocol):
                 self.log.warning("Image hash is not 20 characters %s" % image_hash)
                 raise Exception("Invalid image hash")
             self.log.info("serving image %s to %s" % (image_hash.encode('hex'), sender))
-            with open(self.db.filemap.get_file(image_hash.encode("hex")), "rb") as filename:
-                image = filename.read()
+            image = self.db.filemap.read(image_hash.encode("hex"))
+            if image is None:
+                raise Exception("Image not found")
             return [image]
         except Exception:
             self.log.warning("could not find image %s" % image_hash[:20].encode('hex'))
             return None
 
-    def rpc_get_profile(self, sender):
+    def rpc_get_chunk(self, sender, file_hash, index=None):
+        """
+        Serve an image or contract in pieces. Without an index this returns the size of
+        the file and the hash of each chunk, otherwise the chunk itself.
+        """
+        self.router.addContact(sender)
+        try:
+            if len(file_hash) != 20:
+                raise Exception("Invalid file hash")
+            path = self.db.filemap.get_file(file_hash.encode("hex"))
+            if index is None:
+                size, hashes = get_manifest(path)
+                return [str(size), hashes]
+            return [read_chunk(path, int(index))]
+        except Exception:
+            self.log.warning("could not find file %s" % file_hash[:20].encode('hex'))
+            return None
+
+    def rpc_get_profile(self, sender, cached_hash=None):
         self.log.info("serving profile to %s" % sender)
         self.router.addContact(sender)
         try:
-            proto = Profile(self.db).get(True)
-            return [proto, self.signing_key.sign(proto)[:64]]
+            return self._signed_response("get_profile", lambda: Profile(self.db).get(True),
+                                         cached_hash=cached_hash)
         except Exception:
             self.log.error("unable to load the profile")
             return None
 
-    def rpc_get_user_metadata(self, sender):
+    def rpc_get_user_metadata(self, sender, cached_hash=None):
         self.log.info("serving user metadata to %s" % sender)
         self.router.addContact(sender)
         try:
-            proto = Profile(self.db).get(False)
-            m = Metadata()
-            m.name = proto.name
-            m.handle = proto.handle
-            m.short_description = proto.short_description
-            m.avatar_hash = proto.avatar_hash
-            m.nsfw = proto.nsfw
-            return [m.SerializeToString(), self.signing_key.sign(m.SerializeToString())[:64]]
+            return self._signed_response("get_user_metadata", self._build_metadata, cached_hash=cached_hash)
         except Exception:
             self.log.error("unable to load profile metadata")
             return None
 
-    def rpc_get_listings(self, sender):
+    def _build_metadata(self):
+        proto = Profile(self.db).get(False)
+        m = Metadata()
+        m.name = proto.name
+        m.handle = proto.handle
+        m.short_description = proto.short_description
+        m.avatar_hash = proto.avatar_hash
+        m.nsfw = proto.nsfw
+        return m.SerializeToString()
+
+    def rpc_get_listings(self, sender, cached_hash=None):
         self.log.info("serving store listings to %s" % sender)
         self.router.addContact(sender)
         try:
-            p = Profile(self.db).get()
-            l = Listings()
-            l.ParseFromString(self.db.listings.get_proto())
-            l.handle = p.handle
-            l.avatar_hash = p.avatar_hash
-            return [l.SerializeToString(), self.signing_key.sign(l.SerializeToString())[:64]]
+            return self._signed_response("get_listings", self._build_listings, cached_hash=cached_hash)
         except Exception:
             self.log.warning("could not find any listings in the database")
             return None
 
+    def _build_listings(self):
+        p = Profile(self.db).get()
+        l = Listings()
+        l.ParseFromString(self.db.listings.get_proto())
+        l.handle = p.handle
+        l.avatar_hash = p.avatar_hash
+        return l.SerializeToString()
+
+    def rpc_get_catalog(self, sender, since, start, count):
+        """
+        Serve a page of the listings added or changed after catalog version `since`
+        (0 for all of them) in the order they changed. When `since` isn't 0 the first
+        page also lists the hashes of the listings deleted since then.
+        """
+        self.log.info("serving store catalog to %s" % sender)
+        self.router.addContact(sender)
+        try:
+            key = (int(since), int(start), min(int(count), MAX_PAGE_SIZE))
+            return self._signed_response("get_catalog", lambda: self._build_catalog(*key), key)
+        except Exception:
+            self.log.warning("could not load the catalog")
+            return None
+
+    def _build_catalog(self, since, start, count):
+        p = Profile(self.db).get()
+        changes = self.db.listings.get_changes(since)
+        listings = [ser for _, ser in changes if ser is not None]
+        l = Listings()
+        for ser in listings[start:start + count]:
+            l.listing.add().ParseFromString(ser)
+        if since > 0 and start == 0:
+            l.deleted.extend([hash_value for hash_value, ser in changes if ser is None])
+        l.version = self.db.listings.get_version()
+        l.total = len(listings)
+        l.handle = p.handle
+        l.avatar_hash = p.avatar_hash
+        return l.SerializeToString()
+
     def rpc_get_contract_metadata(self, sender, contract_hash):
         self.log.info("serving metadata for contract %s to %s" % (contract_hash.encode("hex"), sender))
         self.router.addContact(sender)
         try:
-            proto = self.db.listings.get_proto()
-            p = Profile(self.db).get()
-            l = Listings()
-            l.ParseFromString(proto)
-            for listing in l.listing:
-                if listing.contract_hash == contract_hash:
-                    listing.avatar_hash = p.avatar_hash
-                    listing.handle = p.handle
-                    ser = listing.SerializeToString()
-            return [ser, self.signing_key.sign(ser)[:64]]
+            response = self._signed_response("get_contract_metadata",
+                                             lambda: self._build_contract_metadata(contract_hash), contract_hash)
+            if response is None:
+                raise Exception("Unknown contract")
+            return response
         except Exception:
             self.log.warning("could not find metadata for contract %s" % contract_hash.encode("hex"))
             return None
 
+    def _build_contract_metadata(self, contract_hash):
+        ser = self.db.listings.get_listing(contract_hash)
+        if ser is None:
+            return None
+        p = Profile(self.db).get()
+        listing = Listings.ListingMetadata()
+        listing.ParseFromString(ser)
+        listing.avatar_hash = p.avatar_hash
+        listing.handle = p.handle
+        return listing.SerializeToString()
+
     def rpc_follow(self, sender, proto, signature):
         self.log.info("received follow request from %s" % sender)
         self.router.addContact(sender)
-        try:
-            verify_key = nacl.signing.VerifyKey(sender.pubkey)
-            verify_key.verify(proto, signature)
+
+        def set_follower(_):
             f = Followers.Follower()
             f.ParseFromString(proto)
             if f.guid != sender.id:
@@ -144,88 +276,114 @@ class MarketProtocol(RPCProtocol):
                 raise Exception('Following wrong node')
             f.signature = signature
             self.db.follow.set_follower(f)
-            proto = Profile(self.db).get(False)
-            m = Metadata()
-            m.name = proto.name
-            m.handle = proto.handle
-            m.avatar_hash = proto.avatar_hash
-            m.short_description = proto.short_description
-            m.nsfw = proto.nsfw
             for listener in self.listeners:
                 try:
                     verifyObject(NotificationListener, listener)
                     listener.notify(sender.id, f.metadata.handle, "follow", "", "", f.metadata.avatar_hash)
                 except DoesNotImplement:
                     pass
-            return ["True", m.SerializeToString(), self.signing_key.sign(m.SerializeToString())[:64]]
-        except Exception:
+            return ["True"] + self._signed_response("get_user_metadata", self._build_metadata)
+
+        def invalid(_):
             self.log.warning("failed to validate follower")
             return ["False"]
 
+        return verify_signature(sender.pubkey, proto, signature).addCallback(set_follower).addErrback(invalid)
+
     def rpc_unfollow(self, sender, signature):
         self.log.info("received unfollow request from %s" % sender)
         self.router.addContact(sender)
-        try:
-            verify_key = nacl.signing.VerifyKey(sender.pubkey)
-            verify_key.verify("unfollow:" + self.node.id, signature)
-            f = self.db.follow
-            f.delete_follower(sender.id)
+
+        def delete_follower(_):
+            self.db.follow.delete_follower(sender.id)
             return ["True"]
-        except Exception:
+
+        def invalid(_):
             self.log.warning("failed to validate signature on unfollow request")
             return ["False"]
 
-    def rpc_get_followers(self, sender):
+        d = verify_signature(sender.pubkey, "unfollow:" + self.node.id, signature)
+        return d.addCallback(delete_follower).addErrback(invalid)
+
+    def rpc_get_followers(self, sender, cached_hash=None):
         self.log.info("serving followers list to %s" % sender)
         self.router.addContact(sender)
-        ser = self.db.follow.get_followers()
-        if ser is None:
-            return None
-        else:
-            return [ser, self.signing_key.sign(ser)[:64]]
+        return self._signed_response("get_followers", self.db.follow.get_followers, cached_hash=cached_hash)
 
     def rpc_get_following(self, sender):
         self.log.info("serving following list to %s" % sender)
         self.router.addContact(sender)
-        ser = self.db.follow.get_following()
-        if ser is None:
-            return None
-        else:
-            return [ser, self.signing_key.sign(ser)[:64]]
+        return self._signed_response("get_following", self.db.follow.get_following)
 
     def rpc_broadcast(self, sender, message, signature):
         if len(message) <= 140 and self.db.follow.is_following(sender.id):
-            try:
-                verify_key = nacl.signing.VerifyKey(sender.pubkey)
-                verify_key.verify(message, signature)
-            except Exception:
+
+            def notify(_):
+                self.log.info("received a broadcast from %s" % sender)
+                self.router.addContact(sender)
+                self._notify_broadcast(sender.id, message)
+                return ["True"]
+
+            def invalid(_):
                 self.log.warning("received invalid broadcast from %s" % sender)
                 return ["False"]
-            self.log.info("received a broadcast from %s" % sender)
-            self.router.addContact(sender)
-            for listener in self.listeners:
-                try:
-                    verifyObject(BroadcastListener, listener)
-                    listener.notify(sender.id, message)
-                except DoesNotImplement:
-                    pass
-            return ["True"]
+
+            return verify_signature(sender.pubkey, message, signature).addCallbacks(notify, invalid)
         else:
             return ["False"]
 
-    def rpc_message(self, sender, pubkey, encrypted):
+    def rpc_relay_broadcast(self, sender, plaintext, followers):
+        """
+        A broadcast from a store we follow handed on by another of its followers. `plaintext`
+        is a `PlaintextMessage` signed and timestamped by the store. Once the signature checks
+        out it's treated as if the store had sent it to us and then passed on to `followers`,
+        the concatenated guids of our part of the relay tree.
+        """
         try:
-            box = Box(self.signing_key.to_curve25519_private_key(), PublicKey(pubkey))
-            plaintext = box.decrypt(encrypted)
             p = PlaintextMessage()
             p.ParseFromString(plaintext)
             signature = p.signature
             p.ClearField("signature")
-            verify_key = nacl.signing.VerifyKey(p.pubkey)
-            verify_key.verify(p.SerializeToString(), signature)
-            h = nacl.hash.sha512(p.pubkey)
-            pow_hash = h[40:]
-            if int(pow_hash[:6], 16) >= 50 or p.sender_guid.encode("hex") != h[:40] or p.sender_guid != sender.id:
+        except Exception:
+            return ["False"]
+        if p.type == PlaintextMessage.BROADCAST and len(p.message) <= 140 \
+                and len(followers) % 20 == 0 and len(followers) / 20 <= MAX_RELAY_FOLLOWERS \
+                and abs(time.time() - p.timestamp) <= RELAY_MAX_AGE \
+                and signature not in self.relayed and self.db.follow.is_following(p.sender_guid):
+
+            def notify(_):
+                if signature in self.relayed:
+                    return ["False"]
+                self.relayed[signature] = True
+                self.log.info("received a broadcast from %s relayed by %s" % (p.sender_guid.encode("hex"), sender))
+                self.router.addContact(sender)
+                self._notify_broadcast(p.sender_guid, p.message)
+                if self.forward_broadcast is not None and len(followers) > 0:
+                    guids = [followers[i:i + 20] for i in range(0, len(followers), 20)]
+                    self.forward_broadcast(plaintext, guids)
+                return ["True"]
+
+            def invalid(_):
+                self.log.warning("received invalid relayed broadcast from %s" % sender)
+                return ["False"]
+
+            d = verify_identity(p.sender_guid, p.pubkey, p.SerializeToString(), signature)
+            return d.addCallbacks(notify, invalid)
+        else:
+            return ["False"]
+
+    def _notify_broadcast(self, guid, message):
+        for listener in self.listeners:
+            try:
+                verifyObject(BroadcastListener, listener)
+                listener.notify(guid, message)
+            except DoesNotImplement:
+                pass
+
+    def rpc_message(self, sender, pubkey, encrypted):
+
+        def notify(_):
+            if p.sender_guid != sender.id:
                 raise Exception('Invalid guid')
             self.log.info("received a message from %s" % sender)
             self.router.addContact(sender)
@@ -236,10 +394,23 @@ class MarketProtocol(RPCProtocol):
                 except DoesNotImplement:
                     pass
             return ["True"]
-        except Exception:
+
+        def invalid(_):
             self.log.warning("received invalid message from %s" % sender)
             return ["False"]
 
+        try:
+            box = Box(self.signing_key.to_curve25519_private_key(), PublicKey(pubkey))
+            plaintext = box.decrypt(encrypted)
+            p = PlaintextMessage()
+            p.ParseFromString(plaintext)
+            signature = p.signature
+            p.ClearField("signature")
+        except Exception:
+            return invalid(None)
+        d = verify_identity(p.sender_guid, p.pubkey, p.SerializeToString(), signature)
+        return d.addCallback(notify).addErrback(invalid)
+
     def rpc_order(self, sender, pubkey, encrypted):
         try:
             box = Box(self.signing_key.to_curve25519_private_key(), PublicKey(pubkey))
@@ -334,19 +505,21 @@ class MarketProtocol(RPCProtocol):
         self.log.info("serving ratings for contract %s to %s" % (a, sender))
         self.router.addContact(sender)
         try:
-            ratings = []
-            if listing_hash:
-                for rating in self.db.ratings.get_listing_ratings(listing_hash.encode("hex")):
-                    ratings.append(json.loads(rating[0], object_pairs_hook=OrderedDict))
-            else:
-                for rating in self.db.ratings.get_all_ratings():
-                    ratings.append(json.loads(rating[0], object_pairs_hook=OrderedDict))
-            ret = json.dumps(ratings).encode("zlib")
-            return [str(ret), self.signing_key.sign(ret)[:64]]
+            return self._signed_response("get_ratings", lambda: self._build_ratings(listing_hash), listing_hash)
         except Exception:
             self.log.warning("could not load ratings for contract %s" % a)
             return None
 
+    def _build_ratings(self, listing_hash):
+        ratings = []
+        if listing_hash:
+            for rating in self.db.ratings.get_listing_ratings(listing_hash.encode("hex")):
+                ratings.append(json.loads(rating[0], object_pairs_hook=OrderedDict))
+        else:
+            for rating in self.db.ratings.get_all_ratings():
+                ratings.append(json.loads(rating[0], object_pairs_hook=OrderedDict))
+        return str(json.dumps(ratings).encode("zlib"))
+
     def rpc_refund(self, sender, pubkey, encrypted):
         try:
             box = Box(self.signing_key.to_curve25519_private_key(), PublicKey(pubkey))
@@ -370,16 +543,36 @@ class MarketProtocol(RPCProtocol):
         d = self.get_image(nodeToAsk, image_hash)
         return d.addCallback(self.handleCallResponse, nodeToAsk)
 
-    def callGetProfile(self, nodeToAsk):
-        d = self.get_profile(nodeToAsk)
+    def callGetChunk(self, nodeToAsk, file_hash, index=None):
+        if index is None:
+            d = self.get_chunk(nodeToAsk, file_hash)
+        else:
+            d = self.get_chunk(nodeToAsk, file_hash, index)
         return d.addCallback(self.handleCallResponse, nodeToAsk)
 
-    def callGetUserMetadata(self, nodeToAsk):
-        d = self.get_user_metadata(nodeToAsk)
+    def callGetProfile(self, nodeToAsk, cached_hash=None):
+        if cached_hash is None:
+            d = self.get_profile(nodeToAsk)
+        else:
+            d = self.get_profile(nodeToAsk, cached_hash)
         return d.addCallback(self.handleCallResponse, nodeToAsk)
 
-    def callGetListings(self, nodeToAsk):
-        d = self.get_listings(nodeToAsk)
+    def callGetUserMetadata(self, nodeToAsk, cached_hash=None):
+        if cached_hash is None:
+            d = self.get_user_metadata(nodeToAsk)
+        else:
+            d = self.get_user_metadata(nodeToAsk, cached_hash)
+        return d.addCallback(self.handleCallResponse, nodeToAsk)
+
+    def callGetListings(self, nodeToAsk, cached_hash=None):
+        if cached_hash is None:
+            d = self.get_listings(nodeToAsk)
+        else:
+            d = self.get_listings(nodeToAsk, cached_hash)
+        return d.addCallback(self.handleCallResponse, nodeToAsk)
+
+    def callGetCatalog(self, nodeToAsk, since, start, count):
+        d = self.get_catalog(nodeToAsk, str(since), str(start), str(count))
         return d.addCallback(self.handleCallResponse, nodeToAsk)
 
     def callGetContractMetadata(self, nodeToAsk, contract_hash):
@@ -394,8 +587,11 @@ class MarketProtocol(RPCProtocol):
         d = self.unfollow(nodeToAsk, signature)
         return d.addCallback(self.handleCallResponse, nodeToAsk)
 
-    def callGetFollowers(self, nodeToAsk):
-        d = self.get_followers(nodeToAsk)
+    def callGetFollowers(self, nodeToAsk, cached_hash=None):
+        if cached_hash is None:
+            d = self.get_followers(nodeToAsk)
+        else:
+            d = self.get_followers(nodeToAsk, cached_hash)
         return d.addCallback(self.handleCallResponse, nodeToAsk)
 
     def callGetFollowing(self, nodeToAsk):
@@ -406,6 +602,10 @@ class MarketProtocol(RPCProtocol):
         d = self.broadcast(nodeToAsk, message, signature)
         return d.addCallback(self.handleCallResponse, nodeToAsk)
 
+    def callRelayBroadcast(self, nodeToAsk, plaintext, followers):
+        d = self.relay_broadcast(nodeToAsk, plaintext, "".join(followers))
+        return d.addCallback(self.handleCallResponse, nodeToAsk)
+
     def callMessage(self, nodeToAsk, ehemeral_pubkey, ciphertext):
         d = self.message(nodeToAsk, ehemeral_pubkey, ciphertext)
         return d.addCallback(self.handleCallResponse, nodeToAsk)
@@ -444,11 +644,14 @@ class MarketProtocol(RPCProtocol):
     def handleCallResponse(self, result, node):
         """
         If we get a response, add the node to the routing table.  If
-        we get no response, make sure it's removed from the routing table.
+        we get no response and the connection has been closed, make sure it's
+        removed from the routing table. A request can fail on a short adaptive
+        timeout or because the node is rate limiting us without the node being
+        gone, in which case the connection is left open.
         """
         if result[0]:
             self.router.addContact(node)
-        else:
+        elif (node.ip, node.port) not in self.multiplexer:
             self.log.debug("no response from %s, removing from router" % node)
             self.router.removeContact(node)
         return result
@@ -471,3 +674,6 @@ class MarketProtocol(RPCProtocol):
 
     def __iter__(self):
         return iter(self.handled_commands)
+
+    def __contains__(self, command):
+        return command in self.handled_commands
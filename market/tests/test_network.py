@@ -0,0 +1,186 @@
+import nacl.signing
+from mock import MagicMock
+from twisted.trial import unittest
+from twisted.internet import defer
+
+from config import PROTOCOL_VERSION
+from dht.node import Node
+from dht.utils import digest, LRUCache
+from market.network import Server, MAX_BROADCASTS, RELAY_FANOUT
+from market.protocol import UNCHANGED, RELAY_VERSION
+from protos import objects
+
+
+class GetCachedTest(unittest.TestCase):
+    def setUp(self):
+        self.signing_key = nacl.signing.SigningKey.generate()
+        self.node = Node(digest("vendor"), "127.0.0.1", 1234, self.signing_key.verify_key.encode())
+        # only the parts of the server _get_cached uses
+        self.server = Server.__new__(Server)
+        self.server.responses = LRUCache(10)
+        self.server.remote_version = lambda node: PROTOCOL_VERSION
+        m = objects.Metadata()
+        m.name = "test_name"
+        self.ser = m.SerializeToString()
+        self.calls = []
+
+    def _get(self, response):
+        def call(node_to_ask, cached_hash=None):
+            self.calls.append(cached_hash)
+            return defer.succeed(response)
+
+        def get_result(result):
+            m = objects.Metadata()
+            m.ParseFromString(result[1][0])
+            return m
+
+        d = self.server._get_cached(self.node, "get_user_metadata", call, get_result)
+        return self.successResultOf(d)
+
+    def test_get_cached(self):
+        key = (self.node.id, "get_user_metadata")
+
+        fresh = self._get((True, [self.ser, self.signing_key.sign(self.ser)[:64]]))
+        self.assertEqual(fresh.name, "test_name")
+        self.assertEqual(self.server.responses.get(key)[0], digest(self.ser))
+
+        signature = self.signing_key.sign(UNCHANGED + ":" + digest(self.ser))[:64]
+        unchanged = self._get((True, [UNCHANGED, signature]))
+        self.assertEqual(unchanged.name, "test_name")
+        self.assertEqual(self.calls, [None, digest(self.ser)])
+
+        self.assertIsNone(self._get((True, [UNCHANGED, "bad signature"])))
+
+        self.assertIsNone(self._get((True, None)))
+        self.assertNotIn(key, self.server.responses)
+        self._get((True, None))
+        self.assertEqual(self.calls[-1], None)
+
+    def test_get_cached_without_connection(self):
+        self._get((True, [self.ser, self.signing_key.sign(self.ser)[:64]]))
+
+        # with the connection gone the version kept with our copy is used
+        self.server.remote_version = lambda node: 0
+        signature = self.signing_key.sign(UNCHANGED + ":" + digest(self.ser))[:64]
+        unchanged = self._get((True, [UNCHANGED, signature]))
+        self.assertEqual(unchanged.name, "test_name")
+        self.assertEqual(self.calls, [None, digest(self.ser)])
+
+
+class BroadcastTest(unittest.TestCase):
+    def setUp(self):
+        self.nodes = [Node(digest(str(i)), "127.0.0.1", i) for i in range(30)]
+        f = objects.Followers()
+        for node in self.nodes:
+            f.followers.add().guid = node.id
+        # only the parts of the server broadcast uses
+        self.server = Server.__new__(Server)
+        self.server.db = MagicMock()
+        self.server.db.follow.get_followers.return_value = f.SerializeToString()
+        self.server.signing_key = nacl.signing.SigningKey.generate()
+        self.server.log = MagicMock()
+        self.server.broadcasts = defer.DeferredSemaphore(MAX_BROADCASTS)
+        self.server.kserver = MagicMock()
+        # the first five followers are offline
+        self.server.kserver.resolve_many = lambda guids: dict(
+            (guid, defer.succeed(None if guid in [n.id for n in self.nodes[:5]] else Node(guid, "127.0.0.1", 1)))
+            for guid in guids)
+        self.pending = []
+        self.server.protocol = MagicMock()
+        self.server.protocol.callBroadcast = self._call_broadcast
+
+    def _call_broadcast(self, node, message, signature):
+        d = defer.Deferred()
+        self.pending.append((d, node))
+        return d
+
+    def test_broadcast(self):
+        progress = []
+        d = self.server.broadcast("hello", lambda *counts: progress.append(counts))
+
+        # followers which couldn't be found are tried straight away
+        self.assertEqual(progress[-1], (0, 5, 30))
+        self.assertEqual(len(self.pending), MAX_BROADCASTS)
+
+        while self.pending:
+            response, node = self.pending.pop(0)
+            # every other follower accepts it
+            response.callback((True, ["True" if ord(node.id[0]) % 2 else "False"]))
+            self.assertLessEqual(len(self.pending), MAX_BROADCASTS)
+
+        reached = len([n for n in self.nodes[5:] if ord(n.id[0]) % 2])
+        self.assertEqual(self.successResultOf(d), reached)
+        self.assertEqual(progress[-1], (reached, 30, 30))
+        self.assertEqual(len(progress), 30)
+
+
+class RelayBroadcastTest(unittest.TestCase):
+    def setUp(self):
+        self.guids = sorted(digest(str(i)) for i in range(40))
+        self.unreachable = set()
+        f = objects.Followers()
+        for guid in self.guids:
+            f.followers.add().guid = guid
+        # only the parts of the server broadcast uses
+        self.server = Server.__new__(Server)
+        self.server.db = MagicMock()
+        self.server.db.follow.get_followers.return_value = f.SerializeToString()
+        self.server.signing_key = nacl.signing.SigningKey.generate()
+        self.server.log = MagicMock()
+        self.server.broadcasts = defer.DeferredSemaphore(MAX_BROADCASTS)
+        self.server.remote_version = lambda node: RELAY_VERSION
+        self.server.kserver = MagicMock()
+        self.server.kserver.node = Node(digest("store"), "127.0.0.1", 1234,
+                                        self.server.signing_key.verify_key.encode())
+        self.server.kserver.resolve_many = lambda guids: dict(
+            (guid, defer.succeed(None if guid in self.unreachable else Node(guid, "127.0.0.1", 1)))
+            for guid in guids)
+        self.relays = []
+        self.server.protocol = MagicMock()
+        self.server.protocol.callRelayBroadcast = self._call_relay_broadcast
+
+    def _call_relay_broadcast(self, node, plaintext, followers):
+        self.relays.append((node.id, followers))
+        self.plaintext = plaintext
+        return defer.succeed((True, ["True"]))
+
+    def test_relay_split(self):
+        d = self.server.broadcast("hello", relay=True)
+        self.assertEqual(self.successResultOf(d), 40)
+
+        # the store only sends to the head of each group, which is handed the rest of it
+        size = 40 // RELAY_FANOUT
+        self.assertEqual(self.relays, [(self.guids[i], self.guids[i + 1:i + size])
+                                       for i in range(0, 40, size)])
+
+        # and what it hands on is signed and timestamped so it can't be replayed later on
+        p = objects.PlaintextMessage()
+        p.ParseFromString(self.plaintext)
+        signature = p.signature
+        p.ClearField("signature")
+        self.server.signing_key.verify_key.verify(p.SerializeToString(), signature)
+        self.assertEqual((p.type, p.message), (objects.PlaintextMessage.BROADCAST, "hello"))
+        self.assertGreater(p.timestamp, 0)
+
+    def test_relay_takes_over_unreachable_head(self):
+        self.unreachable.add(self.guids[0])
+        d = self.server.broadcast("hello", relay=True)
+        self.assertEqual(self.successResultOf(d), 39)
+
+        # the rest of the unreachable head's group is split up and sent to by the store
+        self.assertEqual(len(self.relays), RELAY_FANOUT - 1 + 4)
+        for guid in self.guids[1:5]:
+            self.assertIn((guid, []), self.relays)
+
+    def test_relay_drops_unreachable_head_of_others_broadcast(self):
+        self.unreachable.add(self.guids[0])
+        p = objects.PlaintextMessage()
+        p.sender_guid = digest("another store")
+        p.type = objects.PlaintextMessage.BROADCAST
+        p.message = "hello"
+        d = self.server._relay_broadcast(p.SerializeToString(), self.guids)
+
+        # relaying nodes don't go looking for the rest of a group they were given
+        self.assertEqual(self.successResultOf(d), 35)
+        self.assertEqual(len(self.relays), RELAY_FANOUT - 1)
+        self.assertNotIn(self.guids[1], [guid for guid, _ in self.relays])
@@ -1,11 +1,22 @@
+import os
+import time
+import nacl.encoding
+import nacl.hash
+import nacl.signing
+from binascii import unhexlify
 from twisted.trial import unittest
+from twisted.internet import defer
 from twisted.python import log
 
+from db.datastore import Database
 from dht.node import Node
 from dht.utils import digest
 from dht.routing import RoutingTable
-from market.protocol import MarketProtocol
+from market.protocol import MarketProtocol, UNCHANGED
+from market.profile import Profile
+from market.transfer import Download, MediaFetcher, CHUNK_SIZE, VISIBLE, THUMBNAIL, FULL
 from dht.tests.utils import mknode
+from protos import objects
 
 class MarketProtocolTest(unittest.TestCase):
     def setUp(self):
@@ -36,3 +47,223 @@ class MarketProtocolTest(unittest.TestCase):
         exception_message = catcher.pop()
         self.assertEquals(catch_exception["message"][0], "[WARNING] could not find image 696e76616c69645f68617368")
         self.assertEquals(exception_message["message"][0], "[WARNING] Image hash is not 20 characters invalid_hash")
+
+    def test_MarketProtocol_signed_responses_cached(self):
+        db = Database(filepath="test.db")
+        self.addCleanup(os.remove, "test.db")
+        u = objects.Profile()
+        u.name = "test_name"
+        Profile(db).update(u)
+        signing_key = nacl.signing.SigningKey.generate()
+        mp = MarketProtocol(self.node, self.router, signing_key, db)
+
+        first = mp.rpc_get_profile(mknode())
+        self.assertIs(mp.responses["get_profile"].get(None)[0][1], mp.rpc_get_profile(mknode())[1])
+        signing_key.verify_key.verify(first[0], first[1])
+
+        unchanged = mp.rpc_get_profile(mknode(), digest(first[0]))
+        self.assertEqual(unchanged[0], UNCHANGED)
+        signing_key.verify_key.verify(UNCHANGED + ":" + digest(first[0]), unchanged[1])
+
+        u.name = "new_name"
+        Profile(db).update(u)
+        self.assertNotIn("get_profile", mp.responses)
+        p = objects.Profile()
+        p.ParseFromString(mp.rpc_get_profile(mknode())[0])
+        self.assertEqual(p.name, "new_name")
+
+    def test_MarketProtocol_rpc_get_catalog(self):
+        db = Database(filepath="test.db")
+        self.addCleanup(os.remove, "test.db")
+        for i in range(5):
+            listing = objects.Listings.ListingMetadata()
+            listing.contract_hash = digest(str(i))
+            db.listings.add_listing(listing)
+        signing_key = nacl.signing.SigningKey.generate()
+        mp = MarketProtocol(self.node, self.router, signing_key, db)
+
+        l = objects.Listings()
+        l.ParseFromString(mp.rpc_get_catalog(mknode(), "0", "1", "2")[0])
+        self.assertEqual([listing.contract_hash for listing in l.listing], [digest("1"), digest("2")])
+        self.assertEqual((l.version, l.total), (5, 5))
+
+        db.listings.delete_listing(digest("0"))
+        db.listings.add_listing(l.listing[0])
+        response = mp.rpc_get_catalog(mknode(), "5", "0", "10")
+        signing_key.verify_key.verify(response[0], response[1])
+        l.ParseFromString(response[0])
+        self.assertEqual([listing.contract_hash for listing in l.listing], [digest("1")])
+        self.assertEqual(list(l.deleted), [digest("0")])
+        self.assertEqual(l.version, 7)
+
+    def test_MarketProtocol_rpc_relay_broadcast(self):
+        db = Database(filepath="test.db")
+        self.addCleanup(os.remove, "test.db")
+        valid_key = "63d901c4d57cde34fc1f1e28b9af5d56ed342cae5c2fb470046d0130a4226b0c"
+        vendor_key = nacl.signing.SigningKey(valid_key, encoder=nacl.encoding.HexEncoder)
+        followers = digest("follower1") + digest("follower2")
+
+        def broadcast(message="new listings", timestamp=None, forge=False):
+            p = objects.PlaintextMessage()
+            p.sender_guid = unhexlify(nacl.hash.sha512(vendor_key.verify_key.encode())[:40])
+            p.pubkey = vendor_key.verify_key.encode()
+            p.type = objects.PlaintextMessage.BROADCAST
+            p.message = message
+            p.timestamp = int(time.time()) if timestamp is None else timestamp
+            p.signature = vendor_key.sign(p.SerializeToString())[:64]
+            if forge:
+                p.message = "forged"
+            return p.SerializeToString()
+
+        mp = MarketProtocol(self.node, self.router, 0, db)
+        forwarded = []
+        mp.forward_broadcast = lambda *args: forwarded.append(args)
+        plaintext = broadcast()
+        self.assertEqual(["False"], mp.rpc_relay_broadcast(mknode(), plaintext, followers))
+
+        user = objects.Following.User()
+        user.guid = unhexlify(nacl.hash.sha512(vendor_key.verify_key.encode())[:40])
+        db.follow.follow(user)
+        self.assertEqual(["False"], mp.rpc_relay_broadcast(mknode(), broadcast(timestamp=1), followers))
+        self.assertEqual(["False"], mp.rpc_relay_broadcast(mknode(), plaintext, followers * 5001))
+        d = mp.rpc_relay_broadcast(mknode(), broadcast(forge=True), followers)
+        d.addCallback(self.assertEqual, ["False"])
+        d.addCallback(lambda _: mp.rpc_relay_broadcast(mknode(), plaintext, followers))
+        d.addCallback(self.assertEqual, ["True"])
+        d.addCallback(lambda _: self.assertEqual(
+            forwarded, [(plaintext, [digest("follower1"), digest("follower2")])]))
+        # a replay of one we have already seen is turned down
+        d.addCallback(lambda _: self.assertEqual(
+            ["False"], mp.rpc_relay_broadcast(mknode(), plaintext, followers)))
+        return d
+
+
+class FakeChunkProtocol(object):
+    def __init__(self, data, bad_nodes=(), bad_manifests=()):
+        self.data = data
+        self.bad_nodes = bad_nodes
+        self.bad_manifests = bad_manifests
+        self.requests = []
+        self.pending = []
+
+    def callGetChunk(self, node, file_hash, index=None):
+        self.requests.append((node.port, index))
+        data = "x" * len(self.data) if node.port in self.bad_manifests else self.data
+        chunks = [data[i:i + CHUNK_SIZE] for i in range(0, len(data), CHUNK_SIZE)]
+        if index is None:
+            result = (True, [str(len(data)), "".join(digest(c) for c in chunks)])
+        elif node.port in self.bad_manifests:
+            result = (False, None)
+        elif node.port in self.bad_nodes:
+            result = (True, ["garbage"])
+        else:
+            result = (True, [chunks[int(index)]])
+        d = defer.Deferred()
+        self.pending.append((d, result))
+        return d
+
+    def respond(self):
+        while self.pending:
+            d, result = self.pending.pop(0)
+            d.callback(result)
+
+
+class DownloadTest(unittest.TestCase):
+    def setUp(self):
+        self.data = "".join(chr(i % 256) for i in range(CHUNK_SIZE * 14 + 100))
+        self.nodes = [Node(digest(str(i)), "127.0.0.1", i) for i in range(3)]
+
+    def test_download_from_several_nodes(self):
+        protocol = FakeChunkProtocol(self.data)
+        d = Download(protocol, digest(self.data)).fetch(self.nodes)
+        d.addCallback(self.assertEqual, self.data)
+        protocol.respond()
+        ports = set(port for port, index in protocol.requests if index is not None)
+        self.assertEqual(ports, set([0, 1, 2]))
+        return d
+
+    def test_download_drops_bad_node(self):
+        protocol = FakeChunkProtocol(self.data, bad_nodes=(1,))
+        download = Download(protocol, digest(self.data))
+        d = download.fetch(self.nodes)
+        d.addCallback(self.assertEqual, self.data)
+        protocol.respond()
+        self.assertNotIn(("127.0.0.1", 1), download.sources)
+        return d
+
+    def test_download_resumes(self):
+        protocol = FakeChunkProtocol(self.data, bad_nodes=(0,))
+        download = Download(protocol, digest(self.data))
+        d = download.fetch(self.nodes[:1])
+        d.addCallback(self.assertIsNone)
+        d.addCallback(lambda _: download.fetch(self.nodes[1:]))
+        d.addCallback(self.assertEqual, self.data)
+        protocol.respond()
+        return d
+
+    def test_download_wrong_hash(self):
+        protocol = FakeChunkProtocol(self.data)
+        d = Download(protocol, digest("something else")).fetch(self.nodes)
+        d.addCallback(self.assertIsNone)
+        protocol.respond()
+        return d
+
+
+    def test_download_blames_bad_manifest(self):
+        protocol = FakeChunkProtocol(self.data, bad_manifests=(0,))
+        download = Download(protocol, digest(self.data))
+        # the manifest is asked for from the first node
+        first = download.fetch(self.nodes[:1])
+        d = download.fetch(self.nodes[1:])
+        protocol.respond()
+        self.assertEqual(self.successResultOf(first), self.data)
+        self.assertEqual(download.blamed, set([("127.0.0.1", 0)]))
+        return d.addCallback(self.assertEqual, self.data)
+
+    def test_download_drops_unconfirmed_manifest(self):
+        protocol = FakeChunkProtocol(self.data, bad_manifests=(0,))
+        download = Download(protocol, digest(self.data))
+        d = download.fetch(self.nodes[:1])
+        d.addCallback(self.assertIsNone)
+        d.addCallback(lambda _: self.assertIsNone(download.hashes))
+        d.addCallback(lambda _: download.fetch(self.nodes[1:]))
+        d.addCallback(self.assertEqual, self.data)
+        protocol.respond()
+        return d
+
+class MediaFetcherTest(unittest.TestCase):
+    def setUp(self):
+        self.node = Node(digest("node"), "127.0.0.1", 1234)
+        self.requests = []
+        self.fetcher = MediaFetcher(self.fetch, max_per_node=1)
+
+    def fetch(self, node, image_hash, other_nodes):
+        d = defer.Deferred()
+        self.requests.append((image_hash, d))
+        return d
+
+    def test_duplicates_share_a_request(self):
+        results = []
+        self.fetcher.fetch(self.node, "a").addCallback(results.append)
+        self.fetcher.fetch(self.node, "a").addCallback(results.append)
+        self.assertEqual(len(self.requests), 1)
+        self.requests[0][1].callback("image")
+        self.assertEqual(results, ["image", "image"])
+        self.assertEqual(len(self.fetcher), 0)
+
+    def test_priority_and_limit(self):
+        self.fetcher.fetch(self.node, "busy")
+        self.fetcher.fetch(self.node, "full", FULL)
+        self.fetcher.fetch(self.node, "thumbnail", THUMBNAIL)
+        self.fetcher.fetch(self.node, "other", FULL)
+        self.fetcher.fetch(self.node, "other", VISIBLE)
+        self.assertEqual([h for h, d in self.requests], ["busy"])
+        for expected in ["other", "thumbnail", "full"]:
+            self.requests[-1][1].callback(None)
+            self.assertEqual(self.requests[-1][0], expected)
+
+    def test_failed_fetch(self):
+        results = []
+        self.fetcher.fetch(self.node, "a").addCallback(results.append)
+        self.requests[0][1].errback(Exception("timed out"))
+        self.assertEqual(results, [None])
@@ -0,0 +1,327 @@
+__author__ = 'chris'
+
+import os
+from heapq import heappush, heappop
+from itertools import count
+from dht.utils import digest, LRUCache
+from twisted.internet import defer
+
+# Large files are transferred in pieces of this size so they can be fetched from several
+# nodes at once, checked as they arrive and picked up again after a failure.
+CHUNK_SIZE = 65536
+
+# The first protocol version which understands GET_CHUNK.
+CHUNK_VERSION = 4
+
+# The number of chunk requests kept in flight to each node.
+WINDOW = 4
+
+HASH_SIZE = 20
+
+# Image priorities, most urgent first. VISIBLE is for images the user is looking at
+# right now and FULL for full size images fetched ahead of time.
+VISIBLE = 0
+THUMBNAIL = 1
+FULL = 2
+
+# The most images requested from a single node at once.
+MAX_PER_NODE = 2
+
+_manifests = LRUCache(1000)
+
+
+def get_manifest(path):
+    """
+    Returns the size of the file and the concatenated hashes of each of its chunks.
+    """
+    key = (path, os.path.getmtime(path))
+    manifest = _manifests.get(key)
+    if manifest is None:
+        size = 0
+        hashes = []
+        with open(path, "rb") as f:
+            chunk = f.read(CHUNK_SIZE)
+            while chunk:
+                size += len(chunk)
+                hashes.append(digest(chunk))
+                chunk = f.read(CHUNK_SIZE)
+        manifest = (size, "".join(hashes))
+        _manifests[key] = manifest
+    return manifest
+
+
+def read_chunk(path, index):
+    with open(path, "rb") as f:
+        f.seek(index * CHUNK_SIZE)
+        return f.read(CHUNK_SIZE)
+
+
+def chunk_count(size):
+    return (size + CHUNK_SIZE - 1) // CHUNK_SIZE
+
+
+class Download(object):
+    """
+    Fetches a file chunk by chunk from any number of nodes in parallel. The manifest (the
+    size and the hash of each chunk) is taken from the first node that has the file and
+    every chunk is checked against it as it arrives. A node which sends back a bad chunk
+    or fails to respond is dropped and its chunks are handed to the others.
+
+    The manifest could be the bad part though. So if every other node sends chunks which
+    don't match it, and none which do, the manifest is thrown away, the node it came from
+    is blamed instead and the others are taken back.
+
+    If every node drops out before the file is complete the chunks received so far are
+    kept, so calling `fetch` again with new nodes picks up where it left off. The manifest
+    is only kept for that if at least one chunk matched it.
+    """
+
+    def __init__(self, protocol, file_hash, verify=True):
+        """
+        Args:
+            protocol: the `MarketProtocol` used to request the chunks.
+            file_hash: the 20 byte hash of the file.
+            verify: whether to check the assembled file against `file_hash`. Contracts
+                aren't stored under the hash of their bytes so they are verified by the
+                caller instead.
+        """
+        self.protocol = protocol
+        self.file_hash = file_hash
+        self.verify = verify
+        self.size = None
+        self.hashes = None
+        self.chunks = {}
+        self.missing = []
+        self.sources = {}
+        self.in_flight = {}
+        self.fetching_manifest = False
+        self.waiting = []
+        # where the manifest came from and whether a chunk from anywhere else has matched it
+        self.manifest_source = None
+        self.confirmed = False
+        # nodes dropped for sending chunks which didn't match the manifest
+        self.mismatched = {}
+        # nodes which sent a bad manifest
+        self.blamed = set()
+        # bumped whenever the manifest is thrown away so late responses can be ignored
+        self.attempt = 0
+
+    def fetch(self, nodes):
+        """
+        Download the file from these nodes (plus any already being used). Returns a
+        `Deferred` which fires with the file or None if it couldn't be downloaded.
+        """
+        d = defer.Deferred()
+        self.waiting.append(d)
+        for node in nodes:
+            address = (node.ip, node.port)
+            if address not in self.sources and address not in self.blamed:
+                self.sources[address] = node
+                self.in_flight[address] = 0
+                if self.hashes is not None:
+                    self._request(address)
+        if self.hashes is None:
+            if not self.fetching_manifest:
+                self._get_manifest()
+        else:
+            self._check_finished()
+        return d
+
+    def _get_manifest(self):
+        if len(self.sources) == 0:
+            return self._finish(None)
+        address = next(iter(self.sources))
+        self.fetching_manifest = True
+        d = self.protocol.callGetChunk(self.sources[address], self.file_hash)
+        d.addCallback(self._on_manifest, address, self.attempt)
+
+    def _on_manifest(self, result, address, attempt):
+        if attempt != self.attempt:
+            return
+        self.fetching_manifest = False
+        try:
+            size, hashes = int(result[1][0]), result[1][1]
+            if not result[0] or len(hashes) != chunk_count(size) * HASH_SIZE:
+                raise Exception("Invalid manifest")
+        except Exception:
+            self._drop(address)
+            return self._get_manifest()
+        self.size, self.hashes = size, hashes
+        self.manifest_source = address
+        self.missing = [i for i in range(chunk_count(size)) if i not in self.chunks]
+        for source in self.sources.keys():
+            self._request(source)
+        self._check_finished()
+
+    def _request(self, address):
+        while self.missing and address in self.sources and self.in_flight[address] < WINDOW:
+            index = self.missing.pop(0)
+            self.in_flight[address] += 1
+            d = self.protocol.callGetChunk(self.sources[address], self.file_hash, str(index))
+            d.addCallback(self._on_chunk, address, index, self.attempt)
+
+    def _on_chunk(self, result, address, index, attempt):
+        if attempt != self.attempt:
+            return
+        if address in self.in_flight:
+            self.in_flight[address] -= 1
+        try:
+            chunk = result[1][0]
+            valid = result[0] and digest(chunk) == self.hashes[index * HASH_SIZE:(index + 1) * HASH_SIZE]
+        except Exception:
+            valid = False
+        if valid:
+            self.chunks[index] = chunk
+            if address != self.manifest_source:
+                self.confirmed = True
+            if index in self.missing:
+                self.missing.remove(index)
+            self._request(address)
+        else:
+            if index not in self.chunks and index not in self.missing:
+                self.missing.insert(0, index)
+            if result[0] and address != self.manifest_source and address in self.sources:
+                self.mismatched[address] = self.sources[address]
+            self._drop(address)
+            if self._manifest_suspect():
+                return self._reject_manifest()
+            for source in self.sources.keys():
+                self._request(source)
+        self._check_finished()
+
+    def _manifest_suspect(self):
+        others = [address for address in self.sources if address != self.manifest_source]
+        return not self.confirmed and len(self.mismatched) > 0 and len(others) == 0
+
+    def _reject_manifest(self):
+        self.blamed.add(self.manifest_source)
+        self._drop(self.manifest_source)
+        for address, node in self.mismatched.items():
+            self.sources[address] = node
+            self.in_flight[address] = 0
+        self._reset_manifest()
+        self.chunks = {}
+        self.attempt += 1
+        self._get_manifest()
+
+    def _reset_manifest(self):
+        self.size = None
+        self.hashes = None
+        self.missing = []
+        self.manifest_source = None
+        self.confirmed = False
+        self.mismatched = {}
+
+    def _drop(self, address):
+        self.sources.pop(address, None)
+        self.in_flight.pop(address, None)
+
+    def _check_finished(self):
+        if self.hashes is None or len(self.waiting) == 0:
+            return
+        count = chunk_count(self.size)
+        if len(self.chunks) == count:
+            data = "".join(self.chunks[i] for i in range(count))
+            if self.verify and digest(data) != self.file_hash:
+                # the chunks matched the manifest so it was the manifest that was wrong
+                self.blamed.add(self.manifest_source)
+                self.chunks = {}
+                self._reset_manifest()
+                data = None
+            self._finish(data)
+        elif len(self.sources) == 0:
+            self._finish(None)
+
+    def _finish(self, data):
+        waiting, self.waiting = self.waiting, []
+        self.sources = {}
+        self.in_flight = {}
+        self.mismatched = {}
+        if data is None and self.hashes is not None:
+            if len(self.chunks) == 0:
+                # nothing ever matched the manifest so there's no reason to trust it
+                self._reset_manifest()
+            else:
+                self.missing = [i for i in range(chunk_count(self.size)) if i not in self.chunks]
+        for d in waiting:
+            d.callback(data)
+
+    def __len__(self):
+        return len(self.chunks)
+
+
+class MediaFetcher(object):
+    """
+    Queues image downloads so that the same image is never requested twice at once,
+    more urgent images go first and no node is sent more than `max_per_node` requests
+    at a time.
+    """
+
+    def __init__(self, fetch, max_per_node=MAX_PER_NODE):
+        """
+        Args:
+            fetch: a function taking a node, an image hash and a list of other nodes which
+                have the image. It returns a `Deferred` which fires with the image or None.
+            max_per_node: the most images requested from a node at once.
+        """
+        self._fetch = fetch
+        self.max_per_node = max_per_node
+        # image hash -> Deferreds to fire with the image
+        self.waiting = {}
+        # image hash -> (priority, address) of images which haven't been requested yet
+        self.queued = {}
+        # address -> heap of (priority, sequence, image hash, node, other nodes)
+        self.queues = {}
+        # address -> number of requests in flight
+        self.active = {}
+        self._sequence = count()
+
+    def fetch(self, node, image_hash, priority=FULL, other_nodes=()):
+        """
+        Returns a `Deferred` which fires with the image or None. If the image is already
+        being fetched this waits on that request, moving it up the queue if needed.
+        """
+        d = defer.Deferred()
+        if image_hash in self.waiting:
+            self.waiting[image_hash].append(d)
+            if image_hash in self.queued and priority < self.queued[image_hash][0]:
+                # the old entry is skipped when it comes off the queue
+                address = self.queued[image_hash][1]
+                self._queue(address, priority, image_hash, node, other_nodes)
+                self._next(address)
+            return d
+        self.waiting[image_hash] = [d]
+        address = (node.ip, node.port)
+        self._queue(address, priority, image_hash, node, other_nodes)
+        self._next(address)
+        return d
+
+    def _queue(self, address, priority, image_hash, node, other_nodes):
+        self.queued[image_hash] = (priority, address)
+        heappush(self.queues.setdefault(address, []),
+                 (priority, next(self._sequence), image_hash, node, other_nodes))
+
+    def _next(self, address):
+        queue = self.queues.get(address, [])
+        while queue and self.active.get(address, 0) < self.max_per_node:
+            priority, _, image_hash, node, other_nodes = heappop(queue)
+            if self.queued.get(image_hash) != (priority, address):
+                continue
+            del self.queued[image_hash]
+            self.active[address] = self.active.get(address, 0) + 1
+            d = self._fetch(node, image_hash, other_nodes)
+            d.addErrback(lambda failure: None)
+            d.addCallback(self._finished, address, image_hash)
+        if not queue:
+            self.queues.pop(address, None)
+
+    def _finished(self, image, address, image_hash):
+        self.active[address] -= 1
+        if self.active[address] == 0:
+            del self.active[address]
+        for d in self.waiting.pop(image_hash, []):
+            d.callback(image)
+        self._next(address)
+
+    def __len__(self):
+        return len(self.waiting)
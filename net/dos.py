@@ -1,70 +1,140 @@
 __author__ = 'chris'
 
+import time
+
 from log import Logger
-from protos.message import Command, PING, STUN, STORE, INV, VALUES, GET_LISTINGS
-from twisted.internet import reactor, task
+from protos.message import Command, PING, STUN, STORE, INV, VALUES, GET_LISTINGS, GET_CONTRACT, GET_IMAGE, \
+    GET_CHUNK, RELAY_BROADCAST
+
+# The (burst, refill per second) allowed for each command. These are in messages except
+# for the commands in SIZE_LIMITED which are measured in bytes of arguments.
+LIMITS = {
+    PING: (4, 1 / 30.0),
+    STUN: (1, 1 / 30.0),
+    STORE: (1000000, 350 / 30.0),
+    INV: (5, 1 / 900.0),
+    VALUES: (5, 1 / 900.0),
+    GET_LISTINGS: (50, 1 / 150.0),
+    GET_CONTRACT: (100, 2),
+    GET_IMAGE: (200, 5),
+    GET_CHUNK: (1000, 50),
+    RELAY_BROADCAST: (10, 1 / 60.0),
+}
+DEFAULT_LIMIT = (100, 5)
+SIZE_LIMITED = (STORE,)
+
+# Every peer behind an ip also draws from a bucket for the ip as a whole this many times
+# the size of its own, so a few nodes behind a NAT aren't held back but a peer can't get
+# a fresh allowance just by changing its source port.
+IP_SHARE = 8
 
+# Buckets which have refilled are the same as new ones so they are dropped every so often.
+PRUNE_INTERVAL = 300
 
-class BanScore(object):
 
-    def __init__(self, peer_ip, multiplexer, ban_time=86400):
-        self.peer_ip = peer_ip
+class RateLimiter(object):
+    """
+    A token bucket for each (peer address, command) and, IP_SHARE times larger, each (ip,
+    command). Buckets are refilled when they are checked rather than on a timer, so there
+    is no per-peer cost between messages. A peer that runs out of either is sent CALM_DOWN.
+
+    Peers are told apart by ip and port since any number of nodes can share an address
+    behind a NAT. One that keeps going until its own bucket is a whole burst in debt is
+    disconnected and banned on its own. If the ip's bucket gets that far in debt every
+    peer behind it is, since that takes several of them or one hopping between ports.
+    """
+
+    def __init__(self, multiplexer, ban_time=86400, limits=None):
         self.multiplexer = multiplexer
         self.ban_time = ban_time
-        self.scores = {
-            PING: 0,
-            STUN: 0,
-            STORE: 0,
-            INV: 0,
-            VALUES: 0,
-            GET_LISTINGS: 0,
-        }
-        self.scoring_loop = task.LoopingCall(self.adjust_scores)
-        self.scoring_loop.start(30)
+        self.limits = limits if limits is not None else LIMITS
+        self.buckets = {}
+        # address or ip -> time the ban runs out
+        self.banned = {}
+        self.last_prune = time.time()
         self.log = Logger(system=self)
 
-    def process_message(self, message):
-        try:
-            if message.command == PING:
-                self.scores[PING] += 1
-                if self.scores[PING] > 4:
-                    self.ban(PING)
-            elif message.command == STUN:
-                self.scores[STUN] += 1
-                if self.scores[STUN] > 1:
-                    self.ban(STUN)
-            elif message.command == STORE:
-                args = tuple(message.arguments)
-                for arg in args:
-                    self.scores[STORE] += len(arg)
-                if self.scores[STORE] > 1000000:
-                    self.ban(STORE)
-            elif message.command == INV:
-                self.scores[INV] += 30
-                if self.scores[INV] > 150:
-                    self.ban(INV)
-            elif message.command == VALUES:
-                self.scores[VALUES] += 30
-                if self.scores[VALUES] > 150:
-                    self.ban(VALUES)
-            elif message.command == GET_LISTINGS:
-                self.scores[GET_LISTINGS] += 5
-                if self.scores[GET_LISTINGS] > 250:
-                    self.ban(GET_LISTINGS)
-        except Exception:
-            self.log.warning("Exception processing banscore for %s" % self.peer_ip[0])
-
-    def ban(self, message_type):
-        self.log.warning("Banned %s. Reason: too many %s messages." %
-                         (self.peer_ip[0], Command.Name(message_type)))
-        self.multiplexer.ban_ip(self.peer_ip[0])
-        self.multiplexer[self.peer_ip].shutdown()
-        reactor.callLater(self.ban_time, self.multiplexer.remove_ip_ban, self.peer_ip[0])
-
-    def adjust_scores(self):
-        for k, v in self.scores.items():
-            if v > 0:
-                if k == STORE:
-                    self.scores[k] = v - 350
-                else:
-                    self.scores[k] = v - 1
+    def allow(self, address, command, args):
+        """
+        Take the cost of a request from the peer's and its ip's buckets. Returns False if
+        either is over its limit.
+
+        Args:
+            address: a `tuple` of (ip address, port) of the peer.
+            command: the `Command` of the request.
+            args: the request arguments.
+        """
+        now = time.time()
+        if now - self.last_prune >= PRUNE_INTERVAL:
+            self.prune(now)
+        if self.is_banned(address):
+            return False
+        cost = sum(len(arg) for arg in args) if command in SIZE_LIMITED else 1
+        peer_allowed, peer_debt = self._take((address, command), cost, now)
+        ip_allowed, ip_debt = self._take((address[0], command), cost, now)
+        allowed = peer_allowed and ip_allowed
+        if not allowed and ip_debt:
+            self.ban(address[0], command)
+        elif not allowed and peer_debt:
+            self.ban(address, command)
+        elif not allowed:
+            self.log.warning("%s is sending too many %s messages" % (address[0], Command.Name(command)))
+        return allowed
+
+    def _take(self, key, cost, now):
+        """
+        Take `cost` from the bucket for `key`. Returns whether there were enough tokens and
+        whether the bucket is now a whole burst in debt.
+        """
+        burst, rate = self._limit(key)
+        tokens, last = self.buckets.get(key, (burst, now))
+        tokens = min(burst, tokens + (now - last) * rate)
+        # a single message larger than the burst is allowed through from a full bucket
+        allowed = tokens >= min(cost, burst)
+        tokens -= cost
+        self.buckets[key] = (tokens, now)
+        return allowed, tokens < -burst
+
+    def _limit(self, key):
+        burst, rate = self.limits.get(key[1], DEFAULT_LIMIT)
+        if isinstance(key[0], tuple):
+            return burst, rate
+        return burst * IP_SHARE, rate * IP_SHARE
+
+    def prune(self, now):
+        self.last_prune = now
+        for key, (tokens, last) in self.buckets.items():
+            burst, rate = self._limit(key)
+            if tokens + (now - last) * rate >= burst:
+                del self.buckets[key]
+        for banned, until in self.banned.items():
+            if until <= now:
+                del self.banned[banned]
+
+    def ban(self, banned, command):
+        """
+        Ban either a single peer, given its (ip address, port), or every peer behind an ip.
+        """
+        if isinstance(banned, tuple):
+            self.log.warning("Banned %s:%s. Reason: too many %s messages." %
+                             (banned[0], banned[1], Command.Name(command)))
+            addresses = [banned]
+        else:
+            self.log.warning("Banned %s. Reason: too many %s messages." % (banned, Command.Name(command)))
+            addresses = [address for address in self.multiplexer.keys() if address[0] == banned]
+        for key in [key for key in self.buckets if key[0] == banned]:
+            del self.buckets[key]
+        self.banned[banned] = time.time() + self.ban_time
+        for address in addresses:
+            if address in self.multiplexer:
+                self.multiplexer[address].shutdown()
+
+    def is_banned(self, address):
+        """
+        Returns True if this peer or its ip has been banned and the ban hasn't run out yet.
+        """
+        now = time.time()
+        return self.banned.get(address, 0) > now or self.banned.get(address[0], 0) > now
+
+    def __len__(self):
+        return len(self.buckets)
@@ -5,17 +5,48 @@ Copyright (c) 2015 OpenBazaar
 
 import abc
 import random
+import time
+import zlib
 from base64 import b64encode
-from config import PROTOCOL_VERSION
+from config import PROTOCOL_VERSION, MIN_PROTOCOL_VERSION
 from dht.node import Node
-from dht.utils import digest
+from dht.utils import digest, LRUCache
 from hashlib import sha1
 from log import Logger
-from protos.message import Message, Command, NOT_FOUND, HOLE_PUNCH
+from net.rtt import RTTEstimator
+from net.sendqueue import INTERACTIVE, BULK
+from net.timerwheel import TimerWheel
+from protos.message import Message, Command, NOT_FOUND, CALM_DOWN, HOLE_PUNCH, GET_CONTRACT, GET_IMAGE, \
+    GET_CHUNK, INV, VALUES
 from protos.objects import FULL_CONE, RESTRICTED, SYMMETRIC
-from twisted.internet import defer, reactor
+from twisted.internet import defer
 from txrudp.connection import State
 
+# Responses to these commands can be very large so the time it takes to receive them
+# depends more on the size of the file than the round trip time. They always get the
+# full waitTimeout and their response times are not used in the rtt estimate.
+BULK_COMMANDS = (GET_CONTRACT, GET_IMAGE, GET_CHUNK)
+
+# Requests and responses for these are sent behind everything else. Nobody is waiting
+# on the key transfers to new nodes.
+LOW_PRIORITY_COMMANDS = BULK_COMMANDS + (INV, VALUES)
+
+# Responses are kept around for a short time so a duplicated request can be answered
+# by resending the bytes rather than running the handler again. Very large responses
+# (images mostly) aren't worth the memory.
+REPLAY_TTL = 30
+REPLAY_CACHE_SIZE = 1000
+REPLAY_MAX_SIZE = 65536
+
+# Responses to peers running at least this version have their arguments compressed
+# when they add up to more than COMPRESSION_THRESHOLD bytes. Images are already
+# compressed so they are left alone. MAX_DECOMPRESSED_SIZE guards against a small
+# message that inflates into something huge.
+COMPRESSION_VERSION = 3
+COMPRESSION_THRESHOLD = 1024
+MAX_DECOMPRESSED_SIZE = 32 * 1024 * 1024
+INCOMPRESSIBLE_COMMANDS = (GET_IMAGE,)
+
 
 class RPCProtocol:
     """
@@ -34,13 +65,21 @@ class RPCProtocol:
             waitTimeout: Timeout for whole messages. Note the txrudp layer has a per-packet
                     timeout but invalid responses wont trigger it. The waitTimeout on this
                      layer needs to be long enough to allow whole messages (ex. images) to
-                     transmit.
+                     transmit. It is also the upper bound on the adaptive timeouts used
+                     for all other rpcs.
 
         """
         self.sourceNode = sourceNode
         self.router = router
         self._waitTimeout = waitTimeout
         self._outstanding = {}
+        self._peer_requests = {}
+        # msgIDs of requests which ran out of an adaptive timeout. A late response to one
+        # of these is dropped rather than taken for a new request.
+        self._expired = {}
+        self._timers = TimerWheel()
+        self._replay_cache = LRUCache(REPLAY_CACHE_SIZE)
+        self.rtt = RTTEstimator(waitTimeout)
         self.log = Logger(system=self)
 
     def receive_message(self, message, sender, connection):
@@ -50,7 +89,7 @@ class RPCProtocol:
             connection.shutdown()
             return False
 
-        if message.protoVer < PROTOCOL_VERSION:
+        if message.protoVer < MIN_PROTOCOL_VERSION:
             self.log.warning("received message from %s with incompatible protocol version." %
                              str(connection.dest_addr))
             connection.shutdown()
@@ -61,12 +100,25 @@ class RPCProtocol:
         msgID = message.messageID
         if message.command == NOT_FOUND:
             data = None
+        elif message.compressed:
+            try:
+                data = decompress_arguments(message.arguments)
+            except Exception:
+                self.log.warning("received a message from %s which couldn't be decompressed" %
+                                 str(connection.dest_addr))
+                return False
         else:
             data = tuple(message.arguments)
         if msgID in self._outstanding:
-            self._acceptResponse(msgID, data, sender)
-        elif message.command != NOT_FOUND:
-            self._acceptRequest(msgID, str(Command.Name(message.command)).lower(), data, sender, connection)
+            if message.command == CALM_DOWN:
+                self._acceptCalmDown(msgID, sender)
+            else:
+                self._acceptResponse(msgID, data, sender)
+        elif msgID in self._expired:
+            self.log.debug("ignoring late response for message id %s from %s" % (b64encode(msgID), sender))
+        elif message.command not in (NOT_FOUND, CALM_DOWN):
+            self._acceptRequest(msgID, str(Command.Name(message.command)).lower(), data, sender, connection,
+                                message.protoVer >= COMPRESSION_VERSION)
 
     def _acceptResponse(self, msgID, data, sender):
         if data is not None:
@@ -74,13 +126,36 @@ class RPCProtocol:
             self.log.debug("received response for message id %s from %s" % msgargs)
         else:
             self.log.warning("received 404 error response from %s" % sender)
-        d = self._outstanding[msgID][0]
-        if self._outstanding[msgID][2].active():
-            self._outstanding[msgID][2].cancel()
+        d, address, sent_time, command = self._popOutstanding(msgID)
+        if command not in BULK_COMMANDS:
+            self.rtt.add_sample(address, time.time() - sent_time)
         d.callback((True, data))
-        del self._outstanding[msgID]
 
-    def _acceptRequest(self, msgID, funcname, args, sender, connection):
+    def _acceptCalmDown(self, msgID, sender):
+        # The peer is up, we are just asking too much of it. Fail the request but
+        # unlike a timeout leave the connection alone.
+        self.log.warning("%s is rate limiting our requests" % sender)
+        d = self._popOutstanding(msgID)[0]
+        d.callback((False, None))
+
+    def _popOutstanding(self, msgID):
+        d, address, timeout, sent_time, command = self._outstanding.pop(msgID)
+        if timeout is not None and timeout.active():
+            timeout.cancel()
+        if address in self._peer_requests:
+            self._peer_requests[address].discard(msgID)
+            if not self._peer_requests[address]:
+                del self._peer_requests[address]
+        return d, address, sent_time, command
+
+    def _mark_sent(self, result, msgID, node, wait):
+        # Time the request and measure the round trip from when it actually left the
+        # send queue rather than from when it was queued.
+        if msgID in self._outstanding:
+            self._outstanding[msgID][2] = self._timers.schedule(wait, self._expire, msgID, node, wait)
+            self._outstanding[msgID][3] = time.time()
+
+    def _acceptRequest(self, msgID, funcname, args, sender, connection, compress=False):
         self.log.debug("received request from %s, command %s" % (sender, funcname.upper()))
         f = getattr(self, "rpc_%s" % funcname, None)
         if f is None or not callable(f):
@@ -88,17 +163,28 @@ class RPCProtocol:
             self.log.error("%s has no callable method rpc_%s; ignoring request" % msgargs)
             return False
         if funcname == "hole_punch":
-            f(sender, *args)
+            if self._allow(funcname, args, connection):
+                f(sender, *args)
         else:
+            request = hash((funcname,) + args)
+            if self._replay(msgID, request, sender, connection):
+                return
+            if not self._allow(funcname, args, connection):
+                self._sendResponse([], "calm_down", msgID, sender, connection)
+                return
+            # Mark the request as in progress so duplicates are dropped until we respond.
+            self._replay_cache[(sender.id, msgID)] = (request, connection, None, time.time() + REPLAY_TTL)
             d = defer.maybeDeferred(f, sender, *args)
-            d.addCallback(self._sendResponse, funcname, msgID, sender, connection)
-            d.addErrback(self._sendResponse, "bad_request", msgID, sender, connection)
+            d.addCallback(self._sendResponse, funcname, msgID, sender, connection, request, compress)
+            d.addErrback(self._sendResponse, "bad_request", msgID, sender, connection, request)
+
+    def _allow(self, funcname, args, connection):
+        return self.multiplexer.rate_limiter.allow(connection.dest_addr, Command.Value(funcname.upper()), args)
 
-    def _sendResponse(self, response, funcname, msgID, sender, connection):
+    def _sendResponse(self, response, funcname, msgID, sender, connection, request=None, compress=False):
         self.log.debug("sending response for msg id %s to %s" % (b64encode(msgID), sender))
         m = Message()
         m.messageID = msgID
-        m.sender.MergeFrom(self.sourceNode.getProto())
         m.protoVer = PROTOCOL_VERSION
         m.testnet = self.multiplexer.testnet
         if response is None:
@@ -109,22 +195,112 @@ class RPCProtocol:
                 response = [response]
             for arg in response:
                 m.arguments.append(str(arg))
-        m.signature = self.signing_key.sign(m.SerializeToString())[:64]
-        connection.send_message(m.SerializeToString())
+            if compress and m.command not in INCOMPRESSIBLE_COMMANDS and \
+                    sum(len(arg) for arg in m.arguments) > COMPRESSION_THRESHOLD:
+                compressed = compress_arguments(m.arguments)
+                if len(compressed) < m.ByteSize():
+                    del m.arguments[:]
+                    m.arguments.append(compressed)
+                    m.compressed = True
+
+        def authenticate():
+            data = self._authenticate(m, connection)
+            if request is not None and len(data) <= REPLAY_MAX_SIZE:
+                self._replay_cache[(sender.id, msgID)] = (request, connection, data, time.time() + REPLAY_TTL)
+            else:
+                self._replay_cache.pop((sender.id, msgID))
+            return data
+
+        priority = BULK if Command.Value(funcname.upper()) in LOW_PRIORITY_COMMANDS else INTERACTIVE
+        sent = self.multiplexer.send_queue.enqueue(connection.dest_addr, authenticate, connection.send_message,
+                                                   priority)
+        # if the connection closes first there is nobody left to respond to
+        sent.addErrback(lambda failure: None)
+
+    def _replay(self, msgID, request, sender, connection):
+        """
+        Check whether this request is a duplicate of one we've already seen. If we have
+        the response cached we send it again. Returns True if the request was handled.
+        """
+        cached = self._replay_cache.get((sender.id, msgID))
+        if cached is None or cached[0] != request or cached[3] < time.time():
+            return False
+        replay_connection, data = cached[1:3]
+        if data is None:
+            self.log.debug("ignoring duplicate of request %s from %s" % (b64encode(msgID), sender))
+            return True
+        # The response may have been authenticated with a session key for the old connection.
+        if replay_connection is not connection:
+            return False
+        self.log.debug("replaying response for msg id %s to %s" % (b64encode(msgID), sender))
+        connection.send_message(data)
+        return True
+
+    def _authenticate(self, m, connection):
+        """
+        Fill in the sender and signature of an outgoing message and return it serialized.
+        If we have an established session with this connection the message only carries
+        our guid and a MAC, otherwise the full node and an ed25519 signature.
+        """
+        node = self.sourceNode.getProto()
+        try:
+            session = connection.handler.session
+        except AttributeError:
+            session = None
+        if session is not None and self.multiplexer.session_auth and \
+                session.can_seal(node.SerializeToString()):
+            m.sender.guid = node.guid
+            m.signature = session.mac(m.SerializeToString())
+        else:
+            m.sender.MergeFrom(node)
+            m.signature = self.signing_key.sign(m.SerializeToString())[:64]
+            if session is not None:
+                session.signed_node = node.SerializeToString()
+        return m.SerializeToString()
+
+    def _expire(self, msgID, node, wait):
+        """
+        Called when a request's timeout runs out. Only a request which had the full
+        waitTimeout takes the connection down with it. One which ran out of an adaptive
+        timeout is failed on its own and the peer's timeout backed off. It could just be
+        stuck behind a large response, so the connection is only closed if we still
+        haven't heard anything from the peer by the time the full waitTimeout is up. Its
+        msgID is remembered for as long so a late response isn't mistaken for a request.
+        """
+        if wait >= self._waitTimeout:
+            return self.timeout(node)
+        d, address, sent_time, command = self._popOutstanding(msgID)
+        self.log.debug("request %s to %s timed out" % (b64encode(msgID), address))
+        self.rtt.backoff(address)
+        self._expired[msgID] = True
+        self._timers.schedule(self._waitTimeout, self._expired.pop, msgID, None)
+        self._timers.schedule(self._waitTimeout - wait, self._check_alive, node, sent_time)
+        d.callback((False, None))
+
+    def _check_alive(self, node, since):
+        address = (node.ip, node.port)
+        if address in self.multiplexer and self.multiplexer[address].handler.time_last_message < since:
+            self.timeout(node)
+
+    def has_outstanding_requests(self, address):
+        """
+        Returns True if we are waiting on a response from this address.
+        """
+        return address in self._peer_requests
 
     def timeout(self, node):
         """
-        This timeout is called by the txrudp connection handler. We will run through the
-        outstanding messages and callback false on any waiting on this IP address.
+        This timeout is called by the txrudp connection handler. We will look up the
+        outstanding messages to this IP address and callback false on each of them.
         """
         address = (node.ip, node.port)
-        for msgID, val in self._outstanding.items():
-            if address == val[1]:
-                val[0].callback((False, None))
-                if self._outstanding[msgID][2].active():
-                    self._outstanding[msgID][2].cancel()
-                del self._outstanding[msgID]
+        for msgID in self._peer_requests.pop(address, ()):
+            val = self._outstanding.pop(msgID)
+            if val[2] is not None and val[2].active():
+                val[2].cancel()
+            val[0].callback((False, None))
 
+        self.rtt.remove(address)
         self.router.removeContact(node)
         try:
             self.multiplexer[address].shutdown()
@@ -162,15 +338,15 @@ class RPCProtocol:
             msgID = sha1(str(random.getrandbits(255))).digest()
             m = Message()
             m.messageID = msgID
-            m.sender.MergeFrom(self.sourceNode.getProto())
             m.command = Command.Value(name.upper())
             m.protoVer = PROTOCOL_VERSION
             for arg in args:
                 m.arguments.append(str(arg))
             m.testnet = self.multiplexer.testnet
-            m.signature = self.signing_key.sign(m.SerializeToString())[:64]
-            data = m.SerializeToString()
 
+            def authenticate():
+                # done as the message leaves the send queue (see `SendQueue`)
+                return self._authenticate(m, self.multiplexer[address] if address in self.multiplexer else None)
 
             relay_addr = None
             if node.nat_type == SYMMETRIC or \
@@ -179,11 +355,21 @@ class RPCProtocol:
 
             d = defer.Deferred()
             if m.command != HOLE_PUNCH:
-                timeout = reactor.callLater(self._waitTimeout, self.timeout, node)
-                self._outstanding[msgID] = [d, address, timeout]
+                if m.command in BULK_COMMANDS:
+                    wait = self._waitTimeout
+                else:
+                    wait = self.rtt.get_timeout(address)
+                # the timeout is started once the request is actually sent
+                self._outstanding[msgID] = [d, address, None, time.time(), m.command]
+                self._peer_requests.setdefault(address, set()).add(msgID)
                 self.log.debug("calling remote function %s on %s (msgid %s)" % (name, address, b64encode(msgID)))
 
-            self.multiplexer.send_message(data, address, relay_addr)
+            priority = BULK if m.command in LOW_PRIORITY_COMMANDS else INTERACTIVE
+            sent = self.multiplexer.send_message(authenticate, address, relay_addr, priority)
+            if m.command != HOLE_PUNCH:
+                sent.addCallback(self._mark_sent, msgID, node, wait)
+            # a request whose connection closes before it's sent is failed by the shutdown
+            sent.addErrback(lambda failure: None)
 
             if self.multiplexer[address].state != State.CONNECTED and \
                             node.nat_type == RESTRICTED and \
@@ -196,3 +382,26 @@ class RPCProtocol:
             return d
 
         return func
+
+
+def compress_arguments(arguments):
+    """
+    Pack the arguments into a single zlib compressed blob. They are wrapped in a
+    `Message` so repeated structure across arguments compresses too.
+    """
+    m = Message()
+    m.arguments.extend(arguments)
+    return zlib.compress(m.SerializeToString())
+
+
+def decompress_arguments(arguments):
+    """
+    The reverse of `compress_arguments`. Returns the arguments as a `tuple`.
+    """
+    decompressor = zlib.decompressobj()
+    serialized = decompressor.decompress(arguments[0], MAX_DECOMPRESSED_SIZE)
+    if decompressor.unconsumed_tail:
+        raise Exception("Decompressed arguments too large")
+    m = Message()
+    m.ParseFromString(serialized)
+    return tuple(m.arguments)
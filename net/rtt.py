@@ -0,0 +1,83 @@
+__author__ = 'chris'
+
+
+class RTTEstimator(object):
+    """
+    Keeps a smoothed round trip time and round trip variance for each peer
+    (in the style of TCP's retransmission timer, RFC 6298) so that rpc
+    timeouts can track what we actually observe on the wire rather than a
+    fixed worst case. A global estimate, fed by every sample, is used for
+    peers we haven't received a response from yet.
+
+    Each time a request to a peer times out its timeout is doubled (up to the
+    maximum) until the next response comes back.
+    """
+
+    ALPHA = 0.125
+    BETA = 0.25
+    K = 4
+    MAX_BACKOFF = 64
+
+    def __init__(self, max_timeout, min_timeout=2.5):
+        """
+        Args:
+            max_timeout: the upper bound on any timeout returned. This is also the
+                timeout used before we have collected a single sample.
+            min_timeout: the lower bound on any timeout returned. It should be long
+                enough to cover a couple of txrudp packet retransmissions.
+        """
+        self.max_timeout = max_timeout
+        self.min_timeout = min(min_timeout, max_timeout)
+        self._global = None
+        self._peers = {}
+        self._backoff = {}
+
+    def add_sample(self, address, rtt):
+        """
+        Update the estimates for the given address with a new round trip measurement.
+
+        Args:
+            address: a `tuple` of (ip address, port) of the peer.
+            rtt: the measured round trip time in seconds.
+        """
+        self._peers[address] = self._update(self._peers.get(address), rtt)
+        self._global = self._update(self._global, rtt)
+        self._backoff.pop(address, None)
+
+    def backoff(self, address):
+        """
+        Double the timeout for this address. Called when a request to it times out.
+        """
+        self._backoff[address] = min(self._backoff.get(address, 1) * 2, self.MAX_BACKOFF)
+
+    def get_timeout(self, address):
+        """
+        Return the number of seconds to wait for a response from this address
+        before considering it unresponsive.
+        """
+        estimate = self._peers.get(address, self._global)
+        if estimate is None:
+            return self.max_timeout
+        srtt, rttvar = estimate
+        timeout = max(srtt + self.K * rttvar, 2 * srtt) * self._backoff.get(address, 1)
+        return min(self.max_timeout, max(self.min_timeout, timeout))
+
+    def remove(self, address):
+        """
+        Forget everything we know about this address. Called when the peer
+        disconnects so stale estimates don't apply to a new connection.
+        """
+        if address in self._peers:
+            del self._peers[address]
+        self._backoff.pop(address, None)
+
+    def __contains__(self, address):
+        return address in self._peers
+
+    def _update(self, estimate, rtt):
+        if estimate is None:
+            return rtt, rtt / 2.0
+        srtt, rttvar = estimate
+        rttvar = (1 - self.BETA) * rttvar + self.BETA * abs(srtt - rtt)
+        srtt = (1 - self.ALPHA) * srtt + self.ALPHA * rtt
+        return srtt, rttvar
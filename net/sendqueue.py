@@ -0,0 +1,158 @@
+__author__ = 'chris'
+
+from collections import deque, OrderedDict
+
+from config import SEND_RATE, PEER_SEND_RATE
+from twisted.internet import defer, reactor
+
+# Send priorities, lowest value first. Interactive traffic is anything a user is
+# likely to be waiting on. Bulk is media, contracts and the key transfers used to
+# hand data off to new nodes.
+INTERACTIVE = 0
+BULK = 1
+
+
+class TokenBucket(object):
+    """
+    A token bucket measured in bytes. A message may be sent whenever the bucket isn't
+    empty and the full size is taken even if that leaves the bucket in debt, so messages
+    larger than the burst size still go out, they just delay whatever follows them.
+    """
+
+    def __init__(self, rate, clock=reactor):
+        self.rate = rate
+        self.clock = clock
+        self.tokens = float(rate)
+        self.last = clock.seconds()
+
+    def _refill(self):
+        now = self.clock.seconds()
+        self.tokens = min(self.rate, self.tokens + (now - self.last) * self.rate)
+        self.last = now
+
+    def ready(self):
+        self._refill()
+        return self.tokens > 0
+
+    def consume(self, size):
+        self._refill()
+        self.tokens -= size
+
+    def delay(self):
+        """
+        Seconds until the bucket has tokens again.
+        """
+        self._refill()
+        return max(0, -self.tokens / self.rate)
+
+
+class SendQueue(object):
+    """
+    Paces outbound messages so that fan-out, republishing and media transfers can't
+    flood the socket all at once. Messages are sent immediately while both the global
+    and the peer's rate limits allow it. Otherwise they are queued by priority and sent
+    round robin between peers as the limits free up. The rates are in bytes per second
+    and default to SEND_RATE and PEER_SEND_RATE from the config. Each bucket can burst up
+    to one second's worth.
+
+    `enqueue` returns a `Deferred` which fires once the message has actually been handed
+    to the connection, so callers producing a lot of data can wait on it rather than
+    queueing everything at once.
+
+    Messages can go out in a different order than they were queued in, so anything which
+    depends on what has already been sent to the peer (like whether a message can be
+    sealed with the session key) should be queued as a function and done when it's sent.
+    """
+
+    def __init__(self, rate=SEND_RATE, peer_rate=PEER_SEND_RATE, clock=reactor):
+        self.peer_rate = peer_rate
+        self.clock = clock
+        self._bucket = TokenBucket(rate, clock)
+        self._peer_buckets = {}
+        # one ordered map of address -> deque of pending messages for each priority
+        self._queues = [OrderedDict() for _ in (INTERACTIVE, BULK)]
+        self._count = 0
+        self._call = None
+
+    def enqueue(self, address, data, send, priority=INTERACTIVE):
+        """
+        Send `data` to `address` by calling `send(data)` once the rate limits allow.
+
+        Args:
+            address: a `tuple` of (ip address, port) of the recipient.
+            data: the serialized message or a function which returns it. The function is
+                called just before the message is sent.
+            send: a callable which sends the data over the wire.
+            priority: `INTERACTIVE` or `BULK`.
+        """
+        bucket = self._peer_bucket(address)
+        if not self._queued(address, priority) and self._bucket.ready() and bucket.ready():
+            self._send(address, data, send)
+            return defer.succeed(None)
+        d = defer.Deferred()
+        self._queues[priority].setdefault(address, deque()).append((data, send, d))
+        self._count += 1
+        self._schedule()
+        return d
+
+    def remove(self, address):
+        """
+        Drop everything queued for this address and forget its rate limit. Called when the
+        connection closes.
+        """
+        self._peer_buckets.pop(address, None)
+        for queue in self._queues:
+            for _, _, d in queue.pop(address, ()):
+                self._count -= 1
+                d.errback(Exception("connection to %s:%s closed" % address))
+
+    def _queued(self, address, priority):
+        # Anything already waiting at the same or a higher priority goes first.
+        return any(address in queue for queue in self._queues[:priority + 1])
+
+    def _peer_bucket(self, address):
+        if address not in self._peer_buckets:
+            self._peer_buckets[address] = TokenBucket(self.peer_rate, self.clock)
+        return self._peer_buckets[address]
+
+    def _send(self, address, data, send):
+        if callable(data):
+            data = data()
+        self._bucket.consume(len(data))
+        self._peer_bucket(address).consume(len(data))
+        send(data)
+
+    def _schedule(self):
+        if self._call is not None or self._count == 0:
+            return
+        delay = self._bucket.delay()
+        if delay == 0:
+            delay = min(self._peer_buckets[address].delay() for queue in self._queues for address in queue)
+        self._call = self.clock.callLater(delay, self._drain)
+
+    def _drain(self):
+        self._call = None
+        for queue in self._queues:
+            for address in queue.keys():
+                if not self._bucket.ready():
+                    self._schedule()
+                    return
+                # a callback may have removed this peer already
+                pending = queue.get(address)
+                if pending is None:
+                    continue
+                bucket = self._peer_bucket(address)
+                while pending and bucket.ready() and self._bucket.ready():
+                    data, send, d = pending.popleft()
+                    self._count -= 1
+                    self._send(address, data, send)
+                    d.callback(None)
+                if queue.get(address) is pending:
+                    del queue[address]
+                    if pending:
+                        # move to the back so other peers get a turn
+                        queue[address] = pending
+        self._schedule()
+
+    def __len__(self):
+        return self._count
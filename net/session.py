@@ -0,0 +1,69 @@
+__author__ = 'chris'
+
+import hmac
+import nacl.bindings
+import nacl.signing
+from hashlib import sha256
+
+# The first protocol version which understands session authenticated messages.
+SESSION_VERSION = 2
+
+
+class Session(object):
+    """
+    Per-connection authentication state. Once both sides of a connection have sent
+    each other a signed message we derive a symmetric key from the two identity keys
+    (converted to curve25519) and the ephemeral keys txrudp negotiated for this
+    connection. From then on messages are authenticated with a short HMAC instead of
+    an ed25519 signature and only carry the sender's guid rather than its full node.
+    """
+
+    MAC_SIZE = 16
+
+    def __init__(self):
+        self.key = None
+        self.remote_pubkey = None
+        self.signed_node = None
+
+    def establish(self, signing_key, remote_pubkey, connection):
+        """
+        Derive the session key. This must only be called after the signature on a
+        message from `remote_pubkey` has been verified.
+
+        Args:
+            signing_key: our ed25519 `SigningKey`.
+            remote_pubkey: the peer's ed25519 public key.
+            connection: the txrudp connection this session belongs to.
+        """
+        shared = nacl.bindings.crypto_box_beforenm(
+            nacl.signing.VerifyKey(remote_pubkey).to_curve25519_public_key().encode(),
+            signing_key.to_curve25519_private_key().encode())
+        ephemeral_keys = []
+        if getattr(connection, "_public_key", None) is not None:
+            ephemeral_keys.append(connection._public_key.encode())
+        if getattr(connection, "remote_public_key", None) is not None:
+            ephemeral_keys.append(connection.remote_public_key)
+        self.key = sha256(shared + "".join(sorted(ephemeral_keys))).digest()
+        self.remote_pubkey = remote_pubkey
+
+    def can_seal(self, node_proto):
+        """
+        Returns whether the next message may be sent with a MAC. The peer must have
+        received a signed message from us with our current node proto, as that is what
+        it will use as the sender of the compact messages.
+        """
+        return self.key is not None and self.signed_node == node_proto
+
+    def mac(self, data):
+        return hmac.new(self.key, data, sha256).digest()[:self.MAC_SIZE]
+
+    def is_sealed(self, message):
+        return len(message.signature) == self.MAC_SIZE
+
+    def verify(self, message):
+        """
+        Check the MAC on a sealed message. This clears the signature field.
+        """
+        mac = message.signature
+        message.ClearField("signature")
+        return self.key is not None and hmac.compare_digest(self.mac(message.SerializeToString()), mac)
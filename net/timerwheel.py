@@ -0,0 +1,122 @@
+__author__ = 'chris'
+
+import math
+
+from twisted.internet import reactor
+
+
+class TimerWheel(object):
+    """
+    A hashed timing wheel for managing large numbers of coarse timeouts. Each timer is
+    placed in one of a fixed number of slots based on the tick it expires on, so scheduling
+    and cancelling are O(1) and only a single reactor call (armed for the next occupied
+    slot) is used to drive every timer. The trade off is that timers fire on tick boundaries
+    rather than at their exact deadline, which is fine for rpc timeouts measured in seconds.
+    """
+
+    def __init__(self, tick=0.1, slots=512, clock=reactor):
+        """
+        Args:
+            tick: the resolution of the wheel in seconds.
+            slots: the number of buckets. Timers further out than slots * tick will
+                go around the wheel more than once before firing.
+            clock: the `IReactorTime` provider used to drive the wheel.
+        """
+        self.tick = tick
+        self.clock = clock
+        self._slots = [set() for _ in range(slots)]
+        self._ticks = 0
+        self._start = clock.seconds()
+        self._count = 0
+        self._call = None
+        self._wake = None
+
+    def schedule(self, delay, f, *args, **kw):
+        """
+        Call `f` with the given arguments after `delay` seconds (rounded up to the next tick).
+        Returns a `TimerHandle` which can be used to cancel the timer.
+        """
+        if self._count == 0 and self._call is None:
+            # the wheel has been idle so line the tick count back up with the clock
+            self._start = self.clock.seconds() - self._ticks * self.tick
+        elapsed = self.clock.seconds() - self._start
+        deadline = max(int(math.ceil((elapsed + delay) / self.tick)), self._ticks + 1)
+        handle = TimerHandle(self, deadline, f, args, kw)
+        self._slots[deadline % len(self._slots)].add(handle)
+        self._count += 1
+        if self._wake is None or deadline < self._wake:
+            self._arm(deadline)
+        return handle
+
+    def _remove(self, handle):
+        self._slots[handle.deadline % len(self._slots)].discard(handle)
+        self._count -= 1
+        if self._count == 0 and self._call is not None:
+            self._call.cancel()
+            self._call = None
+            self._wake = None
+
+    def _arm(self, tick):
+        if self._call is not None:
+            self._call.cancel()
+        self._wake = tick
+        delay = max(0, self._start + tick * self.tick - self.clock.seconds())
+        self._call = self.clock.callLater(delay, self._advance)
+
+    def _next_deadline(self):
+        slots = len(self._slots)
+        for i in range(1, slots + 1):
+            tick = self._ticks + i
+            for handle in self._slots[tick % slots]:
+                if handle.deadline == tick:
+                    return tick
+        # everything left is at least one full rotation away
+        return self._ticks + slots
+
+    def _advance(self):
+        self._call = None
+        # The reactor may have fallen behind so fire everything that is due
+        # rather than just the slot we were armed for.
+        target = max(self._wake, int((self.clock.seconds() - self._start) / self.tick))
+        self._wake = None
+        while self._ticks < target and self._count > 0:
+            self._ticks += 1
+            bucket = self._slots[self._ticks % len(self._slots)]
+            for handle in [h for h in bucket if h.deadline <= self._ticks]:
+                # an earlier callback in this bucket may have cancelled it
+                if handle.active():
+                    handle.fire()
+        self._ticks = max(self._ticks, target)
+        if self._count > 0:
+            self._arm(self._next_deadline())
+
+    def __len__(self):
+        return self._count
+
+
+class TimerHandle(object):
+    """
+    Returned by `TimerWheel.schedule`. Mirrors the parts of `DelayedCall` we use.
+    """
+
+    def __init__(self, wheel, deadline, f, args, kw):
+        self.wheel = wheel
+        self.deadline = deadline
+        self.f = f
+        self.args = args
+        self.kw = kw
+        self.called = False
+        self.cancelled = False
+
+    def active(self):
+        return not (self.called or self.cancelled)
+
+    def cancel(self):
+        if self.active():
+            self.cancelled = True
+            self.wheel._remove(self)
+
+    def fire(self):
+        self.called = True
+        self.wheel._remove(self)
+        self.f(*self.args, **self.kw)
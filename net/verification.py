@@ -0,0 +1,99 @@
+__author__ = 'chris'
+
+import nacl.hash
+import nacl.signing
+from dht.utils import LRUCache
+from hashlib import sha256
+from twisted.internet import defer, reactor, threads
+from twisted.python.threadpool import ThreadPool
+
+# Checking a signature only takes a fraction of a millisecond but a burst of new
+# connections can add up to a noticeable stall on the reactor. Libsodium releases
+# the GIL so the checks can run on a small pool of threads instead.
+POOL_SIZE = 4
+
+_pool = None
+
+# Both the guid proof of work and a signature over fixed data always give the same
+# answer so we remember the result for peers we see often. Rejected identities are
+# kept separately so a flood of bad ones can't push out the good ones. These are
+# only touched from the reactor thread.
+_valid_guids = LRUCache(10000)
+_rejected_guids = LRUCache(1000)
+_signatures = LRUCache(10000)
+
+
+def _get_pool():
+    global _pool
+    if _pool is None:
+        _pool = ThreadPool(minthreads=0, maxthreads=POOL_SIZE, name="verification")
+        _pool.start()
+        reactor.addSystemEventTrigger("during", "shutdown", _pool.stop)
+    return _pool
+
+
+def defer_to_pool(f, *args, **kwargs):
+    """
+    Run `f` on the verification thread pool and return a `Deferred` that fires with
+    its result (or failure) on the reactor thread. When the reactor isn't running,
+    as in unit tests, there is nothing to deliver the result so `f` is run inline.
+    """
+    if not reactor.running:
+        return defer.maybeDeferred(f, *args, **kwargs)
+    return threads.deferToThreadPool(reactor, _get_pool(), f, *args, **kwargs)
+
+
+def check_guid(guid, pubkey):
+    """
+    Raise an exception if the guid isn't derived from this public key or doesn't
+    have a valid proof of work.
+    """
+    identity = (guid, pubkey)
+    if _valid_guids.get(identity):
+        return
+    if _rejected_guids.get(identity):
+        raise Exception('Invalid GUID')
+    h = nacl.hash.sha512(pubkey)
+    pow_hash = h[40:]
+    if int(pow_hash[:6], 16) >= 50 or guid.encode("hex") != h[:40]:
+        _rejected_guids[identity] = True
+        raise Exception('Invalid GUID')
+    _valid_guids[identity] = True
+
+
+def check_signature(pubkey, data, signature):
+    """
+    Synchronously verify a signature, raising an exception if it's invalid. Successful
+    checks are cached so this is meant for data we expect to see signed more than
+    once, like the entries in a followers list.
+    """
+    key = (pubkey, signature, sha256(data).digest())
+    if _signatures.get(key):
+        return
+    nacl.signing.VerifyKey(pubkey).verify(data, signature)
+    _signatures[key] = True
+
+
+def _verify(pubkey, data, signature):
+    nacl.signing.VerifyKey(pubkey).verify(data, signature)
+
+
+def verify_signature(pubkey, data, signature):
+    """
+    Returns a `Deferred` which fires if `signature` is a valid signature of `data` by
+    `pubkey` and errbacks otherwise.
+    """
+    return defer_to_pool(_verify, pubkey, data, signature)
+
+
+def verify_identity(guid, pubkey, data, signature):
+    """
+    Like `verify_signature` but also checks that the guid belongs to this public key.
+    The guid is checked against the cache on the reactor thread before the signature
+    is handed to the pool.
+    """
+    try:
+        check_guid(guid, pubkey)
+    except Exception:
+        return defer.fail()
+    return verify_signature(pubkey, data, signature)
@@ -1,25 +1,34 @@
 __author__ = 'chris'
 
 import socket
-import nacl.signing
-import nacl.hash
 import time
-from config import SEEDS
+from config import SEEDS, SESSION_AUTH, MAX_CONNECTIONS
 from dht.node import Node
 from dht.utils import digest
 from interfaces import MessageProcessor, Multiplexer, ConnectionHandler
 from log import Logger
-from protos.message import Message, PING, NOT_FOUND
+from net.dos import RateLimiter
+from net.sendqueue import SendQueue, INTERACTIVE
+from net.session import Session, SESSION_VERSION
+from net.timerwheel import TimerWheel
+from net.verification import verify_identity
+from protos.message import Message, PING, NOT_FOUND, CALM_DOWN
 from protos.objects import RESTRICTED, FULL_CONE
-from random import shuffle
-from twisted.internet import task, reactor
-from twisted.internet.task import LoopingCall
+from random import shuffle, uniform
 from txrudp.connection import HandlerFactory, Handler, State
-from txrudp.crypto_connection import CryptoConnectionFactory
+from txrudp.crypto_connection import CryptoConnection, CryptoConnectionFactory
 from txrudp.rudp import ConnectionMultiplexer
 from zope.interface.verify import verifyObject
 from zope.interface import implements
 
+# The kernel drops datagrams once the socket's receive buffer is full so give it room
+# to hold a burst from many peers while the reactor is busy with something else.
+RECV_BUFFER_SIZE = 4 * 1024 * 1024
+
+# How many bytes to read off the socket each time it becomes readable before going
+# back to the reactor. Twisted's default is 256KB.
+MAX_READ_THROUGHPUT = 1024 * 1024
+
 
 class OpenBazaarProtocol(ConnectionMultiplexer):
     """
@@ -42,71 +51,142 @@ class OpenBazaarProtocol(ConnectionMultiplexer):
         self.ws = None
         self.blockchain = None
         self.processors = []
+        self.dispatch = {}
         self.relay_node = None
         self.nat_type = nat_type
+        self.session_auth = SESSION_AUTH
+        self.max_connections = MAX_CONNECTIONS
         self.vendors = db.vendors.get_vendors()
-        self.factory = self.ConnHandlerFactory(self.processors, nat_type, self.relay_node)
+        # Keep-alives are scheduled per connection so they are spread out over the interval
+        # rather than all sent in one burst. One second resolution is plenty for these.
+        self.keep_alive_timers = TimerWheel(tick=1)
+        self.send_queue = SendQueue()
+        self.rate_limiter = RateLimiter(self)
+        self.factory = self.ConnHandlerFactory(self.processors, nat_type, self.relay_node, self.dispatch,
+                                               self.keep_alive_timers)
         self.log = Logger(system=self)
-        self.keep_alive_loop = LoopingCall(self.keep_alive)
-        self.keep_alive_loop.start(30 if nat_type == RESTRICTED else 1200, now=False)
-        ConnectionMultiplexer.__init__(self, CryptoConnectionFactory(self.factory), self.ip_address[0], relaying)
+        ConnectionMultiplexer.__init__(self, NotifyingConnectionFactory(self.factory), self.ip_address[0], relaying)
+
+    def startProtocol(self):
+        ConnectionMultiplexer.startProtocol(self)
+        try:
+            self.transport.socket.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, RECV_BUFFER_SIZE)
+        except (AttributeError, socket.error):
+            self.log.warning("unable to set the udp receive buffer size")
+        self.transport.maxThroughput = MAX_READ_THROUGHPUT
 
     class ConnHandler(Handler):
         implements(ConnectionHandler)
 
-        def __init__(self, processors, nat_type, relay_node, *args, **kwargs):
+        def __init__(self, processors, nat_type, relay_node, dispatch=None, keep_alive_timers=None,
+                     *args, **kwargs):
             super(OpenBazaarProtocol.ConnHandler, self).__init__(*args, **kwargs)
             self.log = Logger(system=self)
             self.processors = processors
+            self.dispatch = dispatch if dispatch is not None else build_dispatch_table(processors)
             self.connection = None
             self.node = None
             self.relay_node = relay_node
             self.addr = None
             self.is_new_node = True
-            self.on_connection_made()
+            self.session = Session()
+            self.verifying = None
+            self.queue = []
+            self.evicted = False
+            self.keep_alive_timers = keep_alive_timers
+            self.keep_alive_interval = 30 if nat_type == RESTRICTED else 1200
+            self.keep_alive_call = None
+            self.connected = False
+            self.time_created = time.time()
             self.time_last_message = 0
+            self.remote_version = 0
+            # set once a message from the peer has been authenticated
+            self.verified = False
 
         def on_connection_made(self):
-            if self.connection is None or self.connection.state == State.CONNECTING:
-                return task.deferLater(reactor, .1, self.on_connection_made)
-            if self.connection.state == State.CONNECTED:
-                self.addr = str(self.connection.dest_addr[0]) + ":" + str(self.connection.dest_addr[1])
-                self.log.info("connected to %s" % self.addr)
+            """
+            Called by the connection as soon as the handshake completes.
+            """
+            if self.connected or self.connection is None or self.connection.state != State.CONNECTED:
+                return
+            self.connected = True
+            self.addr = str(self.connection.dest_addr[0]) + ":" + str(self.connection.dest_addr[1])
+            self.log.info("connected to %s" % self.addr)
+            # Start each connection at a random point in the interval so connections
+            # made together don't keep pinging together.
+            self.schedule_keep_alive(self.keep_alive_interval * uniform(0.5, 1))
 
         def receive_message(self, datagram):
-            if len(datagram) < 166:
+            if self.verifying is not None:
+                # Don't process anything else until we know who we are talking to.
+                self.queue.append(datagram)
+                return
+            # Session authenticated messages don't carry the full sender node or a signature
+            # so they are quite a bit smaller than signed ones.
+            if len(datagram) < (64 if self.session.key is not None else 166):
                 self.log.warning("received datagram too small from %s, ignoring" % self.addr)
                 return False
             try:
                 m = Message()
                 m.ParseFromString(datagram)
-                self.node = Node(m.sender.guid,
-                                 m.sender.nodeAddress.ip,
-                                 m.sender.nodeAddress.port,
-                                 m.sender.publicKey,
-                                 None if not m.sender.HasField("relayAddress") else
-                                 (m.sender.relayAddress.ip, m.sender.relayAddress.port),
-                                 m.sender.natType,
-                                 m.sender.vendor)
-                if self.time_last_message == 0:
-                    pubkey = m.sender.publicKey
-                    verify_key = nacl.signing.VerifyKey(pubkey)
-                    signature = m.signature
-                    m.ClearField("signature")
-                    verify_key.verify(m.SerializeToString(), signature)
-                    h = nacl.hash.sha512(m.sender.publicKey)
-                    pow_hash = h[40:]
-                    if int(pow_hash[:6], 16) >= 50 or m.sender.guid.encode("hex") != h[:40]:
-                        raise Exception('Invalid GUID')
-                for processor in self.processors:
-                    if m.command in processor or m.command == NOT_FOUND:
-                        processor.receive_message(m, self.node, self.connection)
-                if m.command != PING:
-                    self.time_last_message = time.time()
+                if self.session.is_sealed(m):
+                    if self.node is None or m.sender.guid != self.node.id or not self.session.verify(m):
+                        raise Exception('Invalid MAC')
+                else:
+                    node = Node(m.sender.guid,
+                                m.sender.nodeAddress.ip,
+                                m.sender.nodeAddress.port,
+                                m.sender.publicKey,
+                                None if not m.sender.HasField("relayAddress") else
+                                (m.sender.relayAddress.ip, m.sender.relayAddress.port),
+                                m.sender.natType,
+                                m.sender.vendor)
+                    supports_session = m.protoVer >= SESSION_VERSION
+                    # Whatever version the message claims, a guid or key we haven't checked the
+                    # signature for yet isn't taken on until it has been.
+                    if self.node is None or node.id != self.node.id or node.pubkey != self.node.pubkey or \
+                            (supports_session and node.pubkey != self.session.remote_pubkey):
+                        signature = m.signature
+                        m.ClearField("signature")
+                        self.verifying = verify_identity(m.sender.guid, m.sender.publicKey,
+                                                         m.SerializeToString(), signature)
+                        self.verifying.addCallback(self.on_verified, m, node, supports_session)
+                        self.verifying.addErrback(self.on_invalid_message)
+                        self.verifying.addBoth(self.process_queue)
+                        return
+                    self.node = node
+                self.process_message(m)
             except Exception:
-                # If message isn't formatted property then ignore
-                self.log.warning("received an invalid message from %s, ignoring" % self.addr)
-                return False
+                return self.on_invalid_message()
+
+        def on_verified(self, _, m, node, supports_session):
+            self.node = node
+            if supports_session:
+                self.session.establish(self.processors[0].signing_key, m.sender.publicKey, self.connection)
+            self.process_message(m)
+
+        def on_invalid_message(self, *_):
+            # If message isn't formatted property then ignore
+            self.log.warning("received an invalid message from %s, ignoring" % self.addr)
+            return False
+
+        def process_message(self, m):
+            self.verified = True
+            self.remote_version = m.protoVer
+            if m.command in (NOT_FOUND, CALM_DOWN):
+                # These are only ever responses and we can't tell which processor sent the
+                # request so let each of them check.
+                for processor in self.processors:
+                    processor.receive_message(m, self.node, self.connection)
+            elif m.command in self.dispatch:
+                self.dispatch[m.command].receive_message(m, self.node, self.connection)
+            if m.command != PING:
+                self.time_last_message = time.time()
+
+        def process_queue(self, _):
+            self.verifying = None
+            while len(self.queue) > 0 and self.verifying is None:
+                self.receive_message(self.queue.pop(0))
 
         def handle_shutdown(self):
             try:
@@ -117,29 +197,36 @@ class OpenBazaarProtocol(ConnectionMultiplexer):
             if self.node is None:
                 self.node = Node(digest("null"), str(self.connection.dest_addr[0]),
                                  int(self.connection.dest_addr[1]))
-            for processor in self.processors:
-                processor.timeout(self.node)
+            # A connection closed to make room for another wasn't at fault so leave the
+            # node in the routing table. It has no outstanding requests to fail.
+            if not self.evicted:
+                for processor in self.processors:
+                    processor.timeout(self.node)
 
             if self.addr:
                 self.log.info("connection with %s terminated" % self.addr)
-            try:
-                self.ban_score.scoring_loop.stop()
-            except Exception:
-                pass
-            try:
-                self.keep_alive_loop.stop()
-            except Exception:
-                pass
+            if self.keep_alive_call is not None:
+                self.keep_alive_call.cancel()
+                self.keep_alive_call = None
             if self.relay_node == (self.connection.dest_addr[0], self.connection.dest_addr[1]):
                 self.log.info("Disconnected from relay node. Picking new one...")
                 self.change_relay_node()
 
+        def schedule_keep_alive(self, delay):
+            if self.keep_alive_timers is not None:
+                self.keep_alive_call = self.keep_alive_timers.schedule(delay, self.keep_alive)
+
         def keep_alive(self):
             """
             Let's check that this node has been active in the last 15 minutes. If not
             and if it's not in our routing table, we don't need to keep the connection
-            open. Otherwise PING it to make sure the NAT doesn't drop the mapping.
+            open. Otherwise PING it to make sure the NAT doesn't drop the mapping. If
+            the connection has carried traffic within the interval the mapping is still
+            fresh so the PING is skipped and the next check is pushed back instead.
             """
+            self.keep_alive_call = None
+            if self.connection is None or self.connection.state != State.CONNECTED:
+                return
             t = time.time()
             router = self.processors[0].router
             if (
@@ -150,10 +237,14 @@ class OpenBazaarProtocol(ConnectionMultiplexer):
             ):
                 self.connection.shutdown()
                 return
-            if t - self.time_last_message >= 30:
-                for processor in self.processors:
-                    if PING in processor and self.node is not None:
-                        processor.callPing(self.node)
+            idle = t - self.time_last_message
+            if idle < self.keep_alive_interval:
+                self.schedule_keep_alive((self.keep_alive_interval - idle) * uniform(1, 1.1))
+                return
+            for processor in self.processors:
+                if PING in processor and self.node is not None:
+                    processor.callPing(self.node)
+            self.schedule_keep_alive(self.keep_alive_interval * uniform(0.9, 1.1))
 
         def change_relay_node(self):
             potential_relay_nodes = []
@@ -186,50 +277,143 @@ class OpenBazaarProtocol(ConnectionMultiplexer):
 
     class ConnHandlerFactory(HandlerFactory):
 
-        def __init__(self, processors, nat_type, relay_node):
+        def __init__(self, processors, nat_type, relay_node, dispatch, keep_alive_timers=None):
             super(OpenBazaarProtocol.ConnHandlerFactory, self).__init__()
             self.processors = processors
             self.nat_type = nat_type
             self.relay_node = relay_node
+            self.dispatch = dispatch
+            self.keep_alive_timers = keep_alive_timers
 
         def make_new_handler(self, *args, **kwargs):
-            return OpenBazaarProtocol.ConnHandler(self.processors, self.nat_type, self.relay_node)
+            return OpenBazaarProtocol.ConnHandler(self.processors, self.nat_type, self.relay_node, self.dispatch,
+                                                  self.keep_alive_timers)
 
     def register_processor(self, processor):
         """Add a new class which implements the `MessageProcessor` interface."""
         if verifyObject(MessageProcessor, processor):
             self.processors.append(processor)
+            self._update_dispatch()
 
     def unregister_processor(self, processor):
         """Unregister the given processor."""
         if processor in self.processors:
             self.processors.remove(processor)
+            self._update_dispatch()
+
+    def _update_dispatch(self):
+        # The table is shared with every connection handler so update it in place.
+        self.dispatch.clear()
+        self.dispatch.update(build_dispatch_table(self.processors))
 
     def set_servers(self, ws, blockchain):
         self.ws = ws
         self.blockchain = blockchain
 
-    def keep_alive(self):
-        for connection in self.values():
-            if connection.state == State.CONNECTED:
-                connection.handler.keep_alive()
+    def make_new_connection(self, own_addr, source_addr, relay_addr=None, outbound=False):
+        """
+        Txrudp calls this for every SYN from an address we don't have a connection to and
+        the source address of those is trivial to spoof. So at the connection limit an
+        incoming connection only replaces one which hasn't authenticated itself yet, and
+        is refused otherwise. Only connections we open ourselves can close an established
+        one. Incoming connections from banned peers are refused too.
+        """
+        if not outbound and self.rate_limiter.is_banned(source_addr):
+            return None
+        if len(self) >= self.max_connections:
+            if not self.evict_connection(established=outbound) and not outbound:
+                self.log.debug("connection limit reached, refusing connection from %s:%s" % source_addr)
+                return None
+        return ConnectionMultiplexer.make_new_connection(self, own_addr, source_addr, relay_addr)
+
+    def evict_connection(self, established=True):
+        """
+        Close a connection to make room for a new one. The oldest connection which hasn't
+        sent us an authenticated message yet goes first. Failing that, if `established` is
+        True, the least recently used one is closed. Connections to our relay node and to
+        peers we are waiting on a response from are never evicted. Returns True if a
+        connection was closed.
+        """
+        relay_nodes = set([processor.sourceNode.relay_node for processor in self.processors])
+        unverified, unverified_time = None, None
+        lru, lru_time = None, None
+        for address, connection in self.items():
+            handler = connection.handler
+            if address in relay_nodes or getattr(handler, "relay_node", None) == address or \
+                    any(processor.has_outstanding_requests(address) for processor in self.processors):
+                continue
+            created = getattr(handler, "time_created", 0)
+            if not getattr(handler, "verified", False):
+                if unverified_time is None or created < unverified_time:
+                    unverified, unverified_time = connection, created
+                continue
+            last_used = max(getattr(handler, "time_last_message", 0), created)
+            if lru_time is None or last_used < lru_time:
+                lru, lru_time = connection, last_used
+        victim = unverified if unverified is not None else lru if established else None
+        if victim is None:
+            self.log.warning("connection limit reached but no connection can be closed")
+            return False
+        self.log.debug("connection limit reached, closing connection to %s:%s" % victim.dest_addr)
+        victim.handler.evicted = True
+        victim.shutdown()
+        return True
+
+    def __delitem__(self, addr):
+        ConnectionMultiplexer.__delitem__(self, addr)
+        self.send_queue.remove(addr)
 
-    def send_message(self, datagram, address, relay_addr):
+    def send_message(self, datagram, address, relay_addr, priority=INTERACTIVE):
         """
         Sends a datagram over the wire to the given address. It will create a new rudp connection if one
-        does not already exist for this peer.
+        does not already exist for this peer. The datagram is paced by the send queue and a `Deferred` is
+        returned which fires once it has been handed to the connection.
 
         Args:
             datagram: the raw data to send over the wire
             address: a `tuple` of (ip address, port) of the recipient.
             relay_addr: a `tuple` of (ip address, port) of the relay address
                 or `None` if no relaying is required.
+            priority: the `net.sendqueue` priority of the message.
         """
         if address not in self:
-            con = self.make_new_connection(self.ip_address, address, relay_addr)
+            con = self.make_new_connection(self.ip_address, address, relay_addr, outbound=True)
         else:
             con = self[address]
         if relay_addr is not None and relay_addr != con.relay_addr and relay_addr != con.own_addr:
             con.set_relay_address(relay_addr)
 
-        con.send_message(datagram)
+        return self.send_queue.enqueue(address, datagram, con.send_message, priority)
+
+
+def build_dispatch_table(processors):
+    """
+    Map each command to the `MessageProcessor` which handles it so incoming messages
+    can be routed with a single lookup. If more than one processor claims a command
+    the first one registered wins.
+    """
+    table = {}
+    for processor in processors:
+        for command in processor:
+            table.setdefault(command, processor)
+    return table
+
+
+class NotifyingConnection(CryptoConnection):
+    """
+    A `CryptoConnection` which tells its handler the moment the handshake completes
+    rather than leaving it to poll the connection state.
+    """
+
+    def _process_syn_packet(self, rudp_packet):
+        super(NotifyingConnection, self)._process_syn_packet(rudp_packet)
+        self.handler.on_connection_made()
+
+
+class NotifyingConnectionFactory(CryptoConnectionFactory):
+
+    def make_new_connection(self, proto_handle, own_addr, source_addr, relay_addr, private_key=None):
+        handler = self.handler_factory.make_new_handler(own_addr, source_addr, relay_addr)
+        connection = NotifyingConnection(proto_handle, handler, own_addr, source_addr, relay_addr, private_key)
+        handler.connection = connection
+        return connection
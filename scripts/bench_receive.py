@@ -0,0 +1,118 @@
+"""
+Measure how many messages per second ConnHandler.receive_message can process.
+
+A single peer sends PING messages over an established connection. Signed pings are
+fully verified while sealed pings only need their session MAC checked. Run from the
+root of the repo:
+
+    python scripts/bench_receive.py [count]
+"""
+
+import os
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+import nacl.encoding
+import nacl.hash
+import nacl.signing
+from binascii import unhexlify
+from config import PROTOCOL_VERSION
+from db.datastore import Database
+from dht.node import Node
+from dht.protocol import KademliaProtocol
+from dht.storage import ForgetfulStorage
+from dht.utils import digest
+from net.sendqueue import SendQueue
+from net.wireprotocol import OpenBazaarProtocol
+from protos import message, objects
+from txrudp.connection import State
+
+PEER_KEY = "63d901c4d57cde34fc1f1e28b9af5d56ed342cae5c2fb470046d0130a4226b0c"
+
+
+class Connection(object):
+    """Just enough of a txrudp connection to hand responses to."""
+
+    state = State.CONNECTED
+
+    def __init__(self, handler, dest_addr):
+        self.handler = handler
+        self.dest_addr = dest_addr
+        self.sent = 0
+
+    def send_message(self, data):
+        self.sent += 1
+
+    def shutdown(self):
+        pass
+
+
+def make_node(signing_key, address):
+    h = nacl.hash.sha512(signing_key.verify_key.encode())
+    return Node(unhexlify(h[:40]), address[0], address[1], signing_key.verify_key.encode(),
+                None, objects.FULL_CONE, True)
+
+
+def make_pings(count, node, signing_key, session=None):
+    pings = []
+    for i in range(count):
+        m = message.Message()
+        m.messageID = digest("%s %d" % ("sealed" if session is not None else "signed", i))
+        m.command = message.PING
+        m.protoVer = PROTOCOL_VERSION
+        m.testnet = False
+        if session is not None:
+            m.sender.guid = node.id
+            m.signature = session.mac(m.SerializeToString())
+        else:
+            m.sender.MergeFrom(node.getProto())
+            m.signature = signing_key.sign(m.SerializeToString())[:64]
+        pings.append(m.SerializeToString())
+    return pings
+
+
+def run(handler, pings):
+    start = time.time()
+    for datagram in pings:
+        handler.receive_message(datagram)
+    return len(pings) / (time.time() - start)
+
+
+def main():
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else 5000
+    own_addr = ("123.45.67.89", 18467)
+    peer_addr = ("132.54.76.98", 18467)
+    own_key = nacl.signing.SigningKey.generate()
+    # guids need a proof of work so the peer uses a known good key
+    peer_key = nacl.signing.SigningKey(PEER_KEY, encoder=nacl.encoding.HexEncoder)
+    own_node = make_node(own_key, own_addr)
+    peer_node = make_node(peer_key, peer_addr)
+
+    db_file = tempfile.mktemp(suffix=".db")
+    try:
+        db = Database(filepath=db_file)
+        protocol = KademliaProtocol(own_node, ForgetfulStorage(), 20, db, own_key)
+        wire_protocol = OpenBazaarProtocol(db, own_addr, objects.FULL_CONE)
+        wire_protocol.send_queue = SendQueue(rate=float("inf"), peer_rate=float("inf"))
+        wire_protocol.rate_limiter.allow = lambda address, command, args: True
+        wire_protocol.register_processor(protocol)
+        protocol.connect_multiplexer(wire_protocol)
+
+        handler = wire_protocol.ConnHandler(wire_protocol.processors, objects.FULL_CONE, None,
+                                            wire_protocol.dispatch)
+        handler.connection = Connection(handler, peer_addr)
+
+        print "signed: %d messages/s" % run(handler, make_pings(count, peer_node, peer_key))
+        sealed = make_pings(count, peer_node, peer_key, handler.session)
+        print "sealed: %d messages/s" % run(handler, sealed)
+        print "responses sent: %d" % handler.connection.sent
+    finally:
+        if os.path.exists(db_file):
+            os.remove(db_file)
+
+
+if __name__ == "__main__":
+    main()